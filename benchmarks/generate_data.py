@@ -0,0 +1,179 @@
+"""
+Builds benchmark databases filled with synthetic, deterministic data:
+
+- an encrypted operations database with init_db.py's schema, all migrations, synced sales history,
+  sieve tests and a built sales rollup, for the report, export and sieve page benchmarks;
+- a plain SQLite "Sage" database with the same sales history in Sage's table layout, which the
+  stand-in pyodbc module in benchmarks/sage_standin serves to pull_sage.py for offline sync runs.
+
+Usage: python benchmarks/generate_data.py [--customers 50000] [--lines 5000000] [--seed 42]
+"""
+import os
+import sys
+import random
+import sqlite3 as plain_sqlite3
+import argparse
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+from init_db import create_schema
+from migrations import apply_migrations
+from sales_summary import classify_items, rebuild_rollup
+from sieve_analysis import refresh_stored_results
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB = os.path.join(BENCH_DIR, "bench.db")
+DEFAULT_SAGE_DB = os.path.join(BENCH_DIR, "bench_sage.db")
+DEFAULT_PASSWORD = "benchmark"
+INSERT_BATCH = 10000
+
+PRODUCTS = ['20/40 Frac Sand', '30/50 Frac Sand', '40/70 Frac Sand', '100 Mesh Sand', 'Glass Sand', 'Foundry Sand',
+            'Filter Sand', 'Golf Course Sand', 'Play Sand', 'Blasting Sand']
+# Non-product lines, matched by the default tons-sold exclusion keywords.
+CHARGES = ['Freight Charge', 'Pallet', 'Lease Fee', 'Dunnage', 'Fuel Surcharge Misc', 'Shrinkwrap']
+STATES = ['TX', 'OK', 'LA', 'NM', 'WI', 'MN', 'IL', 'OH', 'PA', 'ND']
+SIEVES = [20, 30, 40, 50, 70, 100, 140, 200, 270]
+
+def generate_customers(rng, count):
+    for i in range(count):
+        yield (f"C{i:06d}", f"{rng.choice(['Acme', 'Summit', 'Prairie', 'Lone Star', 'Northern', 'Delta'])} {rng.choice(['Energy', 'Glass', 'Foundry', 'Supply', 'Materials'])} {i}")
+
+def generate_items(rng, count):
+    """(ItemCode, description, ProductLine, unit price); about one item in six is a charge line."""
+    for i in range(count):
+        charge = i % 6 == 5
+        desc = rng.choice(CHARGES if charge else PRODUCTS)
+        yield (f"{'CHG' if charge else 'SND'}{i:05d}", f"{desc} {i}", 'CHG' if charge else 'SAND', round(rng.uniform(5, 120), 2))
+
+def generate_invoices(rng, lines, customers, items, start=date(2015, 1, 1), years=10):
+    """Yields (header, [detail lines]) per invoice until `lines` detail lines have been produced."""
+    days, invoice, produced = years * 365, 0, 0
+    while produced < lines:
+        invoice += 1
+        count = min(rng.randint(1, 5), lines - produced)
+        order_date = (start + timedelta(days=days * produced // lines)).isoformat()
+        customer_no = f"C{rng.randrange(customers):06d}"
+        state, city = rng.choice(STATES), f"City {rng.randrange(500)}"
+        header = (f"{invoice:07d}", order_date, f"PO{rng.randrange(10**6):06d}", f"Site {customer_no}", f"{rng.randrange(9999)} Main St",
+                  city, state, f"{rng.randrange(10000, 99999)}", f"Bill {customer_no}", f"{rng.randrange(9999)} Oak Ave", city, state,
+                  f"{rng.randrange(10000, 99999)}", rng.choice(['TRUCK', 'RAIL', 'CPU']), customer_no)
+        detail = []
+        for seq in range(count):
+            code, desc, _, price = items[rng.randrange(len(items))]
+            ordered = round(rng.uniform(1, 40), 2)
+            shipped = ordered if rng.random() > 0.1 else round(ordered * rng.random(), 2)
+            detail.append((header[0], f"{seq + 1:03d}", code, desc, ordered, shipped, price, round(shipped * price, 2), ''))
+        produced += count
+        yield header, detail
+
+def batched(rows, size=INSERT_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch; batch = []
+    if batch: yield batch
+
+def invoice_rows(args, items):
+    """Streams (headers, details) batches of the same invoices for both databases."""
+    rng = random.Random(args.seed + 1)
+    headers, details = [], []
+    for header, detail in generate_invoices(rng, args.lines, args.customers, items):
+        headers.append(header); details.extend(detail)
+        if len(details) >= INSERT_BATCH:
+            yield headers, details
+            headers, details = [], []
+    if details: yield headers, details
+
+def create_operations_db(args, customers, items):
+    if os.path.exists(args.db): os.remove(args.db)
+    con = sqlite3.connect(args.db)
+    con.execute(f"PRAGMA key = '{args.password}';")
+    create_schema(con.cursor())
+    con.execute("INSERT INTO config (key, value) VALUES ('sage_dsn', 'BENCH'), ('sage_company_code', 'BEN')")
+    con.execute("INSERT INTO credentials VALUES ('sage100', 'localhost', 'bench', 'bench', 'bench')")
+    con.execute("INSERT INTO scheduler_jobs (job_name, script_path, interval_minutes, enabled) VALUES ('Sync Sage 100 Data', 'pull_sage.py', 1440, 0)")
+    con.commit()
+    apply_migrations(con, verbose=False)
+    con.execute("PRAGMA journal_mode = WAL")
+
+    con.executemany("INSERT INTO Customer VALUES (?, ?)", customers)
+    con.executemany("INSERT INTO CI_Item VALUES (?, ?, 'F', 'TON', 'TON', ?, ?)", ((code, line, price, desc) for code, desc, line, price in items))
+    for headers, details in invoice_rows(args, items):
+        con.executemany("""INSERT INTO SalesOrderHeader (SalesOrderNo, OrderDate, CustomerPONo, ShipToName, ShipToAddress1, ShipToCity, ShipToState,
+                           ShipToZipCode, BillToName, BillToAddress1, BillToCity, BillToState, BillToZipCode, ShipVia, CustomerNo)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", headers)
+        con.executemany("INSERT INTO SalesOrderDetail VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", details)
+    con.commit()
+
+    rng = random.Random(args.seed + 2)
+    con.executemany("INSERT INTO Sample (Name) VALUES (?)", ((name,) for name in PRODUCTS))
+    con.executemany("INSERT INTO SieveDefaults VALUES (?)", ((sieve,) for sieve in SIEVES))
+    for test_id in range(1, args.sieve_tests + 1):
+        test_date = (date(2015, 1, 1) + timedelta(days=test_id * 3650 // args.sieve_tests)).isoformat()
+        con.execute("INSERT INTO SieveTest (SieveTestID, SieveTestDate, CarorTruckNumber, BillofLading, SampleID) VALUES (?, ?, ?, ?, ?)",
+                    (test_id, test_date, f"TRK{rng.randrange(1000):03d}", f"BOL{test_id:06d}", rng.randint(1, len(PRODUCTS))))
+        con.executemany("INSERT INTO SieveTestDetail (SieveTestID, USSieve, Weight) VALUES (?, ?, ?)",
+                        ((test_id, sieve, round(rng.uniform(0, 30), 1)) for sieve in SIEVES))
+    con.commit()
+    refresh_stored_results(con)
+
+    con.execute("BEGIN")
+    classify_items(con, 'SalesOrderDetail')
+    con.commit()
+    rebuild_rollup(con)
+    con.close()
+
+def create_sage_db(args, customers, items):
+    if os.path.exists(args.sage_db): os.remove(args.sage_db)
+    con = plain_sqlite3.connect(args.sage_db)
+    con.executescript("""
+        CREATE TABLE AR_Customer (CustomerNo TEXT PRIMARY KEY, CustomerName TEXT);
+        CREATE TABLE CI_Item (ItemCode TEXT PRIMARY KEY, ProductLine TEXT, ProductType TEXT, SalesUnitOfMeasure TEXT,
+                              PurchaseUnitOfMeasure TEXT, StandardUnitPrice REAL, CommentText TEXT);
+        CREATE TABLE AR_InvoiceHistoryHeader (InvoiceNo TEXT PRIMARY KEY, OrderDate TEXT, CustomerPONo TEXT, ShipToName TEXT, ShipToAddress1 TEXT,
+                                              ShipToCity TEXT, ShipToState TEXT, ShipToZipCode TEXT, BillToName TEXT, BillToAddress1 TEXT,
+                                              BillToCity TEXT, BillToState TEXT, BillToZipCode TEXT, ShipVia TEXT, CustomerNo TEXT);
+        CREATE TABLE AR_InvoiceHistoryDetail (InvoiceNo TEXT, DetailSeqNo TEXT, ItemCode TEXT, ItemCodeDesc TEXT, QuantityOrdered REAL,
+                                              QuantityShipped REAL, UnitPrice REAL, ExtensionAmt REAL, CommentText TEXT,
+                                              PRIMARY KEY (InvoiceNo, DetailSeqNo));
+    """)
+    con.executemany("INSERT INTO AR_Customer VALUES (?, ?)", customers)
+    con.executemany("INSERT INTO CI_Item VALUES (?, ?, 'F', 'TON', 'TON', ?, ?)", ((code, line, price, desc) for code, desc, line, price in items))
+    for headers, details in invoice_rows(args, items):
+        con.executemany("INSERT INTO AR_InvoiceHistoryHeader VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", headers)
+        con.executemany("INSERT INTO AR_InvoiceHistoryDetail VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", details)
+    con.commit()
+    con.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic benchmark databases.")
+    parser.add_argument("--db", default=DEFAULT_DB, help="Encrypted operations database to create.")
+    parser.add_argument("--sage-db", default=DEFAULT_SAGE_DB, help="Plain SQLite database served as Sage 100 by the stand-in pyodbc.")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD, help="Master password of the generated database.")
+    parser.add_argument("--customers", type=int, default=50000)
+    parser.add_argument("--items", type=int, default=600)
+    parser.add_argument("--lines", type=int, default=5000000, help="Sales order detail lines (about three per invoice).")
+    parser.add_argument("--sieve-tests", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    customers = list(generate_customers(rng, args.customers))
+    items = list(generate_items(rng, args.items))
+    print(f"Generating {args.customers} customers, {args.items} items, {args.lines} sales lines and {args.sieve_tests} sieve tests...")
+    create_sage_db(args, customers, items)
+    print(f"Created Sage stand-in database '{args.sage_db}'.")
+    create_operations_db(args, customers, items)
+    print(f"Created operations database '{args.db}' (password '{args.password}').")
+
+if __name__ == "__main__":
+    main()
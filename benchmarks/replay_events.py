@@ -0,0 +1,125 @@
+"""
+Replays a recorded plant feed - or a synthetic one - against the OPEvent ingestion endpoint, for load
+testing. Events are sent as NDJSON batches at a target rate from several concurrent senders, backing
+off when the server answers 503, and the run ends with throughput and batch latency figures.
+
+Recorded feeds are NDJSON or CSV files with OPEvent columns (or the short names event_ingest.py accepts).
+--retime shifts their timestamps so the feed plays as if it started now, and so shows on the dashboards.
+
+Usage: python benchmarks/replay_events.py --token TOKEN [feed.ndjson | --synthetic 100000] [--rate 5000]
+"""
+import os
+import sys
+import csv
+import ssl
+import json
+import time
+import random
+import argparse
+import threading
+import statistics
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIME_FIELDS = ('OPEventTime', 'time')
+
+def load_feed(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if path.endswith('.csv'): return [{k: v for k, v in row.items() if v != ''} for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f if line.strip()]
+
+def synthetic_feed(count, operations, seed=42):
+    """`count` readings spread over `operations` operations, one second apart per operation, ending now."""
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(seconds=count // operations)
+    levels = [rng.uniform(10, 500) for _ in range(operations)]
+    return [{'operation_id': i % operations + 1, 'time': (start + timedelta(seconds=i // operations)).strftime(TIME_FORMAT),
+             'value': round(levels[i % operations] * rng.uniform(0.95, 1.05), 3), 'code_id': 1} for i in range(count)]
+
+def retime(events):
+    """Shifts every event by the same amount so the earliest one happens now."""
+    field = next((f for f in TIME_FIELDS if events and f in events[0]), None)
+    if not field: sys.exit("FATAL: The feed has no OPEventTime column to retime.")
+    times = [datetime.fromisoformat(str(event[field])) for event in events]
+    shift = datetime.now() - min(times)
+    for event, moment in zip(events, times): event[field] = (moment + shift).strftime(TIME_FORMAT)
+
+class Replay:
+    def __init__(self, args, batches):
+        self.args, self.batches = args, batches
+        self.run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.context = ssl._create_unverified_context() if args.insecure else None
+        self.lock = threading.Lock()
+        self.totals = {'accepted': 0, 'rejected': 0, 'duplicate_batches': 0, 'busy_retries': 0, 'failed_batches': 0}
+        self.latencies = []
+
+    def send(self, index):
+        args, body = self.args, self.batches[index]
+        if args.rate:  # Each batch is due when the events before it have been sent at the target rate.
+            delay = self.started + index * args.batch_size / args.rate - time.monotonic()
+            if delay > 0: time.sleep(delay)
+        data = "\n".join(json.dumps(event) for event in body).encode()
+        # A stable batch id makes a retried batch idempotent on the server.
+        headers = {'Content-Type': 'application/x-ndjson', 'Authorization': f"Bearer {args.token}", 'X-Batch-Id': f"replay-{self.run_id}-{index}"}
+        for _ in range(args.retries + 1):
+            request = urllib.request.Request(args.url, data=data, headers=headers, method='POST')
+            start = time.monotonic()
+            try:
+                with urllib.request.urlopen(request, context=self.context, timeout=60) as response: result = json.load(response)
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    print(f"ERROR: Batch {index} failed: {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
+                    break
+                with self.lock: self.totals['busy_retries'] += 1
+                time.sleep(float(e.headers.get('Retry-After') or 1))
+                continue
+            except (urllib.error.URLError, OSError) as e:
+                print(f"ERROR: Batch {index} failed: {e}", file=sys.stderr)
+                break
+            with self.lock:
+                self.latencies.append(time.monotonic() - start)
+                self.totals['accepted'] += result['accepted']
+                self.totals['rejected'] += result['rejected']
+                self.totals['duplicate_batches'] += result['duplicate']
+            return
+        with self.lock: self.totals['failed_batches'] += 1
+
+    def run(self):
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(self.args.concurrency) as pool: list(pool.map(self.send, range(len(self.batches))))
+        elapsed = time.monotonic() - self.started
+        latencies = sorted(self.latencies) or [0]
+        return dict(self.totals, events=sum(map(len, self.batches)), batches=len(self.batches), seconds=round(elapsed, 3),
+                    accepted_per_second=round(self.totals['accepted'] / elapsed, 1) if elapsed else None,
+                    batch_seconds_p50=round(statistics.median(latencies), 4),
+                    batch_seconds_p95=round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4),
+                    batch_seconds_max=round(latencies[-1], 4))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay OPEvent feeds against the ingestion endpoint.")
+    parser.add_argument("feed", nargs="*", help="Recorded NDJSON or CSV feed files, replayed in order.")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="Send N generated events instead of a recorded feed.")
+    parser.add_argument("--operations", type=int, default=50, help="Operations the synthetic events are spread over (default 50).")
+    parser.add_argument("--url", default="https://localhost:5000/api/ops/events")
+    parser.add_argument("--token", default=os.environ.get('INGEST_TOKEN'), help="Source token (default: $INGEST_TOKEN).")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="Target events per second; 0 sends as fast as the server accepts.")
+    parser.add_argument("--concurrency", type=int, default=2, help="Batches in flight at once.")
+    parser.add_argument("--retries", type=int, default=20, help="Times a batch is retried after a 503.")
+    parser.add_argument("--retime", action="store_true", help="Shift recorded timestamps so the feed starts now.")
+    parser.add_argument("--insecure", action="store_true", help="Do not verify the server certificate (the self-signed one from generate_cert.py).")
+    args = parser.parse_args()
+    if not args.token: sys.exit("FATAL: A source token is required; create one with 'python event_ingest.py add-source NAME'.")
+    if bool(args.feed) == bool(args.synthetic): sys.exit("FATAL: Give either feed files or --synthetic N.")
+
+    events = synthetic_feed(args.synthetic, args.operations) if args.synthetic else [e for path in args.feed for e in load_feed(path)]
+    if args.retime and not args.synthetic: retime(events)
+    batches = [events[i:i + args.batch_size] for i in range(0, len(events), args.batch_size)]
+    print(f"Replaying {len(events)} events in {len(batches)} batches to {args.url}...", file=sys.stderr)
+    print(json.dumps(Replay(args, batches).run(), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Runs repeatable benchmarks against the databases made by benchmarks/generate_data.py and writes the
+results as JSON, so runs before and after a change can be compared.
+
+Each benchmark is timed over --repeat runs, with the report cache cleared first so every run does the
+real work, and then run once more under tracemalloc to record its peak Python memory.
+
+Usage: python benchmarks/run_benchmarks.py [--output results.json] [--only export_item sync_full]
+"""
+import io
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import statistics
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+# The stand-in pyodbc must shadow any real one, so pull_sage.py talks to the synthetic Sage database.
+sys.path[:0] = [os.path.join(BENCH_DIR, 'sage_standin'), ROOT]
+
+from generate_data import DEFAULT_DB, DEFAULT_SAGE_DB, DEFAULT_PASSWORD
+import main
+import pull_sage
+import sales_summary
+import sieve_analysis
+from db_pool import ConnectionPool, open_connection
+from init_db import create_schema
+from migrations import apply_migrations
+
+FULL_RANGE = ('2000-01-01', '2099-12-31')
+ONE_YEAR = ('2020-01-01', '2020-12-31')
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        main.DATABASE = args.db
+        main.db_pool = ConnectionPool(args.db, args.password)
+        main.db_pool.release(main.db_pool.acquire())  # Pay key derivation here, not in the first benchmark.
+        self.client = main.app.test_client()
+        # Unlock the test client's session without /login, which would also start the scheduler.
+        with self.client.session_transaction() as sess: sess['db_unlock'] = main.db_pool.token
+
+    def query(self, fn, *args):
+        with main.db_connection() as con: return len(fn(con, *args))
+
+    def page(self, path):
+        response = self.client.get(path)
+        if response.status_code != 200: raise RuntimeError(f"GET {path} returned {response.status_code}")
+        return len(response.get_data())
+
+    def rebuild_rollup(self):
+        with main.db_connection() as con: return sales_summary.rebuild_rollup(con)
+
+    def sync(self, target):
+        # A fresh encrypted database per run, so a full sync really inserts everything.
+        con = self._empty_database(target)
+        try:
+            status = pull_sage.run_sync(con, pull_sage.get_sage_creds_and_config(con), full_sync=True)
+            if set(status.values()) != {'Success'}: raise RuntimeError(f"Sync failed: {status}")
+            return con.execute("SELECT COUNT(*) FROM SalesOrderDetail").fetchone()[0]
+        finally:
+            con.close()
+
+    def resync(self, target):
+        # A second full sync of unchanged data: every row is compared and skipped.
+        if not os.path.exists(target): self.sync(target)
+        con = open_connection(target, self.args.password)
+        try:
+            pull_sage.run_sync(con, pull_sage.get_sage_creds_and_config(con), full_sync=True)
+            return con.execute("SELECT COUNT(*) FROM SalesOrderDetail").fetchone()[0]
+        finally:
+            con.close()
+
+    def _empty_database(self, target):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(target + suffix): os.remove(target + suffix)
+        con = pull_sage.sqlite3.connect(target, check_same_thread=False)
+        con.row_factory = pull_sage.sqlite3.Row
+        con.execute(f"PRAGMA key = '{self.args.password}';")
+        create_schema(con.cursor())
+        source = open_connection(self.args.db, self.args.password)
+        try: config = source.execute("SELECT key, value FROM config WHERE key LIKE 'sage_%'").fetchall()
+        finally: source.close()
+        con.executemany("INSERT INTO config (key, value) VALUES (?, ?)", config)
+        con.execute("INSERT INTO credentials VALUES ('sage100', 'localhost', 'bench', 'bench', 'bench')")
+        con.commit()
+        apply_migrations(con, verbose=False)
+        return con
+
+def benchmarks(bench, sync_db):
+    """name -> (unit, function returning how many units it processed)."""
+    return {
+        'sales_report_data_year': ('rows', lambda: bench.query(main.get_sales_report_data, *ONE_YEAR)),
+        'summary_by_item': ('rows', lambda: bench.query(sales_summary.get_summary_by_item, *FULL_RANGE)),
+        'summary_by_year': ('rows', lambda: bench.query(sales_summary.get_summary_by_year, *FULL_RANGE)),
+        'summary_by_month': ('rows', lambda: bench.query(sales_summary.get_summary_by_month, *FULL_RANGE)),
+        'rollup_rebuild': ('days', bench.rebuild_rollup),
+        'sales_report_page': ('bytes', lambda: bench.page(f"/sales-report?start_date={FULL_RANGE[0]}&end_date={FULL_RANGE[1]}")),
+        'sales_detail_api_page': ('bytes', lambda: bench.page(f"/api/sales/detail?start_date={FULL_RANGE[0]}&end_date={FULL_RANGE[1]}&limit=1000")),
+        'export_detailed_year': ('bytes', lambda: bench.page(f"/export/sales?report_type=detailed&start_date={ONE_YEAR[0]}&end_date={ONE_YEAR[1]}")),
+        'export_item': ('bytes', lambda: bench.page(f"/export/sales?report_type=item&start_date={FULL_RANGE[0]}&end_date={FULL_RANGE[1]}")),
+        'export_year': ('bytes', lambda: bench.page(f"/export/sales?report_type=year&start_date={FULL_RANGE[0]}&end_date={FULL_RANGE[1]}")),
+        'export_month': ('bytes', lambda: bench.page(f"/export/sales?report_type=month&start_date={FULL_RANGE[0]}&end_date={FULL_RANGE[1]}")),
+        'sieve_search_page': ('bytes', lambda: bench.page("/sieve")),
+        'sieve_detail_page': ('bytes', lambda: bench.page("/sieve/1")),
+        'sieve_product_trend_year': ('bytes', lambda: bench.page(f"/sieve/product/1?start_date={ONE_YEAR[0]}&end_date={ONE_YEAR[1]}")),
+        'sieve_analysis_all_tests': ('tests', lambda: bench.query(lambda con: sieve_analysis.analyze(*sieve_analysis.load_details(con))['tests'])),
+        'sync_full': ('rows', lambda: bench.sync(sync_db)),
+        'sync_full_unchanged': ('rows', lambda: bench.resync(sync_db)),
+    }
+
+def measure(fn, repeat):
+    seconds, units = [], 0
+    for _ in range(repeat):
+        main.report_cache.clear()
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            units = fn()
+            seconds.append(time.perf_counter() - start)
+    main.report_cache.clear()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()): fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, units, peak
+
+def database_stats(args):
+    con = open_connection(args.db, args.password)
+    try:
+        return {table: con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ('Customer', 'CI_Item', 'SalesOrderHeader', 'SalesOrderDetail', 'SieveTest', 'sales_daily_rollup')}
+    finally:
+        con.close()
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark reports, exports, sieve pages and the Sage sync on synthetic data.")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--sage-db", default=DEFAULT_SAGE_DB)
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark (default 3).")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="Run only these benchmarks.")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+    for path in (args.db, args.sage_db):
+        if not os.path.exists(path): sys.exit(f"FATAL: '{path}' not found. Run benchmarks/generate_data.py first.")
+    os.environ['BENCH_SAGE_DB'] = args.sage_db
+
+    bench = Bench(args)
+    work_dir = tempfile.mkdtemp(prefix='bench_sync_')
+    try:
+        suite = benchmarks(bench, os.path.join(work_dir, 'sync.db'))
+        unknown = set(args.only or ()) - set(suite)
+        if unknown: sys.exit(f"FATAL: Unknown benchmark(s): {', '.join(sorted(unknown))}. Available: {', '.join(suite)}")
+        results = {}
+        for name, (unit, fn) in suite.items():
+            if args.only and name not in args.only: continue
+            print(f"Running {name}...", file=sys.stderr)
+            seconds, units, peak = measure(fn, args.repeat)
+            best = min(seconds)
+            results[name] = {
+                'seconds': [round(s, 6) for s in seconds], 'best_seconds': round(best, 6), 'median_seconds': round(statistics.median(seconds), 6),
+                'unit': unit, 'units': units, f'{unit}_per_second': round(units / best, 1) if best else None, 'peak_memory_bytes': peak,
+            }
+            print(f"  best {best:.4f}s, {units} {unit}, peak memory {peak / 2**20:.1f} MiB", file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        main.db_pool.close()
+
+    report = {
+        'started_at': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+        'platform': platform.platform(), 'repeat': args.repeat, 'database': database_stats(args), 'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output + "\n")
+        print(f"Results written to '{args.output}'.", file=sys.stderr)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main_cli()
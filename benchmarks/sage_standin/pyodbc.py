@@ -0,0 +1,73 @@
+"""
+A stand-in for the pyodbc module that serves the Sage 100 tables from the plain SQLite database made by
+benchmarks/generate_data.py, so pull_sage.py can be benchmarked offline. Only what pull_sage.py uses is
+provided. Values come back typed like the ProvideX ODBC driver returns them: dates as datetime.date,
+amounts and quantities as Decimal, and cursor.description reports those types.
+
+Benchmarks put this directory first on sys.path; the database is taken from BENCH_SAGE_DB.
+"""
+import os
+import sqlite3
+from datetime import date
+from decimal import Decimal
+
+Error = sqlite3.Error
+
+DATE_COLUMNS = {'OrderDate'}
+DECIMAL_COLUMNS = {'StandardUnitPrice', 'QuantityOrdered', 'QuantityShipped', 'UnitPrice', 'ExtensionAmt'}
+
+def _column_type(name):
+    if name in DATE_COLUMNS: return date
+    if name in DECIMAL_COLUMNS: return Decimal
+    return str
+
+def _convert(type_code):
+    if type_code is date: return lambda v: None if v is None else date.fromisoformat(v)
+    if type_code is Decimal: return lambda v: None if v is None else Decimal(str(v))
+    return None
+
+class Cursor:
+    def __init__(self, con):
+        self._cursor, self.description, self._converters = con.cursor(), None, []
+
+    def execute(self, query, *params):
+        # pyodbc passes parameters positionally; SQLite wants dates as ISO strings.
+        self._cursor.execute(query, [p.isoformat() if isinstance(p, date) else p for p in params])
+        types = [_column_type(column[0]) for column in self._cursor.description]
+        self.description = [(column[0], type_code, None, None, None, None, True) for column, type_code in zip(self._cursor.description, types)]
+        self._converters = [(i, conv) for i, conv in enumerate(map(_convert, types)) if conv]
+        return self
+
+    def _rows(self, rows):
+        if not self._converters: return rows
+        converted = []
+        for row in rows:
+            row = list(row)
+            for i, conv in self._converters: row[i] = conv(row[i])
+            converted.append(tuple(row))
+        return converted
+
+    def fetchmany(self, size):
+        return self._rows(self._cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._rows(self._cursor.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+class Connection:
+    def __init__(self, database):
+        self._con = sqlite3.connect(database, check_same_thread=False)
+
+    def cursor(self):
+        return Cursor(self._con)
+
+    def close(self):
+        self._con.close()
+
+def connect(connection_string, autocommit=False, readonly=False, **kwargs):
+    database = os.environ.get('BENCH_SAGE_DB')
+    if not database or not os.path.exists(database):
+        raise Error(f"BENCH_SAGE_DB does not point to a Sage stand-in database (got {database!r}).")
+    return Connection(database)
@@ -0,0 +1,143 @@
+import sys
+import time
+import threading
+import secrets
+import hmac
+from contextlib import contextmanager
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+# Connection PRAGMAs applied whenever a connection is opened: config key -> (pragma, default).
+# WAL lets report pages keep reading while a sync writes; NORMAL synchronous is durable in WAL mode
+# except for the last transactions before a power loss.
+CONNECTION_PRAGMAS = {
+    'db_journal_mode': ('journal_mode', 'WAL'),
+    'db_synchronous': ('synchronous', 'NORMAL'),
+    'db_wal_autocheckpoint': ('wal_autocheckpoint', '1000'),
+}
+
+def configure_connection(con):
+    keys = list(CONNECTION_PRAGMAS)
+    settings = dict(con.execute(f"SELECT key, value FROM config WHERE key IN ({', '.join('?' for _ in keys)})", keys).fetchall())
+    for key, (pragma, default) in CONNECTION_PRAGMAS.items():
+        value = str(settings.get(key, default))
+        if not value.isalnum(): raise ValueError(f"Invalid value {value!r} for config setting '{key}'.")
+        con.execute(f"PRAGMA {pragma} = {value}")
+
+def open_connection(database, password, timeout=10):
+    """Opens and unlocks one SQLCipher connection. This pays the full key derivation cost."""
+    if not password: raise ValueError("A database password is required.")
+    try:
+        con = sqlite3.connect(database, timeout=timeout, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.execute(f"PRAGMA key = '{password}';")
+        con.execute("SELECT name FROM sqlite_master WHERE type='table' LIMIT 1;").fetchone()
+        configure_connection(con)
+        return con
+    except (sqlite3.Error, ValueError) as e:
+        raise ConnectionError(f"Failed to connect or unlock database '{database}'. Is the password correct? Error: {e}")
+
+class ConnectionPool:
+    """
+    A thread-safe pool of already-keyed SQLCipher connections, so each request pays for a query and
+    not for key derivation. The master password lives only in this object, in server memory.
+
+    At most `max_size` connections exist at once; `connection()` waits up to `acquire_timeout` seconds
+    for one to free up. Idle connections are closed after `idle_timeout` seconds, and every connection
+    is health-checked before it is handed out.
+    """
+    def __init__(self, database, password, max_size=8, idle_timeout=600, acquire_timeout=10, token=None):
+        self.database, self.max_size = database, max_size
+        self.idle_timeout, self.acquire_timeout = idle_timeout, acquire_timeout
+        # Identifies this unlock in browser sessions instead of the password; workers of one server share it.
+        self.token = token or secrets.token_hex(16)
+        self._password = password
+        self._idle = []  # (connection, returned_at), most recently returned last
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def password(self):
+        return self._password
+
+    def matches(self, password):
+        return bool(password) and hmac.compare_digest(password.encode(), self._password.encode())
+
+    def add(self, con):
+        """Hands an already-open connection (e.g. the one used to check the password at login) to the pool."""
+        if not self._slots.acquire(blocking=False):
+            con.close(); return
+        self.release(con)
+
+    def acquire(self):
+        if self._closed: raise ConnectionError("The database connection pool has been closed.")
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise ConnectionError(f"Timed out after {self.acquire_timeout}s waiting for a database connection.")
+        try:
+            while True:
+                with self._lock:
+                    self._close_expired()
+                    con = self._idle.pop()[0] if self._idle else None
+                if con is None: return open_connection(self.database, self._password)
+                if self._is_healthy(con): return con
+                self._close_quietly(con)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, con):
+        try:
+            if con.in_transaction: con.rollback()
+            # Connections go back as they were opened, so no idle connection keeps another file open
+            # (e.g. a sales archive that is about to be restored or replaced).
+            for row in con.execute("PRAGMA database_list").fetchall():
+                if row[1] not in ('main', 'temp'): con.execute(f"DETACH DATABASE {row[1]}")
+        except sqlite3.Error:
+            self._close_quietly(con); self._slots.release(); return
+        with self._lock:
+            if self._closed: self._close_quietly(con)
+            else: self._idle.append((con, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection; commits on success and rolls back on error, like `with sqlite3.connect(...)`."""
+        con = self.acquire()
+        try:
+            yield con
+            if con.in_transaction: con.commit()
+        except BaseException:
+            if con.in_transaction: con.rollback()
+            raise
+        finally:
+            self.release(con)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for con, _ in self._idle: self._close_quietly(con)
+            self._idle.clear()
+
+    def _close_expired(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        # The oldest entries are first; keep the most recently used connection warm.
+        while len(self._idle) > 1 and self._idle[0][1] < cutoff:
+            self._close_quietly(self._idle.pop(0)[0])
+
+    @staticmethod
+    def _is_healthy(con):
+        try:
+            con.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(con):
+        try: con.close()
+        except sqlite3.Error: pass
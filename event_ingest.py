@@ -0,0 +1,371 @@
+import io
+import os
+import sys
+import csv
+import json
+import math
+import time
+import zlib
+import hashlib
+import secrets
+import getpass
+import argparse
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+# Bulk ingestion of OPEvent readings from plant sources. A batch arrives as newline-delimited JSON or
+# CSV, is validated a column at a time with array operations, and all of its valid rows are inserted in one short transaction;
+# the rollup trigger from ops_events.py folds them into the dashboards as part of that transaction.
+# Each source authenticates with its own token, made with `python event_ingest.py add-source NAME`.
+
+DB_FILE = "operations_dashboard.db"
+MAX_BATCH_ROWS, MAX_BATCH_BYTES = 20000, 8 * 2**20
+# Batches processed at once per process, and seconds a batch waits for a slot before the source is
+# told to back off. SQLite has one writer, so more slots only add lock waits that dashboards would feel.
+MAX_CONCURRENT_BATCHES, SLOT_WAIT = 2, 2.0
+# Batch ids are remembered this long, so a source retrying a batch after a timeout does not insert it twice.
+BATCH_ID_RETENTION = timedelta(days=7)
+# Per-row errors returned in a response; the counts always cover every row.
+MAX_REPORTED_ERRORS = 100
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+INVALID = object()
+# SQLite stores integers as 64-bit; anything outside this range would fail the whole batch's INSERT.
+INT_MIN, INT_MAX = -2**63, 2**63 - 1
+
+def _to_int(value):
+    if isinstance(value, bool): return INVALID
+    if isinstance(value, float): number = int(value) if value.is_integer() else INVALID
+    elif isinstance(value, int): number = value
+    else:
+        try: number = int(str(value).strip())
+        except ValueError: return INVALID
+    return number if number is not INVALID and INT_MIN <= number <= INT_MAX else INVALID
+
+def _to_float(value):
+    if isinstance(value, bool): return INVALID
+    try: number = float(value)
+    except (TypeError, ValueError, OverflowError): return INVALID
+    return number if math.isfinite(number) else INVALID
+
+def _to_time(value):
+    """An ISO 8601 timestamp or Unix time, as local time in OPEvent's 'YYYY-MM-DD HH:MM:SS' format."""
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool): moment = datetime.fromtimestamp(value)
+        else:
+            text = str(value).strip()
+            moment = datetime.fromisoformat(text)
+            if len(text) == 19 and text[10] == ' ': return text
+        if moment.tzinfo: moment = moment.astimezone().replace(tzinfo=None)
+        return moment.strftime(TIME_FORMAT)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return INVALID
+
+def _to_text(value):
+    return value if isinstance(value, str) else INVALID if isinstance(value, (dict, list)) else str(value)
+
+# Array versions of the converters, applied to a whole column. Each converts the values it can decide at
+# the `todo` positions into `out`, flags the bad ones in `invalid` and returns the positions it decided.
+# The rest (bools, other timestamp formats, values a cast rejects) go through the converter above one by one.
+_EPOCH = datetime(1970, 1, 1)
+_DATE_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_MONTH_DAYS = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def _cast(values, dtype):
+    """
+    Casts an object array with int()/float() rules. Returns (numbers, cast mask); values the cast rejects
+    are found by halving the array, so one bad value does not send the whole column down the slow path.
+    """
+    try: return values.astype(dtype), np.ones(len(values), dtype=bool)
+    except (TypeError, ValueError, OverflowError):
+        if len(values) == 1: return np.zeros(1, dtype), np.zeros(1, dtype=bool)
+        (low, low_cast), (high, high_cast) = _cast(values[:len(values) // 2], dtype), _cast(values[len(values) // 2:], dtype)
+        return np.concatenate([low, high]), np.concatenate([low_cast, high_cast])
+
+def _codes(times):
+    """19-character strings as a (rows, 19) array of their code points, with anything past 255 clipped to 255."""
+    return np.minimum(np.ascontiguousarray(times, dtype='U19').view(np.uint32).reshape(-1, 19), 255).astype(np.uint8)
+
+def _time_text(codes):
+    codes[:, 10] = ord(' ')
+    return codes.astype(np.uint32).view('U19').ravel().tolist()
+
+def _ints_array(values, kinds, todo, out, invalid):
+    done = todo & False
+    floats = np.flatnonzero(todo & (kinds == float))
+    number = values[floats].astype(np.float64)
+    fits = np.isfinite(number) & (number == np.floor(number)) & (number >= INT_MIN) & (number < 2**63)
+    out[floats[fits]] = number[fits].astype(np.int64).tolist()
+    invalid[floats[~fits]] = True
+    done[floats] = True
+    # Ints and numeric text outside int64 fail the cast and are rejected by _to_int.
+    others = np.flatnonzero(todo & ((kinds == int) | (kinds == str)))
+    number, cast = _cast(values[others], np.int64)
+    out[others[cast]] = number[cast].tolist()
+    done[others[cast]] = True
+    return done
+
+def _floats_array(values, kinds, todo, out, invalid):
+    done = todo & False
+    candidates = np.flatnonzero(todo & ((kinds == int) | (kinds == float) | (kinds == str)))
+    number, cast = _cast(values[candidates], np.float64)
+    finite = np.isfinite(number)
+    out[candidates[cast & finite]] = number[cast & finite].tolist()
+    invalid[candidates[cast & ~finite]] = True
+    done[candidates[cast]] = True
+    return done
+
+def _utc_offset(moment):
+    return int((datetime.fromtimestamp(moment) - _EPOCH).total_seconds()) - moment
+
+def _times_array(values, kinds, todo, out, invalid):
+    done = todo & False
+    # 'YYYY-MM-DD HH:MM:SS' and 'YYYY-MM-DDTHH:MM:SS' text, checked digit by digit against the calendar.
+    texts = np.flatnonzero(todo & (kinds == str))
+    texts = texts[np.fromiter(map(len, values[texts]), dtype=np.int64, count=len(texts)) == 19]
+    codes = _codes(values[texts])
+    digits = codes[:, _DATE_DIGITS] - ord('0')  # wraps around, so anything but a digit is above 9
+    laid_out = ((digits <= 9).all(1) & (codes[:, 4] == ord('-')) & (codes[:, 7] == ord('-')) & (codes[:, 13] == ord(':'))
+                & (codes[:, 16] == ord(':')) & ((codes[:, 10] == ord('T')) | (codes[:, 10] == ord(' '))))
+    digits = digits.astype(np.int32)
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month, day, hour, minute, second = (digits[:, 4::2] * 10 + digits[:, 5::2]).T
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = _MONTH_DAYS[np.clip(month, 0, 12)] + ((month == 2) & leap)
+    valid = laid_out & (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days) & (hour < 24) & (minute < 60) & (second < 60)
+    spaced = codes[:, 10] == ord(' ')
+    out[texts[valid & spaced]] = values[texts[valid & spaced]]
+    out[texts[valid & ~spaced]] = _time_text(codes[valid & ~spaced])
+    invalid[texts[laid_out & ~valid]] = True
+    done[texts[laid_out]] = True
+    # Unix times, shifted to local time by the UTC offset of their hour. An hour whose offset changes part way
+    # through, and fractions that fromtimestamp would round up to the next second, are left to _to_time.
+    numbers = np.flatnonzero(todo & ((kinds == int) | (kinds == float)))
+    seconds, cast = _cast(values[numbers], np.float64)
+    whole = np.floor(seconds)
+    with np.errstate(invalid='ignore'): usable = cast & (seconds - whole < 0.999999) & (whole >= 0) & (whole < 2**32)
+    numbers, whole = numbers[usable], whole[usable].astype(np.int64)
+    hours, hour_of = np.unique(whole // 3600, return_inverse=True)
+    offsets = np.array([(_utc_offset(hour * 3600), _utc_offset(hour * 3600 + 3599)) for hour in hours.tolist()], dtype=np.int64).reshape(-1, 2)
+    steady = (offsets[:, 0] == offsets[:, 1])[hour_of]
+    local = (whole + offsets[hour_of, 0])[steady].astype('datetime64[s]')
+    out[numbers[steady]] = _time_text(_codes(np.datetime_as_string(local, unit='s')))
+    done[numbers[steady]] = True
+    return done
+
+def _texts_array(values, kinds, todo, out, invalid):
+    done = todo & (kinds == str)
+    out[done] = values[done]
+    return done
+
+ARRAY_CONVERTERS = {_to_int: _ints_array, _to_float: _floats_array, _to_time: _times_array, _to_text: _texts_array}
+
+def convert_column(raw, convert):
+    """Converts one column of raw values. Returns (values, invalid mask, missing mask) as NumPy arrays."""
+    values = np.fromiter(raw, dtype=object, count=len(raw))
+    kinds = np.fromiter(map(type, raw), dtype=object, count=len(raw))
+    out, invalid, missing = np.full(len(raw), None, dtype=object), np.zeros(len(raw), dtype=bool), kinds == type(None)
+    todo = ~missing & ~ARRAY_CONVERTERS[convert](values, kinds, ~missing, out, invalid)
+    for i in np.flatnonzero(todo):
+        value = convert(values[i])
+        if value is INVALID: invalid[i] = True
+        else: out[i] = value
+    return out, invalid, missing
+
+# OPEvent column -> (converter, required). Rows are inserted in this column order.
+FIELDS = {
+    'OPEventItemID': (_to_int, False),
+    'OpEventItemOperationID': (_to_int, True),
+    'OPEventTime': (_to_time, True),
+    'OpEventNumber': (_to_float, True),
+    'OPEventDesc': (_to_text, False),
+    'OPEventCodeID': (_to_int, True),
+    'OpEventPlantUpTime': (_to_text, False),
+    'EmployeeID': (_to_int, False),
+}
+# Field names are matched case-insensitively; these shorter names are accepted too.
+ALIASES = {name.lower(): name for name in FIELDS}
+ALIASES.update({'item_id': 'OPEventItemID', 'operation_id': 'OpEventItemOperationID', 'time': 'OPEventTime', 'value': 'OpEventNumber',
+                'desc': 'OPEventDesc', 'code_id': 'OPEventCodeID', 'plant_uptime': 'OpEventPlantUpTime', 'employee_id': 'EmployeeID'})
+INSERT_SQL = f"INSERT INTO OPEvent ({', '.join(FIELDS)}) VALUES ({', '.join('?' for _ in FIELDS)})"
+
+class BatchError(ValueError):
+    """The batch as a whole cannot be accepted; `status` is the HTTP status to answer with."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT_BATCHES)
+_last_cleanup = 0.0
+
+@contextmanager
+def batch_slot(timeout=SLOT_WAIT):
+    """Yields True if a slot was free within `timeout` seconds, False if the source should retry later."""
+    acquired = _slots.acquire(timeout=timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired: _slots.release()
+
+def decode_body(body, content_encoding=None):
+    if content_encoding == 'gzip':
+        inflater = zlib.decompressobj(wbits=31)
+        body = inflater.decompress(body, MAX_BATCH_BYTES + 1)
+        if inflater.unconsumed_tail: raise BatchError(f"Batch is larger than {MAX_BATCH_BYTES} bytes uncompressed.", 413)
+    elif content_encoding not in (None, '', 'identity'): raise BatchError(f"Unsupported Content-Encoding '{content_encoding}'.", 415)
+    if len(body) > MAX_BATCH_BYTES: raise BatchError(f"Batch is larger than {MAX_BATCH_BYTES} bytes.", 413)
+    try: return body.decode('utf-8-sig')
+    except UnicodeDecodeError as e: raise BatchError(f"Batch is not valid UTF-8: {e}")
+
+def parse_batch(text, content_type):
+    """
+    Splits a batch into records. Returns (records, errors): records are (line number, {OPEvent column: raw
+    value}) and errors are (line number, message) for lines that could not be read at all.
+    """
+    records, errors = [], []
+    if 'csv' in (content_type or ''):
+        reader = csv.DictReader(io.StringIO(text))
+        columns = {field: ALIASES.get(field.strip().lower()) for field in reader.fieldnames or ()}
+        if not any(columns.values()): raise BatchError("The CSV header has no OPEvent columns.")
+        for raw in reader:
+            records.append((reader.line_num, {columns[k]: v for k, v in raw.items() if columns.get(k) and v not in (None, '')}))
+    else:
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip(): continue
+            try: raw = json.loads(line)
+            except ValueError as e: errors.append((line_no, f"Invalid JSON: {e}")); continue
+            if not isinstance(raw, dict): errors.append((line_no, "Expected a JSON object.")); continue
+            records.append((line_no, {ALIASES[k.lower()]: v for k, v in raw.items() if k.lower() in ALIASES and v is not None}))
+    if len(records) + len(errors) > MAX_BATCH_ROWS: raise BatchError(f"Batch has more than {MAX_BATCH_ROWS} rows; split it.", 413)
+    return records, errors
+
+def validate_batch(records):
+    """
+    Converts and checks the records a column at a time with array operations. Returns (rows ready for
+    INSERT_SQL, errors), where errors are (line number, message) for the first problem of each rejected record.
+    """
+    columns, problems, rejected = [], {}, np.zeros(len(records), dtype=bool)
+    for name, (convert, required) in FIELDS.items():
+        raw = [fields.get(name) for _, fields in records]
+        values, invalid, missing = convert_column(raw, convert)
+        for i in np.flatnonzero(invalid & ~rejected).tolist(): problems[i] = f"Invalid {name}: {raw[i]!r}"
+        if required:
+            for i in np.flatnonzero(missing & ~rejected).tolist(): problems[i] = f"Missing {name}"
+            rejected |= missing
+        rejected |= invalid
+        columns.append(values)
+    kept = np.flatnonzero(~rejected)
+    rows = list(zip(*(values[kept].tolist() for values in columns)))
+    return rows, sorted((records[i][0], message) for i, message in problems.items())
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def get_source(con, token):
+    """The name of the source a token belongs to, or None."""
+    if not token: return None
+    row = con.execute("SELECT name FROM ops_ingest_source WHERE token_hash = ?", (hash_token(token),)).fetchone()
+    return row['name'] if row else None
+
+def add_source(con, name):
+    """Registers a source and returns its new token, which is shown once and only stored hashed."""
+    token = secrets.token_urlsafe(32)
+    con.execute("INSERT INTO ops_ingest_source (name, token_hash, created_at) VALUES (?, ?, ?)",
+                (name, hash_token(token), datetime.now().strftime(TIME_FORMAT)))
+    return token
+
+def insert_events(con, rows, source, batch_id=None, rejected=0):
+    """
+    Inserts one batch's rows in a single transaction. Returns False without inserting if the source
+    already delivered a batch with this id.
+    """
+    global _last_cleanup
+    now = datetime.now()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        if batch_id and con.execute("SELECT 1 FROM ops_ingest_batch WHERE source = ? AND batch_id = ?", (source, batch_id)).fetchone():
+            con.rollback()
+            return False
+        con.executemany(INSERT_SQL, rows)
+        if batch_id:
+            con.execute("INSERT INTO ops_ingest_batch (source, batch_id, received_at, accepted, rejected) VALUES (?, ?, ?, ?, ?)",
+                        (source, batch_id, now.strftime(TIME_FORMAT), len(rows), rejected))
+        if time.monotonic() - _last_cleanup > 3600:
+            con.execute("DELETE FROM ops_ingest_batch WHERE received_at < ?", ((now - BATCH_ID_RETENTION).strftime(TIME_FORMAT),))
+            _last_cleanup = time.monotonic()
+        con.execute("UPDATE ops_ingest_source SET last_batch_at = ?, events_total = events_total + ? WHERE name = ?",
+                    (now.strftime(TIME_FORMAT), len(rows), source))
+        con.commit()
+    except (sqlite3.IntegrityError, OverflowError, ValueError, TypeError) as e:
+        con.rollback()
+        raise BatchError(f"Batch could not be stored: {e}", 422)
+    except Exception:
+        con.rollback()
+        raise
+    return True
+
+def ingest_batch(con, body, content_type, source, batch_id=None, content_encoding=None):
+    """Parses, validates and stores one batch. Returns the response summary for the source."""
+    records, errors = parse_batch(decode_body(body, content_encoding), content_type)
+    rows, invalid = validate_batch(records)
+    errors = sorted(errors + invalid)
+    stored = insert_events(con, rows, source, batch_id, rejected=len(errors))
+    result = {'accepted': len(rows) if stored else 0, 'rejected': len(errors), 'duplicate': not stored,
+              'errors': [{'line': line, 'error': message} for line, message in errors[:MAX_REPORTED_ERRORS]]}
+    if batch_id: result['batch_id'] = batch_id
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the plant sources allowed to send OPEvent batches.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="List sources and how many events each has sent.")
+    add = commands.add_parser('add-source', help="Register a source and print its token.")
+    add.add_argument('name')
+    rotate = commands.add_parser('rotate-token', help="Replace a source's token.")
+    rotate.add_argument('name')
+    remove = commands.add_parser('remove-source', help="Revoke a source.")
+    remove.add_argument('name')
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_FILE): sys.exit(f"FATAL: Database file '{DB_FILE}' not found. Please run init_db.py first.")
+    password = os.environ.get('DB_MASTER_PASSWORD') or getpass.getpass("Please enter the database master password: ")
+    con = sqlite3.connect(DB_FILE)
+    con.row_factory = sqlite3.Row
+    try:
+        con.execute(f"PRAGMA key = '{password}';")
+        from migrations import apply_migrations
+        apply_migrations(con)
+        if args.command == 'list':
+            for source in con.execute("SELECT * FROM ops_ingest_source ORDER BY name"):
+                print(f"{source['name']}: {source['events_total']} events, last batch {source['last_batch_at'] or 'never'}")
+        elif args.command == 'add-source':
+            token = add_source(con, args.name)
+            con.commit()
+            print(f"SUCCESS: Added source '{args.name}'. Its token is shown only once:\n{token}")
+        elif args.command == 'rotate-token':
+            token = secrets.token_urlsafe(32)
+            if not con.execute("UPDATE ops_ingest_source SET token_hash = ? WHERE name = ?", (hash_token(token), args.name)).rowcount:
+                sys.exit(f"FATAL: No source '{args.name}'.")
+            con.commit()
+            print(f"SUCCESS: New token for '{args.name}'; the old one no longer works:\n{token}")
+        elif args.command == 'remove-source':
+            removed = con.execute("DELETE FROM ops_ingest_source WHERE name = ?", (args.name,)).rowcount
+            con.commit()
+            print(f"SUCCESS: Removed source '{args.name}'." if removed else f"ERROR: No source '{args.name}'.")
+    except sqlite3.IntegrityError:
+        sys.exit(f"FATAL: A source named '{args.name}' already exists.")
+    except sqlite3.Error as e:
+        sys.exit(f"FATAL: {e}")
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
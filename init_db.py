@@ -9,9 +9,77 @@ except ImportError:
     print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
     sys.exit(1)
 
+from migrations import apply_migrations
 
 DB_FILE = "operations_dashboard.db"
 
+def create_schema(cur):
+    """Creates the initial (schema version 0) tables; migrations.py upgrades them from there."""
+    cur.execute("CREATE TABLE config (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    cur.execute("""
+        CREATE TABLE credentials (
+            system TEXT PRIMARY KEY, server TEXT, database TEXT, username TEXT, password TEXT
+        )
+    """)
+    cur.execute("CREATE TABLE Customer (CustomerNo TEXT PRIMARY KEY, CustomerName TEXT)")
+    cur.execute("""
+        CREATE TABLE SalesOrderHeader (
+            SalesOrderNo TEXT PRIMARY KEY, OrderDate TEXT, OrderStatus TEXT, CustomerNo TEXT,
+            CustomerPONo TEXT, ShipToName TEXT, ShipToAddress1 TEXT, ShipToCity TEXT,
+            ShipToState TEXT, ShipToZipCode TEXT, ShipVia TEXT,
+            BillToName TEXT, BillToAddress1 TEXT, BillToCity TEXT, BillToState TEXT, BillToZipCode TEXT,
+            FOREIGN KEY (CustomerNo) REFERENCES Customer (CustomerNo)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE SalesOrderDetail (
+            SalesOrderNo TEXT, LineKey TEXT, ItemCode TEXT, ItemCodeDesc TEXT,
+            QuantityOrdered REAL, QuantityShipped REAL, UnitPrice REAL, ExtensionAmt REAL, CommentText TEXT,
+            PRIMARY KEY (SalesOrderNo, LineKey),
+            FOREIGN KEY (SalesOrderNo) REFERENCES SalesOrderHeader (SalesOrderNo)
+        )
+    """)
+    # New table to store item master details
+    cur.execute("""
+        CREATE TABLE CI_Item (
+            ItemCode TEXT PRIMARY KEY, ProductLine TEXT, ProductType TEXT,
+            SalesUnitOfMeasure TEXT, PurchaseUnitOfMeasure TEXT,
+            StandardUnitPrice REAL, CommentText TEXT
+        )
+    """)
+    cur.execute("CREATE TABLE Sample (SampleID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT UNIQUE NOT NULL)")
+    cur.execute("""
+        CREATE TABLE SieveTest (
+            SieveTestID INTEGER PRIMARY KEY AUTOINCREMENT, SieveTestDate TEXT NOT NULL,
+            CarorTruckNumber TEXT, BillofLading TEXT, SampleID INTEGER,
+            InternalTest INTEGER DEFAULT 0, Selected4Avg INTEGER DEFAULT 1, StoredAFS REAL,
+            FOREIGN KEY (SampleID) REFERENCES Sample (SampleID)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE SieveTestDetail (
+            SieveTestID INTEGER, USSieve INTEGER, Weight REAL, SpecLow REAL, SpecHigh REAL,
+            PRIMARY KEY (SieveTestID, USSieve),
+            FOREIGN KEY (SieveTestID) REFERENCES SieveTest (SieveTestID)
+        )
+    """)
+    cur.execute("CREATE TABLE SieveDefaults (USSieve INTEGER PRIMARY KEY NOT NULL)")
+    cur.execute("""
+        CREATE TABLE OPEvent (
+            OpEventID INTEGER PRIMARY KEY AUTOINCREMENT, OPEventItemID INTEGER,
+            OpEventItemOperationID INTEGER NOT NULL, OPEventTime TEXT NOT NULL,
+            OpEventNumber REAL NOT NULL, OPEventDesc TEXT, OPEventCodeID INTEGER NOT NULL,
+            OpEventPlantUpTime TEXT, EmployeeID INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE scheduler_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, job_name TEXT NOT NULL UNIQUE, script_path TEXT NOT NULL,
+            interval_minutes INTEGER NOT NULL, enabled BOOLEAN NOT NULL CHECK (enabled IN (0, 1)),
+            last_run TEXT, last_status TEXT, last_run_log TEXT
+        )
+    """)
+
 def create_database():
     """
     Initializes a new encrypted SQLite database for the Operations Dashboard.
@@ -50,71 +118,7 @@ def create_database():
         cur.execute("PRAGMA foreign_keys = ON;")
 
         print("\nCreating database schema...")
-
-        cur.execute("CREATE TABLE config (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
-        cur.execute("""
-            CREATE TABLE credentials (
-                system TEXT PRIMARY KEY, server TEXT, database TEXT, username TEXT, password TEXT
-            )
-        """)
-        cur.execute("CREATE TABLE Customer (CustomerNo TEXT PRIMARY KEY, CustomerName TEXT)")
-        cur.execute("""
-            CREATE TABLE SalesOrderHeader (
-                SalesOrderNo TEXT PRIMARY KEY, OrderDate TEXT, OrderStatus TEXT, CustomerNo TEXT,
-                CustomerPONo TEXT, ShipToName TEXT, ShipToAddress1 TEXT, ShipToCity TEXT,
-                ShipToState TEXT, ShipToZipCode TEXT, ShipVia TEXT,
-                BillToName TEXT, BillToAddress1 TEXT, BillToCity TEXT, BillToState TEXT, BillToZipCode TEXT,
-                FOREIGN KEY (CustomerNo) REFERENCES Customer (CustomerNo)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE SalesOrderDetail (
-                SalesOrderNo TEXT, LineKey TEXT, ItemCode TEXT, ItemCodeDesc TEXT,
-                QuantityOrdered REAL, QuantityShipped REAL, UnitPrice REAL, ExtensionAmt REAL, CommentText TEXT,
-                PRIMARY KEY (SalesOrderNo, LineKey),
-                FOREIGN KEY (SalesOrderNo) REFERENCES SalesOrderHeader (SalesOrderNo)
-            )
-        """)
-        # New table to store item master details
-        cur.execute("""
-            CREATE TABLE CI_Item (
-                ItemCode TEXT PRIMARY KEY, ProductLine TEXT, ProductType TEXT,
-                SalesUnitOfMeasure TEXT, PurchaseUnitOfMeasure TEXT,
-                StandardUnitPrice REAL, CommentText TEXT
-            )
-        """)
-        cur.execute("CREATE TABLE Sample (SampleID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT UNIQUE NOT NULL)")
-        cur.execute("""
-            CREATE TABLE SieveTest (
-                SieveTestID INTEGER PRIMARY KEY AUTOINCREMENT, SieveTestDate TEXT NOT NULL,
-                CarorTruckNumber TEXT, BillofLading TEXT, SampleID INTEGER,
-                InternalTest INTEGER DEFAULT 0, Selected4Avg INTEGER DEFAULT 1, StoredAFS REAL,
-                FOREIGN KEY (SampleID) REFERENCES Sample (SampleID)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE SieveTestDetail (
-                SieveTestID INTEGER, USSieve INTEGER, Weight REAL, SpecLow REAL, SpecHigh REAL,
-                PRIMARY KEY (SieveTestID, USSieve),
-                FOREIGN KEY (SieveTestID) REFERENCES SieveTest (SieveTestID)
-            )
-        """)
-        cur.execute("CREATE TABLE SieveDefaults (USSieve INTEGER PRIMARY KEY NOT NULL)")
-        cur.execute("""
-            CREATE TABLE OPEvent (
-                OpEventID INTEGER PRIMARY KEY AUTOINCREMENT, OPEventItemID INTEGER,
-                OpEventItemOperationID INTEGER NOT NULL, OPEventTime TEXT NOT NULL,
-                OpEventNumber REAL NOT NULL, OPEventDesc TEXT, OPEventCodeID INTEGER NOT NULL,
-                OpEventPlantUpTime TEXT, EmployeeID INTEGER
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE scheduler_jobs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, job_name TEXT NOT NULL UNIQUE, script_path TEXT NOT NULL,
-                interval_minutes INTEGER NOT NULL, enabled BOOLEAN NOT NULL CHECK (enabled IN (0, 1)),
-                last_run TEXT, last_status TEXT, last_run_log TEXT
-            )
-        """)
+        create_schema(cur)
 
         print("Storing configuration in the encrypted database...")
         cur.execute("INSERT INTO config (key, value) VALUES (?, ?)", ("sage_dsn", sage_dsn))
@@ -129,6 +133,8 @@ def create_database():
         )
 
         con.commit()
+        # New databases start at the latest schema version, indexes included.
+        apply_migrations(con)
         print(f"\n✅ Success! Encrypted database '{DB_FILE}' created and configured.")
 
     except sqlite3.Error as e:
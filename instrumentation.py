@@ -0,0 +1,207 @@
+import os
+import re
+import sys
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Phase timings of the request being handled in the current context ({phase: seconds}), or None outside
+# a request. main.py sets it per request and turns it into a Server-Timing header.
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+class Metrics:
+    """
+    A thread-safe registry of counters and histograms, rendered in the Prometheus text format. Metrics
+    are declared once with `counter` or `histogram`; `gauge` registers a callback read at render time.
+    Values are kept per process. With `share`, every worker publishes them to a WorkerSlots (workers.py)
+    and render adds up all workers, so a scrape answered by any worker sees the whole server.
+    """
+    def __init__(self):
+        self._types, self._values, self._gauges = {}, {}, {}
+        self._lock = threading.Lock()
+        self._shared = None
+
+    def share(self, slots):
+        self._shared = slots
+        # A forked worker starts from zero; the values it inherited stay counted in its parent.
+        if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._values, self._lock = {}, threading.Lock()
+
+    def counter(self, name, help_text):
+        self._types[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._types[name] = ('histogram', help_text, buckets)
+
+    def gauge(self, name, help_text, fn):
+        self._types[name] = ('gauge', help_text, None)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._types[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            # [count per bucket..., +Inf count, sum]
+            sample = self._values.setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound: sample[i] += 1
+            sample[-2] += 1
+            sample[-1] += value
+
+    def snapshot(self):
+        """This process's values and gauge readings, as JSON-compatible data."""
+        with self._lock: values = [[name, labels, list(value) if isinstance(value, list) else value] for (name, labels), value in self._values.items()]
+        return {'values': values, 'gauges': {name: fn() for name, fn in self._gauges.items()}}
+
+    def publish(self, own=None):
+        """Shares this process's current values with the other workers, if shared."""
+        if self._shared is None: return
+        try: self._shared.publish(own or self.snapshot())
+        except ValueError as e: print(f"WARNING: Could not share this worker's metrics: {e}", file=sys.stderr)
+
+    def _merged(self):
+        own = self.snapshot()
+        if self._shared is None: return {(name, tuple(labels)): value for name, labels, value in own['values']}, own['gauges']
+        self.publish(own)
+        values, gauges = {}, {}
+        for data in [own] + self._shared.read_others():
+            for name, labels, value in data['values']:
+                key = (name, tuple(tuple(label) for label in labels))
+                if isinstance(value, list): values[key] = [a + b for a, b in zip(values.get(key, [0] * len(value)), value)]
+                else: values[key] = values.get(key, 0) + value
+            for name, value in data['gauges'].items(): gauges[name] = gauges.get(name, 0) + value
+        return values, gauges
+
+    def render(self):
+        values, gauges = self._merged()
+        lines = []
+        for name, (kind, help_text, buckets) in self._types.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == 'gauge':
+                lines.append(f"{name} {gauges.get(name, 0)}")
+                continue
+            for (sample_name, labels), value in sorted(values.items()):
+                if sample_name != name: continue
+                if kind == 'counter':
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {count}")
+                lines += [f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {value[-2]}",
+                          f"{name}_count{_labels(labels)} {value[-2]}", f"{name}_sum{_labels(labels)} {value[-1]}"]
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels: return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+metrics.histogram('phase_seconds', "Time spent in a request phase (connect, acquire, render).")
+metrics.histogram('sql_statement_seconds', "Time to execute an SQL statement, by statement kind and table.")
+metrics.counter('sql_fetch_seconds_total', "Time spent fetching SQL result rows, by statement kind and table.")
+metrics.counter('sql_rows_total', "SQL result rows fetched, by statement kind and table.")
+metrics.histogram('http_request_seconds', "Time to handle an HTTP request, by endpoint, method and status.")
+metrics.counter('sync_phase_seconds_total', "Time pull_sage.py spent per table in its fetch, convert and write phases.")
+metrics.counter('ops_ingest_rows_total', "OPEvent rows received from plant sources, by source and outcome (accepted, rejected).")
+metrics.counter('ops_ingest_batches_total', "OPEvent batches received, by source and outcome (stored, duplicate, busy, invalid).")
+
+def add_request_timing(phase, seconds):
+    timings = request_timings.get()
+    if timings is not None: timings[phase] = timings.get(phase, 0) + seconds
+
+@contextmanager
+def timed(phase):
+    """Times a block as one request phase, both in /metrics and in the current request's Server-Timing."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('phase_seconds', elapsed, phase=phase)
+        add_request_timing(phase, elapsed)
+
+VERB_RE = re.compile(r"\s*(\w+)")
+TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)", re.IGNORECASE)
+
+def statement_label(sql):
+    """A low-cardinality name for a statement: its verb and first table, e.g. 'SELECT SalesOrderHeader'."""
+    verb, table = VERB_RE.match(sql), TABLE_RE.search(sql)
+    if not verb: return "OTHER"
+    return f"{verb.group(1).upper()} {table.group(1)}" if table else verb.group(1).upper()
+
+class InstrumentedCursor:
+    """Wraps a DB-API cursor, timing statements and fetches and counting rows."""
+    def __init__(self, cursor):
+        self._cursor, self._label = cursor, "OTHER"
+
+    def _execute(self, method, sql, params):
+        self._label = statement_label(sql)
+        start = time.perf_counter()
+        try:
+            method(sql, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('sql_statement_seconds', elapsed, statement=self._label)
+            add_request_timing('sql', elapsed)
+        return self
+
+    def execute(self, sql, params=()):
+        return self._execute(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._execute(self._cursor.executemany, sql, seq_of_params)
+
+    def _fetch(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        elapsed = time.perf_counter() - start
+        rows = (0 if result is None else 1) if method == self._cursor.fetchone else len(result)
+        metrics.inc('sql_fetch_seconds_total', elapsed, statement=self._label)
+        metrics.inc('sql_rows_total', rows, statement=self._label)
+        add_request_timing('sql', elapsed)
+        return result
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(self._cursor.fetchmany, size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(256)
+            if not rows: return
+            yield from rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class InstrumentedConnection:
+    """Wraps a DB-API connection so every statement run through it is timed. Anything else passes through."""
+    def __init__(self, con):
+        self._con = con
+
+    def cursor(self):
+        return InstrumentedCursor(self._con.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
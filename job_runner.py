@@ -0,0 +1,223 @@
+import os
+import sys
+import threading
+import subprocess
+import contextvars
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# The log buffer of the job running in the current context. Jobs that start their own threads copy
+# their context into them (contextvars.copy_context().run) so those threads log to the job as well.
+current_job_log = contextvars.ContextVar('current_job_log', default=None)
+
+class JobLog:
+    """
+    A run's output, bounded in memory: the first `head_bytes` and the last `tail_bytes` are kept and anything
+    in between is dropped. Positions are byte offsets into everything written, so a reader can follow the
+    log with `read_from` and is told when it fell behind what is kept. `on_line(line)` sees every complete
+    line, including the dropped ones.
+    """
+    def __init__(self, head_bytes=256 * 1024, tail_bytes=768 * 1024, on_line=None):
+        self.head_bytes, self.tail_bytes, self.on_line = head_bytes, tail_bytes, on_line
+        self._head, self._tail = bytearray(), bytearray()
+        self._total = 0
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        data = text.encode('utf-8', errors='replace')
+        with self._lock:
+            room = max(self.head_bytes - len(self._head), 0)
+            self._head += data[:room]
+            self._tail += data[room:]
+            if len(self._tail) > self.tail_bytes: del self._tail[:len(self._tail) - self.tail_bytes]
+            self._total += len(data)
+            if self.on_line:
+                lines = (self._partial + text).split("\n")
+                self._partial = lines.pop()
+        if self.on_line:
+            for line in lines: self.on_line(line)
+
+    @property
+    def size(self):
+        """Bytes written so far."""
+        with self._lock: return self._total
+
+    def parts(self):
+        """(head, tail, total): the kept bytes, and how many were written. Bytes were dropped if head + tail is shorter than total."""
+        with self._lock: return bytes(self._head), bytes(self._tail), self._total
+
+    def read_from(self, offset):
+        """(start, data): the kept bytes from `offset` on. `start` is later than `offset` if the bytes at `offset` were dropped."""
+        with self._lock: return read_kept(self._head, self._tail, self._total, offset)
+
+    def getvalue(self):
+        head, tail, total = self.parts()
+        return join_log(head, tail, total).decode('utf-8', errors='replace')
+
+def read_kept(head, tail, total, offset):
+    """read_from() over a bounded log's parts; for a log taken out of storage as well as a live one."""
+    tail_start = total - len(tail)
+    if offset < len(head):
+        if tail_start > len(head): return offset, bytes(head[offset:])  # The tail follows after a gap.
+        return offset, bytes(head[offset:]) + bytes(tail)
+    start = max(offset, tail_start)
+    return start, bytes(tail[start - tail_start:])
+
+def join_log(head, tail, total):
+    """A bounded log as one text: head, a note of how much was dropped if anything was, and tail."""
+    gap = total - len(head) - len(tail)
+    return head + (f"\n[... {gap:,} bytes of output omitted ...]\n".encode() if gap > 0 else b"") + tail
+
+class _StreamRouter:
+    """Stands in for sys.stdout/sys.stderr: output from inside a job goes to its log, everything else passes through."""
+    def __init__(self, stream, prefix=""):
+        self._stream, self._prefix = stream, prefix
+
+    def write(self, text):
+        log = current_job_log.get()
+        if log is None: return self._stream.write(text)
+        log.write(self._prefix + text if self._prefix and text.strip() else text)
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def install_stream_router():
+    if not isinstance(sys.stdout, _StreamRouter): sys.stdout = _StreamRouter(sys.stdout)
+    if not isinstance(sys.stderr, _StreamRouter): sys.stderr = _StreamRouter(sys.stderr, prefix="STDERR: ")
+
+class JobContext:
+    """What a registered job function receives: its cancellation flag and anything the caller passed along."""
+    def __init__(self, job_id, cancel_event, **kwargs):
+        self.job_id, self.cancel_event = job_id, cancel_event
+        self.__dict__.update(kwargs)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+class JobRunner:
+    """
+    Runs scheduler jobs on a bounded pool of worker threads. Jobs registered with `register` run in
+    this process and must check `context.cancelled` to stop early; any other script, or any job
+    submitted with subprocess=True, runs as a child Python process that is killed on cancel or timeout.
+
+    A job id that is still running is never started a second time. `on_start(job_id)`, if given, is
+    called from the worker thread when a run starts, and `on_finish(job_id, status, log)` when it ends,
+    with status Success, Failure, Cancelled or Timed out and the run's JobLog. While a job runs, its
+    output can be followed with `live_log(job_id)`; `on_log_line(job_id, line)` sees each line of it.
+    """
+    def __init__(self, on_finish, max_workers=2, timeout=1800, on_start=None, on_log_line=None, log_head_bytes=256 * 1024, log_tail_bytes=768 * 1024):
+        self.on_start, self.on_finish, self.on_log_line, self.timeout = on_start, on_finish, on_log_line, timeout
+        self.log_head_bytes, self.log_tail_bytes = log_head_bytes, log_tail_bytes
+        self._registry = {}
+        self._running = {}  # job_id -> cancel event
+        self._logs = {}  # job_id -> JobLog of the current run
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        install_stream_router()
+
+    def register(self, script_path, fn):
+        self._registry[script_path] = fn
+
+    def is_registered(self, script_path):
+        return script_path in self._registry
+
+    def running_ids(self):
+        with self._lock: return set(self._running)
+
+    def live_log(self, job_id):
+        with self._lock: return self._logs.get(job_id)
+
+    def submit(self, job_id, script_path, subprocess_mode=False, env=None, **context):
+        """Queues a run. Returns False, without queuing anything, if this job is already queued or running."""
+        with self._lock:
+            if job_id in self._running: return False
+            cancel_event = self._running[job_id] = threading.Event()
+        in_process = not subprocess_mode and script_path in self._registry
+        run = self._run_in_process if in_process else self._run_subprocess
+        try:
+            self._pool.submit(self._run, run, job_id, script_path, cancel_event, env, context)
+        except RuntimeError:
+            with self._lock: del self._running[job_id]
+            raise
+        return True
+
+    def cancel(self, job_id):
+        with self._lock: cancel_event = self._running.get(job_id)
+        if cancel_event is None: return False
+        cancel_event.set()
+        return True
+
+    def shutdown(self):
+        for job_id in self.running_ids(): self.cancel(job_id)
+        self._pool.shutdown(wait=False)
+
+    def _run(self, run, job_id, script_path, cancel_event, env, context):
+        print(f"[{datetime.now()}] SCHEDULER: Running job '{job_id}': {script_path}")
+        timed_out = threading.Event()
+        def expire():
+            timed_out.set(); cancel_event.set()
+        timer = threading.Timer(self.timeout, expire)
+        timer.daemon = True
+        timer.start()
+        status = "Failure"
+        on_line = (lambda line: self.on_log_line(job_id, line)) if self.on_log_line else None
+        log = JobLog(self.log_head_bytes, self.log_tail_bytes, on_line=on_line)
+        try:
+            if self.on_start: self.on_start(job_id)
+            with self._lock: self._logs[job_id] = log
+            ok = run(job_id, script_path, cancel_event, env, context, log)
+            if timed_out.is_set(): status = "Timed out"
+            elif cancel_event.is_set(): status = "Cancelled"
+            elif ok: status = "Success"
+        except Exception as e:
+            log.write(f"\nScheduler failed to run job: {e}\n")
+        finally:
+            timer.cancel()
+            with self._lock:
+                self._running.pop(job_id, None)
+                self._logs.pop(job_id, None)
+            print(f"[{datetime.now()}] SCHEDULER: Finished job '{job_id}' with status: {status}")
+            try: self.on_finish(job_id, status, log)
+            except Exception as e: print(f"[{datetime.now()}] SCHEDULER: Failed to record job result: {e}", file=sys.stderr)
+
+    def _run_in_process(self, job_id, script_path, cancel_event, env, context, log):
+        token = current_job_log.set(log)
+        try:
+            ok = self._registry[script_path](JobContext(job_id, cancel_event, **context))
+        except SystemExit as e:
+            # Scripts report fatal errors with sys.exit(); that must end the job, not the server.
+            if e.code not in (None, 0): print(e.code if isinstance(e.code, str) else f"Exited with status {e.code}")
+            ok = e.code in (None, 0)
+        except Exception as e:
+            print(f"FATAL: Unhandled error: {e!r}")
+            ok = False
+        finally:
+            current_job_log.reset(token)
+        return bool(ok)
+
+    def _run_subprocess(self, job_id, script_path, cancel_event, env, context, log):
+        proc = subprocess.Popen([sys.executable, script_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, encoding='utf-8', errors='replace', env={**os.environ, **(env or {})})
+        # Both pipes are read line by line as the child writes, into the same log as an in-process run.
+        readers = [threading.Thread(target=self._copy_lines, args=(stream, log, prefix), daemon=True)
+                   for stream, prefix in ((proc.stdout, ""), (proc.stderr, "STDERR: "))]
+        for reader in readers: reader.start()
+        while True:
+            try:
+                proc.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event.is_set(): proc.kill()
+        for reader in readers: reader.join()
+        return proc.returncode == 0
+
+    @staticmethod
+    def _copy_lines(stream, log, prefix):
+        for line in stream: log.write(prefix + line)
+        stream.close()
@@ -1,14 +1,18 @@
 import os
 import sys
-import subprocess
-import time
 import json
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
+import base64
+from datetime import datetime, timedelta, timezone
+import time
+import hmac
+import threading
+from flask import Flask, render_template as flask_render_template, request, redirect, url_for, flash, session, jsonify, Response
 import io
 import csv
+import re
+import zlib
 from apscheduler.schedulers.background import BackgroundScheduler
-from collections import defaultdict
+from contextlib import contextmanager
 
 try:
     from sqlcipher3 import dbapi2 as sqlite3
@@ -16,10 +20,75 @@ except ImportError:
     print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
     sys.exit(1)
 
+from migrations import apply_migrations
+from db_pool import ConnectionPool, open_connection
+from report_cache import ReportCache, get_data_generation, bump_data_generation, make_etag
+from job_runner import JobRunner, read_kept, join_log
+from workers import SharedUnlock, LeaderLock, WorkerSlots
+from ops_events import ensure_event_rollups, get_dashboard, get_widget_values, get_event_generation
+from event_ingest import ingest_batch, get_source, batch_slot, BatchError, MAX_BATCH_BYTES
+from instrumentation import metrics, timed, request_timings, InstrumentedConnection
+from sieve_import import import_file, save_report, get_report
+from sieve_analysis import analyze_test, store_results, refresh_stored_results, get_product_trend, get_product_summaries
+from sales_archive import use_partitions, refresh_archive_rollups
+from sales_summary import get_summary_by_item, get_summary_by_year, get_summary_by_month, refresh_rollup, get_exclusion_keywords, set_exclusion_keywords
+
 DATABASE = 'operations_dashboard.db'
+DB_POOL_SIZE, DB_POOL_IDLE_TIMEOUT = 8, 600
+# Compress CSV exports for browsers that accept gzip.
+EXPORT_GZIP = True
+REPORT_CACHE_SIZE = 128
+# Scheduler jobs running at once, and seconds before a run is cancelled.
+JOB_WORKERS, JOB_TIMEOUT = 2, 1800
+# Only the process holding this file's lock runs the scheduler. It checks for settings changes and run/cancel
+# requests from other workers every SCHEDULER_POLL_SECONDS; the other workers try to take over every LEADER_RETRY_SECONDS.
+SCHEDULER_LOCK_FILE = 'scheduler.lock'
+SCHEDULER_POLL_SECONDS, LEADER_RETRY_SECONDS = 5, 15
+# How often each worker shares its metrics with the others; a scrape sees other workers' values this late at most.
+METRICS_PUBLISH_SECONDS = 5
+SCHEDULER_SYNC_JOB, JOB_LOG_FLUSH_JOB = 'scheduler_sync', 'job_log_flush'
+SCHEDULER_INTERNAL_JOBS = (SCHEDULER_SYNC_JOB, JOB_LOG_FLUSH_JOB)
+# Job logs keep the first and last bytes of a run's output. Running jobs' output is copied to the database
+# every JOB_LOG_FLUSH_SECONDS for the log stream, which checks for more every JOB_LOG_STREAM_POLL seconds.
+JOB_LOG_HEAD_BYTES, JOB_LOG_TAIL_BYTES = 256 * 1024, 768 * 1024
+JOB_LOG_FLUSH_SECONDS, JOB_LOG_STREAM_POLL, JOB_LOG_STREAM_MAX_AGE = 1, 1, 300
+# Run history is kept this long; only the latest runs of each job keep their log.
+JOB_RUN_RETENTION_DAYS, JOB_RUN_LOGS_KEPT = 365, 30
+JOB_HISTORY_RUNS = 200
+# pull_sage.py's summary line per table, summed into the run's row counts.
+SYNC_COUNTS_RE = re.compile(r"SUCCESS: Synced (\d+) fetched rows to '[^']*': (\d+) inserted, (\d+) updated")
+# Send a Server-Timing header with every response, not only to requests that ask for one.
+SERVER_TIMING_ALWAYS = False
+# Prometheus scrapes /metrics with 'Authorization: Bearer <METRICS_TOKEN>'; without the variable only logged-in sessions see it.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Live ops dashboards: seconds between checks for new events, seconds between refreshes even without new
+# events (time-window widgets move on), and how long one event stream stays open before the browser reconnects.
+OPS_STREAM_POLL, OPS_STREAM_REFRESH, OPS_STREAM_MAX_AGE = 2, 60, 300
+# An event stream (live dashboard or job log) holds one of its worker's request threads while it is open, so at
+# most MAX_STREAMS_PER_WORKER are served at once, leaving the other threads (serve.py's --threads) for pages and
+# ingestion. Further streams are answered 503 and the browser tries again after STREAM_RETRY_SECONDS.
+MAX_STREAMS_PER_WORKER, STREAM_RETRY_SECONDS = 6, 10
 app = Flask(__name__)
+# Under serve.py the app is imported once and the workers are forked from it, so they share this key.
 app.secret_key = os.urandom(24)
-scheduler = BackgroundScheduler()
+# Runs missed while a job was still going collapse into one; a job never has two runs queued at once.
+scheduler = BackgroundScheduler(job_defaults={'coalesce': True, 'max_instances': 1})
+# Created at the first successful login; holds the master password in server memory and keyed connections.
+# Each worker process has its own, opened from the unlock shared by the first worker to log in.
+db_pool = None
+shared_unlock = SharedUnlock()
+leader_lock = LeaderLock(SCHEDULER_LOCK_FILE)
+_pool_lock, _scheduler_lock = threading.Lock(), threading.Lock()
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS_PER_WORKER)
+# In the scheduler's process: the scheduler_config_version last reconciled, and the next run times last saved.
+_scheduler_state = {'config_version': None, 'next_runs': {}}
+# In the scheduler's process: job id -> its current job_runs row, how much of its log is copied, and its row counts.
+_active_runs, _job_log_lock = {}, threading.Lock()
+report_cache = ReportCache(REPORT_CACHE_SIZE)
+metrics.gauge('report_cache_hits', "Sales report cache hits since start.", lambda: report_cache.hits)
+metrics.gauge('report_cache_misses', "Sales report cache misses since start.", lambda: report_cache.misses)
+# Each worker's metrics are added up in whichever worker answers /metrics.
+metrics.share(WorkerSlots())
 
 def format_with_commas(value):
     if isinstance(value, (int, float)):
@@ -27,16 +96,90 @@ def format_with_commas(value):
     return value
 app.jinja_env.filters['commas'] = format_with_commas
 
+@app.before_request
+def start_request_timer():
+    request_timings.set({})
+    request.environ['timing.start'] = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    elapsed = time.perf_counter() - request.environ.get('timing.start', time.perf_counter())
+    metrics.observe('http_request_seconds', elapsed, endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+    # Opt in per request with an 'X-Server-Timing: 1' header or a 'server_timing=1' query argument.
+    if SERVER_TIMING_ALWAYS or request.headers.get('X-Server-Timing') == '1' or request.args.get('server_timing') == '1':
+        phases = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in (request_timings.get() or {}).items()]
+        response.headers['Server-Timing'] = ", ".join(phases + [f"total;dur={elapsed * 1000:.1f}"])
+    return response
+
+def render_template(template_name, **context):
+    with timed('render'): return flask_render_template(template_name, **context)
+
 def get_db_connection(password):
-    if not password: raise ValueError("A database password is required.")
+    with timed('db_connect'): return open_connection(DATABASE, password)
+
+def attach_shared_unlock():
+    """Opens this worker's connection pool when another worker has unlocked the database."""
+    global db_pool
+    shared = shared_unlock.read()
+    if shared is None or (db_pool is not None and db_pool.token == shared[0]): return
+    with _pool_lock:
+        token, password = shared
+        if db_pool is None: db_pool = ConnectionPool(DATABASE, password, max_size=DB_POOL_SIZE, idle_timeout=DB_POOL_IDLE_TIMEOUT, token=token)
+        else: db_pool.token = token
+
+@app.before_request
+def adopt_shared_unlock():
+    attach_shared_unlock()
+
+def is_unlocked():
+    return db_pool is not None and session.get('db_unlock') == db_pool.token
+
+def cached_report(con, generation, fn, *args, **kwargs):
+    """Runs a report query through the shared LRU cache; `generation` keeps results from outliving the data."""
+    key = (fn.__name__, generation, args, tuple(sorted(kwargs.items())))
+    def compute():
+        with timed('report'): return fn(con, *args, **kwargs)
+    return report_cache.get_or_compute(key, compute)
+
+def encode_cursor(key):
+    """An opaque, URL-safe page cursor for a keyset pagination key."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode() if key else None
+
+def decode_cursor(cursor, length):
+    """The key a cursor from encode_cursor holds, as a tuple of `length` values, or None. Raises ValueError if malformed."""
+    if not cursor: return None
+    key = json.loads(base64.urlsafe_b64decode(cursor))
+    if not isinstance(key, list) or len(key) != length: raise ValueError("Malformed cursor.")
+    return tuple(key)
+
+def not_modified(etag, modified_at):
+    """True if the browser's copy, identified by ETag or Last-Modified, is still current."""
+    if '_flashes' in session: return False  # Pending flash messages must be rendered.
+    if request.if_none_match: return request.if_none_match.contains(etag)
+    return bool(modified_at and request.if_modified_since and request.if_modified_since >= datetime.fromtimestamp(int(modified_at), timezone.utc))
+
+def with_validators(response, etag, modified_at):
+    response.set_etag(etag)
+    if modified_at: response.last_modified = datetime.fromtimestamp(int(modified_at), timezone.utc)
+    response.headers['Cache-Control'] = 'private, no-cache'  # Always revalidate; a 304 costs one config lookup.
+    return response
+
+def not_modified_response(etag, modified_at):
+    return with_validators(Response(status=304), etag, modified_at)
+
+@contextmanager
+def db_connection():
+    """Borrows an already-keyed connection from the pool for the duration of a request or job."""
+    if db_pool is None: raise ConnectionError("The database is locked. Please log in.")
+    with timed('db_acquire'): con = db_pool.acquire()
     try:
-        con = sqlite3.connect(DATABASE, timeout=10)
-        con.row_factory = sqlite3.Row
-        con.execute(f"PRAGMA key = '{password}';")
-        con.execute("SELECT name FROM sqlite_master WHERE type='table' LIMIT 1;")
-        return con
-    except sqlite3.Error as e:
-        raise ConnectionError(f"Failed to connect or unlock database '{DATABASE}'. Is the password correct? Error: {e}")
+        yield InstrumentedConnection(con)
+        if con.in_transaction: con.commit()
+    except BaseException:
+        if con.in_transaction: con.rollback()
+        raise
+    finally:
+        db_pool.release(con)
 
 def add_sieve_test(db_conn, header_data: dict, detail_lines: list):
     cursor = db_conn.cursor()
@@ -47,74 +190,338 @@ def add_sieve_test(db_conn, header_data: dict, detail_lines: list):
         if not new_sieve_test_id: raise Exception("Failed to retrieve new SieveTestID.")
         detail_params = [(new_sieve_test_id, line['sieve'], line['weight']) for line in detail_lines]
         cursor.executemany("INSERT INTO SieveTestDetail (SieveTestID, USSieve, Weight) VALUES (?, ?, ?)", detail_params)
+        store_results(db_conn, [new_sieve_test_id])
+        bump_data_generation(db_conn)
         db_conn.commit()
         return new_sieve_test_id
     except sqlite3.Error as e:
         db_conn.rollback(); return 0
 
+# Reads sales_order_lines, which use_partitions() defines for the date range on the connection first.
+SALES_REPORT_SQL = """
+    SELECT l.*, c.CustomerName, i.ProductLine, i.ProductType, i.SalesUnitOfMeasure
+    FROM sales_order_lines AS l
+    LEFT JOIN Customer AS c ON l.CustomerNo = c.CustomerNo
+    LEFT JOIN CI_Item AS i ON l.ItemCode = i.ItemCode
+    WHERE l.OrderDate BETWEEN ? AND ? ORDER BY l.OrderDate DESC, l.SalesOrderNo DESC;
+"""
+
+RECENT_SIEVE_TESTS_SQL = """
+    SELECT st.SieveTestID, s.Name AS Product, st.SieveTestDate, st.CarorTruckNumber
+    FROM SieveTest AS st INNER JOIN Sample AS s ON st.SampleID = s.SampleID
+    ORDER BY st.SieveTestDate DESC, st.SieveTestID DESC LIMIT 20
+"""
+
 def get_sales_report_data(db_conn, start_date, end_date):
-    sql = """
-        SELECT h.*, d.LineKey, d.ItemCode, d.ItemCodeDesc, d.QuantityOrdered, d.QuantityShipped,
-               d.UnitPrice, d.ExtensionAmt, d.CommentText AS DetailComment, c.CustomerName,
-               i.ProductLine, i.ProductType, i.SalesUnitOfMeasure
-        FROM SalesOrderHeader AS h
-        INNER JOIN SalesOrderDetail AS d ON h.SalesOrderNo = d.SalesOrderNo
-        LEFT JOIN Customer AS c ON h.CustomerNo = c.CustomerNo
-        LEFT JOIN CI_Item AS i ON d.ItemCode = i.ItemCode
-        WHERE h.OrderDate BETWEEN ? AND ? ORDER BY h.OrderDate DESC, h.SalesOrderNo DESC;
+    use_partitions(db_conn, start_date, end_date)
+    return db_conn.execute(SALES_REPORT_SQL, (start_date, end_date)).fetchall()
+
+SALES_DETAIL_COLUMNS = """
+    l.CustomerNo, c.CustomerName, l.ShipToCity, l.ShipToState, l.SalesOrderNo, l.CustomerPONo, l.ItemCode,
+    l.OrderDate, l.LineKey, l.ItemCodeDesc, l.DetailComment, l.QuantityShipped, l.UnitPrice,
+    l.ExtensionAmt, i.ProductLine, i.SalesUnitOfMeasure, l.BillToName, l.ShipToName
+"""
+SALES_DETAIL_PAGE_SIZE, SALES_DETAIL_MAX_PAGE_SIZE = 100, 1000
+
+def get_sales_detail_page(db_conn, start_date, end_date, after=None, limit=SALES_DETAIL_PAGE_SIZE,
+                          customer_no=None, item_code=None, descending=True):
     """
-    return db_conn.execute(sql, (start_date, end_date)).fetchall()
+    One page of detail lines, keyset-paginated on (OrderDate, SalesOrderNo, LineKey): `after` is the
+    key of the last row of the previous page. Returns (rows, key of the next page's start or None).
+    """
+    where, params = ["l.OrderDate BETWEEN ? AND ?"], [start_date, end_date]
+    if customer_no: where.append("l.CustomerNo = ?"); params.append(customer_no)
+    if item_code: where.append("l.ItemCode = ?"); params.append(item_code)
+    direction = "DESC" if descending else "ASC"
+    if after:
+        where.append(f"(l.OrderDate, l.SalesOrderNo, l.LineKey) {'<' if descending else '>'} (?, ?, ?)"); params.extend(after)
+    use_partitions(db_conn, start_date, end_date)
+    sql = f"""
+        SELECT {SALES_DETAIL_COLUMNS}
+        FROM sales_order_lines AS l
+        LEFT JOIN Customer AS c ON l.CustomerNo = c.CustomerNo
+        LEFT JOIN CI_Item AS i ON l.ItemCode = i.ItemCode
+        WHERE {' AND '.join(where)}
+        ORDER BY l.OrderDate {direction}, l.SalesOrderNo {direction}, l.LineKey {direction} LIMIT ?
+    """
+    rows = db_conn.execute(sql, params + [limit + 1]).fetchall()
+    if len(rows) <= limit: return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], [last['OrderDate'], last['SalesOrderNo'], last['LineKey']]
 
 def get_recent_sieve_tests(db_conn):
-    sql = """
-        SELECT st.SieveTestID, s.Name AS Product, st.SieveTestDate, st.CarorTruckNumber
-        FROM SieveTest AS st INNER JOIN Sample AS s ON st.SampleID = s.SampleID
-        ORDER BY st.SieveTestDate DESC, st.SieveTestID DESC LIMIT 20
+    return db_conn.execute(RECENT_SIEVE_TESTS_SQL).fetchall()
+
+SIEVE_SEARCH_PAGE_SIZE = 50
+
+def fts_query(text):
+    """
+    Turns what a user typed into an FTS5 query: every word must match, as a prefix, in the bill of lading,
+    car/truck number or product name. Words are quoted, so FTS5 operators in the input are plain text.
+    """
+    words = ['"' + word.replace('"', '""') + '"*' for word in text.split() if any(ch.isalnum() for ch in word)]
+    return " AND ".join(words)
+
+def search_sieve_tests(db_conn, text=None, sample_id=None, start_date=None, end_date=None, after=None, limit=SIEVE_SEARCH_PAGE_SIZE):
+    """
+    One page of sieve tests, newest first, keyset-paginated: `after` is the (SieveTestDate, SieveTestID) key of
+    the last row of the previous page. Returns (rows, key of the next page's start or None).
+    Without search text, tests are ordered by date and read from the date index. With search text they are ordered
+    by SieveTestID, the order FTS5 keeps its matches in, so a page reads only as many matches as it shows however
+    broad the words are; ordering matches by date would sort all of them on every page. Tests are numbered as they
+    are entered, so this is newest entered first, and a page narrowed by product or dates may read past tests
+    that match the words but not the filters.
     """
-    return db_conn.execute(sql).fetchall()
+    where, params = [], []
+    match = fts_query(text or '')
+    if text and text.strip() and not match: return [], None  # Only punctuation: nothing can match.
+    if match: where.append("sieve_test_fts MATCH ?"); params.append(match)
+    if sample_id: where.append("st.SampleID = ?"); params.append(sample_id)
+    if start_date: where.append("st.SieveTestDate >= ?"); params.append(start_date)
+    if end_date: where.append("st.SieveTestDate <= ?"); params.append(end_date)
+    if match:
+        if after: where.append("f.rowid < ?"); params.append(after[1])
+        # CROSS JOIN keeps the FTS table outermost, so its rowid order serves the ORDER BY.
+        source, order = "sieve_test_fts AS f CROSS JOIN SieveTest AS st ON st.SieveTestID = f.rowid", "f.rowid DESC"
+    else:
+        if after: where.append("(st.SieveTestDate, st.SieveTestID) < (?, ?)"); params.extend(after)
+        source, order = "SieveTest AS st", "st.SieveTestDate DESC, st.SieveTestID DESC"
+    rows = db_conn.execute(f"""
+        SELECT st.SieveTestID, s.Name AS Product, st.SieveTestDate, st.CarorTruckNumber, st.BillofLading, st.StoredAFS, st.OutOfSpec
+        FROM {source} LEFT JOIN Sample AS s ON st.SampleID = s.SampleID
+        WHERE {' AND '.join(where) or '1'}
+        ORDER BY {order} LIMIT ?
+    """, params + [limit + 1]).fetchall()
+    if len(rows) <= limit: return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], [last['SieveTestDate'], last['SieveTestID']]
 
 def get_sieve_test_details(db_conn, test_id):
     header = db_conn.execute("SELECT st.*, s.Name as ProductName FROM SieveTest as st INNER JOIN Sample as s ON st.SampleID = s.SampleID WHERE st.SieveTestID = ?", (test_id,)).fetchone()
     if not header: return None
     details = db_conn.execute("SELECT USSieve, Weight FROM SieveTestDetail WHERE SieveTestID = ? ORDER BY USSieve", (test_id,)).fetchall()
-    return {"header": header, "details": details}
-
-def run_job(job_id, script_path, password):
-    print(f"[{datetime.now()}] SCHEDULER: Running job '{job_id}': {script_path}")
-    log_output, status = "", "Failure"
-    try:
-        env = os.environ.copy(); env['DB_MASTER_PASSWORD'] = password
-        result = subprocess.run([sys.executable, script_path], capture_output=True, text=True, check=False, timeout=1800, encoding='utf-8', errors='replace', env=env)
-        log_output = f"--- STDOUT ---\n{result.stdout}\n\n--- STDERR ---\n{result.stderr}"
-        if result.returncode == 0: status = "Success"
-    except Exception as e: log_output = f"Scheduler failed to run script: {e}"
-    finally:
-        print(f"[{datetime.now()}] SCHEDULER: Finished job '{job_id}' with status: {status}")
-        try:
-            with get_db_connection(password) as con:
-                con.execute("UPDATE scheduler_jobs SET last_run = ?, last_status = ?, last_run_log = ? WHERE id = ?",
-                            (datetime.now().isoformat(timespec='seconds'), status, log_output, job_id))
-                con.commit()
-        except Exception as e:
-            print(f"[{datetime.now()}] SCHEDULER: Failed to log job result to DB: {e}", file=sys.stderr)
+    return {"header": header, "details": details, "analysis": analyze_test(db_conn, test_id)}
+
+def record_job_start(job_id):
+    # running_since lets the Settings page of every worker show the job as running.
+    started = datetime.now().isoformat(timespec='seconds')
+    with db_connection() as con:
+        con.execute("UPDATE scheduler_jobs SET running_since = ? WHERE id = ?", (started, job_id))
+        run_id = con.execute("INSERT INTO job_runs (job_id, started_at, status) VALUES (?, ?, 'Running')", (job_id, started)).lastrowid
+    with _job_log_lock: _active_runs[job_id] = {'run_id': run_id, 'started': time.monotonic(), 'flushed': 0, 'counts': None}
+
+def count_synced_rows(job_id, line):
+    match = SYNC_COUNTS_RE.search(line)
+    if not match: return
+    with _job_log_lock:
+        run = _active_runs.get(job_id)
+        if run: run['counts'] = [total + int(n) for total, n in zip(run['counts'] or (0, 0, 0), match.groups())]
+
+def flush_job_logs():
+    """Copies the new output of running jobs to job_run_chunks, where the log stream of any worker reads it."""
+    with _job_log_lock:
+        pending = []
+        for job_id, run in _active_runs.items():
+            log = job_runner.live_log(job_id)
+            if log is None: continue
+            start, data = log.read_from(run['flushed'])
+            if data: pending.append((run, start, data, log.size))
+        if not pending: return
+        with db_connection() as con:
+            for run, start, data, total in pending:
+                con.execute("INSERT OR REPLACE INTO job_run_chunks (run_id, start_offset, data) VALUES (?, ?, ?)", (run['run_id'], start, data))
+                # Like the log itself, the copy keeps only the first and the last bytes of the output.
+                con.execute("DELETE FROM job_run_chunks WHERE run_id = ? AND start_offset >= ? AND start_offset + length(data) <= ?",
+                            (run['run_id'], JOB_LOG_HEAD_BYTES, total - JOB_LOG_TAIL_BYTES))
+                run['flushed'] = start + len(data)
+
+def record_job_result(job_id, status, log):
+    finished = datetime.now().isoformat(timespec='seconds')
+    with _job_log_lock: run = _active_runs.pop(job_id, None)
+    head, tail, total = log.parts()
+    with db_connection() as con:
+        con.execute("UPDATE scheduler_jobs SET last_run = ?, last_status = ?, last_run_log = NULL, running_since = NULL WHERE id = ?",
+                    (finished, status, job_id))
+        if run:
+            counts = run['counts'] or (None, None, None)
+            con.execute("""UPDATE job_runs SET finished_at = ?, duration_seconds = ?, status = ?, rows_fetched = ?, rows_inserted = ?, rows_updated = ?,
+                           log = ?, log_head_bytes = ?, log_bytes = ? WHERE id = ?""",
+                        (finished, round(time.monotonic() - run['started'], 2), status, *counts, zlib.compress(head + tail), len(head), total, run['run_id']))
+            con.execute("DELETE FROM job_run_chunks WHERE run_id = ?", (run['run_id'],))
+        prune_job_runs(con, job_id)
+        if status == "Success": bump_data_generation(con)
+        con.commit()
+
+def prune_job_runs(db_conn, job_id):
+    """Retention: drops runs older than JOB_RUN_RETENTION_DAYS and the logs of all but the last JOB_RUN_LOGS_KEPT runs."""
+    cutoff = (datetime.now() - timedelta(days=JOB_RUN_RETENTION_DAYS)).isoformat(timespec='seconds')
+    db_conn.execute("DELETE FROM job_runs WHERE job_id = ? AND started_at < ?", (job_id, cutoff))
+    db_conn.execute("""UPDATE job_runs SET log = NULL WHERE job_id = ? AND log IS NOT NULL
+                       AND id <= (SELECT id FROM job_runs WHERE job_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)""", (job_id, job_id, JOB_RUN_LOGS_KEPT))
+
+def read_run_log(db_conn, run, offset):
+    """(start, data) of a run's log from byte `offset` on, as JobLog.read_from: from the stored log once the run has one, else from its copied chunks."""
+    if run['status'] != 'Running':
+        stored = db_conn.execute("SELECT log, log_head_bytes, log_bytes FROM job_runs WHERE id = ?", (run['id'],)).fetchone()
+        if stored['log'] is not None:
+            data = zlib.decompress(stored['log'])
+            return read_kept(data[:stored['log_head_bytes']], data[stored['log_head_bytes']:], stored['log_bytes'], offset)
+    chunks = db_conn.execute("SELECT start_offset, data FROM job_run_chunks WHERE run_id = ? AND start_offset + length(data) > ? ORDER BY start_offset",
+                             (run['id'], offset)).fetchall()
+    if not chunks: return offset, b""
+    start = max(offset, chunks[0]['start_offset'])
+    data = bytearray(chunks[0]['data'][start - chunks[0]['start_offset']:])
+    for chunk in chunks[1:]:
+        if chunk['start_offset'] != start + len(data): break  # Dropped output; the next read reports the gap.
+        data += chunk['data']
+    return start, bytes(data)
+
+def sync_sage_job(context):
+    # Imported on first use so the web app does not need pyodbc until a sync actually runs.
+    import pull_sage
+    with db_connection() as con:
+        return pull_sage.main(local_conn=con, cancel=context.cancel_event)
+
+job_runner = JobRunner(on_finish=record_job_result, on_start=record_job_start, on_log_line=count_synced_rows, max_workers=JOB_WORKERS, timeout=JOB_TIMEOUT,
+                       log_head_bytes=JOB_LOG_HEAD_BYTES, log_tail_bytes=JOB_LOG_TAIL_BYTES)
+job_runner.register('pull_sage.py', sync_sage_job)
+
+def run_job(job_id, script_path, run_mode='inprocess'):
+    """Scheduler entry point: hands the job to the job runner unless a run of it is already in progress."""
+    subprocess_mode = run_mode == 'subprocess'
+    # Only a child process needs the master password, and only in its own environment.
+    env = {'DB_MASTER_PASSWORD': db_pool.password} if subprocess_mode or not job_runner.is_registered(script_path) else None
+    if not job_runner.submit(job_id, script_path, subprocess_mode=subprocess_mode, env=env):
+        print(f"[{datetime.now()}] SCHEDULER: Job '{job_id}' is already running; skipping this run.")
+        return False
+    return True
+
+def get_scheduler_config_version(db_conn):
+    row = db_conn.execute("SELECT value FROM config WHERE key = 'scheduler_config_version'").fetchone()
+    return row[0] if row else '0'
+
+def bump_scheduler_config_version(db_conn):
+    """Marks the scheduler settings as changed, so the scheduler's process reconciles its jobs. The caller commits."""
+    db_conn.execute("""
+        INSERT INTO config (key, value) VALUES ('scheduler_config_version', '1')
+        ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    """)
+
+def reconcile_scheduler(db_conn):
+    """
+    Brings the scheduler's jobs in line with scheduler_jobs without a restart: adds new jobs, reschedules
+    changed intervals, updates the run mode, pauses disabled jobs, resumes re-enabled ones and removes
+    deleted ones. A job that is running keeps running; the change applies from its next run.
+    """
+    _scheduler_state['config_version'] = get_scheduler_config_version(db_conn)
+    rows = {str(row['id']): row for row in db_conn.execute("SELECT id, script_path, interval_minutes, run_mode, enabled FROM scheduler_jobs")}
+    for job in scheduler.get_jobs():
+        if job.id not in SCHEDULER_INTERNAL_JOBS and job.id not in rows: scheduler.remove_job(job.id)
+    for job_id, row in rows.items():
+        job, args, interval = scheduler.get_job(job_id), (row['id'], row['script_path'], row['run_mode']), timedelta(minutes=row['interval_minutes'])
+        if job is None:
+            if row['enabled']: scheduler.add_job(run_job, 'interval', minutes=row['interval_minutes'], args=args, id=job_id, next_run_time=datetime.now() + timedelta(seconds=10))
+            continue
+        if tuple(job.args) != args: job.modify(args=args)
+        # Rescheduling restarts the interval from now, and also resumes a paused job; pausing comes after.
+        if job.trigger.interval != interval: job = job.reschedule('interval', minutes=row['interval_minutes'])
+        if not row['enabled'] and job.next_run_time is not None: job.pause()
+        elif row['enabled'] and job.next_run_time is None: job.resume()
+
+def save_next_run_times(db_conn):
+    """Stores each job's next run time on scheduler_jobs, where every worker's Settings page can show it."""
+    next_runs = {int(job.id): job.next_run_time.replace(tzinfo=None).isoformat(timespec='seconds') if job.next_run_time else None
+                 for job in scheduler.get_jobs() if job.id not in SCHEDULER_INTERNAL_JOBS}
+    saved = _scheduler_state['next_runs']
+    changed = [(next_run, job_id) for job_id, next_run in next_runs.items() if saved.get(job_id, '') != next_run]
+    changed += [(None, job_id) for job_id in saved if job_id not in next_runs and saved[job_id] is not None]
+    if changed: db_conn.executemany("UPDATE scheduler_jobs SET next_run_at = ? WHERE id = ?", changed)
+    _scheduler_state['next_runs'] = {**{job_id: None for job_id in saved}, **next_runs}
+
+def sync_scheduler():
+    """
+    Runs every SCHEDULER_POLL_SECONDS in the scheduler's process: reconciles the jobs after a settings change
+    made in any worker, carries out the run/cancel requests other workers left in scheduler_jobs, and saves
+    the next run times.
+    """
+    with db_connection() as con:
+        if get_scheduler_config_version(con) != _scheduler_state['config_version']:
+            with _scheduler_lock: reconcile_scheduler(con)
+        requests = con.execute("""UPDATE scheduler_jobs SET requested_action = NULL WHERE requested_action IS NOT NULL
+                                  RETURNING id, script_path, run_mode, requested_action""").fetchall()
+        save_next_run_times(con)
+    for job in requests:
+        if job['requested_action'] == 'cancel': job_runner.cancel(job['id'])
+        else: run_job(job['id'], job['script_path'], job['run_mode'])
+
+def claim_scheduler():
+    """Starts the scheduler if this process wins the scheduler lock. Returns whether this process runs the scheduler."""
+    with _scheduler_lock:
+        if scheduler.running: return True
+        if db_pool is None or not leader_lock.try_acquire(): return False
+        print(f"--- Process {os.getpid()} owns the scheduler lock, starting scheduler. ---")
+        with db_connection() as con:
+            # Left over from the previous owner. Interrupted runs keep the output copied so far.
+            con.execute("UPDATE scheduler_jobs SET running_since = NULL, next_run_at = NULL")
+            con.execute("UPDATE job_runs SET status = 'Interrupted', finished_at = ? WHERE status = 'Running'", (datetime.now().isoformat(timespec='seconds'),))
+            reconcile_scheduler(con)
+        scheduler.add_job(sync_scheduler, 'interval', seconds=SCHEDULER_POLL_SECONDS, id=SCHEDULER_SYNC_JOB, next_run_time=datetime.now())
+        scheduler.add_job(flush_job_logs, 'interval', seconds=JOB_LOG_FLUSH_SECONDS, id=JOB_LOG_FLUSH_JOB)
+        scheduler.start()
+        return True
+
+def start_worker():
+    """Called by serve.py in each worker process: adopts the shared unlock and takes over the scheduler if its owner exits."""
+    def watch():
+        while True:
+            try:
+                attach_shared_unlock()
+                claim_scheduler()
+            except Exception as e:
+                print(f"ERROR: Scheduler lock check failed: {e}", file=sys.stderr)
+            time.sleep(LEADER_RETRY_SECONDS)
+    def publish_metrics():
+        while True:
+            metrics.publish()
+            time.sleep(METRICS_PUBLISH_SECONDS)
+    threading.Thread(target=watch, name='scheduler-leader', daemon=True).start()
+    threading.Thread(target=publish_metrics, name='metrics-publisher', daemon=True).start()
+
+def stop_worker():
+    if scheduler.running: scheduler.shutdown(wait=False)
+    job_runner.shutdown()
+    leader_lock.release()
+    metrics.publish()  # The worker's counts stay in the totals after it exits.
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
+    global db_pool
     if request.method == 'POST':
         password = request.form.get('password')
         try:
-            with get_db_connection(password) as con:
-                if not scheduler.running:
-                    print("--- First login, starting scheduler. ---")
-                    jobs = con.execute("SELECT id, script_path, interval_minutes FROM scheduler_jobs WHERE enabled = 1").fetchall()
-                    for job in jobs:
-                        scheduler.add_job(run_job, 'interval', minutes=job['interval_minutes'], args=[job['id'], job['script_path'], password], id=str(job['id']), next_run_time=datetime.now() + timedelta(seconds=10))
-                    scheduler.start()
-            session['db_password'] = password
+            if db_pool is None or not db_pool.matches(password):
+                # Only an unlock with a new password pays for key derivation; the connection then seeds the pool.
+                con = get_db_connection(password)
+                with _pool_lock:
+                    if db_pool is None: db_pool = ConnectionPool(DATABASE, password, max_size=DB_POOL_SIZE, idle_timeout=DB_POOL_IDLE_TIMEOUT)
+                    db_pool.token = shared_unlock.publish(db_pool.token, password)[0]
+                db_pool.add(con)
+            with db_connection() as con:
+                apply_migrations(con)
+                # Builds the sales rollup and the cached sieve test results after the upgrades that add them;
+                # no-ops when nothing is pending.
+                if refresh_rollup(con) + refresh_stored_results(con):
+                    bump_data_generation(con)
+                    con.commit()
+                ensure_event_rollups(con)
+            claim_scheduler()
+            session['db_unlock'] = db_pool.token
             flash('Database unlocked successfully!', 'success')
             return redirect(url_for('dashboard'))
         except (ValueError, ConnectionError) as e:
             flash(f"Login failed: {e}", 'error')
+        except sqlite3.Error as e:
+            flash(f"Database schema upgrade failed: {e}", 'error')
     return render_template('login.html')
 
 @app.route('/')
@@ -123,43 +530,156 @@ def dashboard():
 
 @app.route('/ops/<string:dashboard_name>')
 def ops_dashboard(dashboard_name):
-    if 'db_password' not in session: return redirect(url_for('login'))
-    dashboards = {
-        'east': {'title': 'East Operations', 'data': [{'key': 'Sample Reading', 'value': 123.45}]},
-        'west_dry': {'title': 'West Dry Operations', 'data': []},
-        'west_wet': {'title': 'West Wet Operations', 'data': []},
-        'west_ball': {'title': 'West Ball Mill', 'data': []},
-    }
-    dash = dashboards.get(dashboard_name)
-    if not dash: return "Dashboard not found", 404
-    return render_template('ops_dashboard.html', title=dash['title'], data=dash['data'], active_page=dashboard_name)
+    if not is_unlocked(): return redirect(url_for('login'))
+    try:
+        with db_connection() as con:
+            dash = get_dashboard(con, dashboard_name)
+            if not dash: return "Dashboard not found", 404
+            widgets = get_widget_values(con, dashboard_name)
+        return render_template('ops_dashboard.html', title=dash['title'], widgets=widgets, dashboard_name=dashboard_name, active_page=dashboard_name)
+    except (ValueError, ConnectionError) as e:
+        flash(f"Database Error: {e}", 'error'); return redirect(url_for('login'))
+
+def event_stream(events):
+    """A Server-Sent Events response for `events`, or 503 when this worker already serves MAX_STREAMS_PER_WORKER streams."""
+    if not _stream_slots.acquire(blocking=False):
+        return Response("Too many live views are open; retrying shortly.", status=503, headers={'Retry-After': str(STREAM_RETRY_SECONDS)})
+    response = Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called when the server closes the response, also if the client went away before the first event.
+    response.call_on_close(_stream_slots.release)
+    return response
+
+@app.route('/ops/<string:dashboard_name>/stream')
+def ops_dashboard_stream(dashboard_name):
+    """Server-Sent Events: pushes the dashboard's widget values whenever they change."""
+    if not is_unlocked(): return Response("Authentication required.", status=401)
+
+    def events():
+        sent, seen_generation, refreshed = None, None, 0
+        started = time.monotonic()
+        yield "retry: 5000\n\n"
+        while time.monotonic() - started < OPS_STREAM_MAX_AGE:
+            try:
+                with db_connection() as con:
+                    generation = get_event_generation(con)
+                    if generation != seen_generation or time.monotonic() - refreshed >= OPS_STREAM_REFRESH:
+                        seen_generation, refreshed = generation, time.monotonic()
+                        payload = json.dumps(get_widget_values(con, dashboard_name))
+                    else: payload = sent
+            except (ValueError, ConnectionError, sqlite3.Error) as e:
+                yield f"event: error\ndata: {json.dumps(str(e))}\n\n"; return
+            # A comment line doubles as a keep-alive and lets a closed connection be noticed.
+            yield f"data: {payload}\n\n" if payload != sent else ": keep-alive\n\n"
+            sent = payload
+            time.sleep(OPS_STREAM_POLL)
+
+    return event_stream(events())
+
+@app.route('/api/ops/events', methods=['POST'])
+def api_ingest_events():
+    """Stores a batch of OPEvent rows sent by a plant source as NDJSON or CSV (see event_ingest.py)."""
+    # Sources authenticate with their own token, not a browser session; the database still has to be unlocked.
+    if db_pool is None: return jsonify({'error': 'The database is locked.'}), 503, {'Retry-After': '30'}
+    if (request.content_length or 0) > MAX_BATCH_BYTES: return jsonify({'error': f"Batch is larger than {MAX_BATCH_BYTES} bytes."}), 413
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    with batch_slot() as acquired:
+        if not acquired:
+            metrics.inc('ops_ingest_batches_total', source='', outcome='busy')
+            return jsonify({'error': 'Too many batches in progress; retry later.'}), 503, {'Retry-After': '1'}
+        try:
+            with db_connection() as con:
+                source = get_source(con, token)
+                if not source: return jsonify({'error': 'Unknown or missing source token.'}), 401
+                result = ingest_batch(con, request.get_data(), request.mimetype, source, batch_id=request.headers.get('X-Batch-Id') or None,
+                                      content_encoding=request.headers.get('Content-Encoding'))
+        except BatchError as e:
+            metrics.inc('ops_ingest_batches_total', source=source, outcome='invalid')
+            return jsonify({'error': str(e)}), e.status
+        except (ConnectionError, sqlite3.Error) as e:
+            return jsonify({'error': f"Database Error: {e}"}), 503, {'Retry-After': '5'}
+    metrics.inc('ops_ingest_batches_total', source=source, outcome='duplicate' if result['duplicate'] else 'stored')
+    metrics.inc('ops_ingest_rows_total', result['accepted'], source=source, outcome='accepted')
+    metrics.inc('ops_ingest_rows_total', result['rejected'], source=source, outcome='rejected')
+    return jsonify(result)
 
 @app.route('/sieve', methods=['GET', 'POST'])
 def sieve_search():
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
     if request.method == 'POST' and request.form.get('id_to_search'):
         return redirect(url_for('sieve_detail', test_id=request.form.get('id_to_search')))
+    args = request.args
+    search = {'text': args.get('q', '').strip(), 'sample_id': args.get('sample_id', type=int),
+              'start_date': args.get('start_date') or None, 'end_date': args.get('end_date') or None}
+    try:
+        after = decode_cursor(args.get('cursor'), 2)
+    except (ValueError, TypeError):
+        flash("Invalid page link.", 'error'); after = None
     try:
-        with get_db_connection(session['db_password']) as con:
-            return render_template('sieve_search.html', recent_tests=get_recent_sieve_tests(con))
+        with db_connection() as con:
+            generation, _ = get_data_generation(con)
+            samples = con.execute("SELECT SampleID, Name FROM Sample ORDER BY Name").fetchall()
+            results = next_cursor = None
+            if any(search.values()):
+                results, next_key = search_sieve_tests(con, after=after, **search)
+                next_cursor = encode_cursor(next_key)
+            return render_template('sieve_search.html', recent_tests=None if results is not None else get_recent_sieve_tests(con),
+                                   products=cached_report(con, generation, get_product_summaries), samples=samples,
+                                   search=search, results=results, next_cursor=next_cursor)
     except (ValueError, ConnectionError) as e:
         flash(f"Database Error: {e}", 'error'); return redirect(url_for('login'))
 
 @app.route('/sieve/<int:test_id>')
 def sieve_detail(test_id):
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
     try:
-        with get_db_connection(session['db_password']) as con: data = get_sieve_test_details(con, test_id)
+        with db_connection() as con: data = get_sieve_test_details(con, test_id)
         if not data: return "Sieve Test not found", 404
         return render_template('sieve_detail.html', data=data)
     except (ValueError, ConnectionError) as e:
         flash(f"Database Error: {e}", 'error'); return redirect(url_for('login'))
 
+@app.route('/sieve/<int:test_id>/selected', methods=['POST'])
+def set_sieve_test_selected(test_id):
+    """Includes a test in, or leaves it out of, its product's averages."""
+    if not is_unlocked(): return redirect(url_for('login'))
+    try:
+        with db_connection() as con:
+            con.execute("UPDATE SieveTest SET Selected4Avg = ? WHERE SieveTestID = ?", (1 if 'selected' in request.form else 0, test_id))
+            bump_data_generation(con)
+            con.commit()
+        flash('Sieve test updated.', 'success')
+    except (ValueError, ConnectionError) as e:
+        flash(f"Database Error: {e}", 'error')
+    return redirect(url_for('sieve_detail', test_id=test_id))
+
+@app.route('/sieve/product/<int:sample_id>')
+def sieve_product_trend(sample_id):
+    if not is_unlocked(): return redirect(url_for('login'))
+    end_date, start_date = datetime.now(), datetime.now() - timedelta(days=365)
+    if request.args.get('start_date') or request.args.get('end_date'):
+        try:
+            start_date = datetime.strptime(request.args.get('start_date'), '%Y-%m-%d')
+            end_date = datetime.strptime(request.args.get('end_date'), '%Y-%m-%d')
+        except (ValueError, TypeError): flash("Invalid date format.", "error")
+    try:
+        start, end = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+        with db_connection() as con:
+            sample = con.execute("SELECT SampleID, Name FROM Sample WHERE SampleID = ?", (sample_id,)).fetchone()
+            if not sample: return "Product not found", 404
+            generation, modified_at = get_data_generation(con)
+            etag = make_etag('sieve_product_trend', sample_id, start, end, generation)
+            if not_modified(etag, modified_at): return not_modified_response(etag, modified_at)
+            trend = cached_report(con, generation, get_product_trend, sample_id, start, end)
+        response = app.make_response(render_template('sieve_trend.html', sample=sample, trend=trend, start_date=start, end_date=end))
+        return with_validators(response, etag, modified_at)
+    except (ValueError, ConnectionError) as e:
+        flash(f"Database Error: {e}", 'error'); return redirect(url_for('login'))
+
 @app.route('/sieve/new', methods=['GET', 'POST'])
 def new_sieve_test():
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
     try:
-        with get_db_connection(session['db_password']) as con:
+        with db_connection() as con:
             if request.method == 'POST':
                 header = {'date': request.form.get('test_date'), 'sample_id': int(request.form.get('sample_id')), 'car_truck': request.form.get('car_truck'), 'bol': request.form.get('bol')}
                 details = [{'sieve': int(s), 'weight': float(w)} for s, w in zip(request.form.getlist('sieve'), request.form.getlist('weight')) if s and w]
@@ -179,159 +699,316 @@ def new_sieve_test():
     except (ValueError, ConnectionError, TypeError) as e:
         flash(f'An error occurred: {e}', 'error'); return redirect(url_for('dashboard'))
 
+@app.route('/sieve/import', methods=['GET', 'POST'])
+def import_sieve_tests():
+    """Bulk import of historical sieve tests from an uploaded CSV or .xlsx file; see sieve_import.py."""
+    if not is_unlocked(): return redirect(url_for('login'))
+    if request.method == 'GET': return render_template('sieve_import.html', result=None)
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Choose a file to import.', 'error'); return redirect(request.url)
+    report = io.StringIO()
+    try:
+        with db_connection() as con:
+            importer = import_file(con, upload.stream, upload.filename, create_samples='create_samples' in request.form, rejects=csv.writer(report))
+            token = save_report(con, upload.filename, importer.stats['rejected'], report.getvalue()) if importer.stats['rejected'] else None
+    except ValueError as e:
+        flash(f"Import failed: {e}", 'error'); return redirect(request.url)
+    except (ConnectionError, sqlite3.Error) as e:
+        flash(f"Database Error: {e}", 'error'); return redirect(request.url)
+    stats = importer.stats
+    flash(f"Imported {stats['imported']} of {stats['rows']} tests from {upload.filename}.", 'success' if stats['imported'] else 'error')
+    return render_template('sieve_import.html', result={'stats': stats, 'rejected': importer.rejected, 'report_token': token, 'filename': upload.filename})
+
+@app.route('/sieve/import/report/<token>')
+def sieve_import_report(token):
+    if not is_unlocked(): return redirect(url_for('login'))
+    try:
+        with db_connection() as con: report = get_report(con, token)
+    except (ValueError, ConnectionError) as e:
+        flash(f"Database Error: {e}. Please log in again.", 'error'); return redirect(url_for('login'))
+    if not report: return "Report not found or expired", 404
+    filename, text = report
+    name = os.path.splitext(os.path.basename(filename or 'import'))[0] + '.rejects.csv'
+    return Response(text, mimetype="text/csv", headers={"Content-Disposition": f"attachment;filename={name}"})
+
 @app.route('/sales-report', methods=['GET', 'POST'])
 def sales_report():
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
     end_date, start_date = datetime.now(), datetime.now() - timedelta(days=7)
-    if request.method == 'POST':
+    # The form submits with GET so the report URL carries its range and can be revalidated with ETags.
+    if request.values.get('start_date') or request.values.get('end_date'):
         try:
-            start_date = datetime.strptime(request.form.get('start_date'), '%Y-%m-%d')
-            end_date = datetime.strptime(request.form.get('end_date'), '%Y-%m-%d')
+            start_date = datetime.strptime(request.values.get('start_date'), '%Y-%m-%d')
+            end_date = datetime.strptime(request.values.get('end_date'), '%Y-%m-%d')
         except (ValueError, TypeError): flash("Invalid date format.", "error")
     try:
-        with get_db_connection(session['db_password']) as con:
-            report_data = get_sales_report_data(con, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-
-        summary_by_item = defaultdict(lambda: {'revenue': 0.0, 'tons_sold': 0.0})
-        summary_by_year = defaultdict(lambda: {'revenue': 0.0, 'tons_sold': 0.0})
-
-        for row in report_data:
-            revenue = row['ExtensionAmt'] or 0.0
-            quantity = row['QuantityShipped'] if row['QuantityShipped'] is not None else (row['QuantityOrdered'] or 0.0)
-            item_desc = row['ItemCodeDesc'] if (row['ItemCodeDesc'] and row['ItemCodeDesc'].strip()) else '(Not Specified)'
-            summary_by_item[item_desc]['revenue'] += revenue
-            excluded_keywords = ['freight', 'pallet', 'lease', 'dunnage', 'shipping', 'charge', 'fee', 'misc', 'covers', 'shrinkwrap']
-            if not any(keyword in item_desc.lower() for keyword in excluded_keywords):
-                summary_by_item[item_desc]['tons_sold'] += quantity
-            try:
-                order_date = datetime.strptime(row['OrderDate'], '%Y-%m-%d')
-                year = order_date.year
-                summary_by_year[year]['revenue'] += revenue
-                if not any(keyword in item_desc.lower() for keyword in excluded_keywords):
-                     summary_by_year[year]['tons_sold'] += quantity
-            except (TypeError, ValueError):
-                continue
-
-        sorted_summary_by_item = sorted(summary_by_item.items(), key=lambda item: item[1]['revenue'], reverse=True)
-        sorted_summary_by_year = sorted(summary_by_year.items(), key=lambda item: item[0])
-
-        return render_template(
-            'sales_report.html', data=report_data,
-            summary_by_item=sorted_summary_by_item, summary_by_year=sorted_summary_by_year,
-            start_date=start_date.strftime('%Y-%m-%d'), end_date=end_date.strftime('%Y-%m-%d')
-        )
+        start, end = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+        with db_connection() as con:
+            generation, modified_at = get_data_generation(con)
+            etag = make_etag('sales_report', start, end, generation)
+            if request.method == 'GET' and not_modified(etag, modified_at): return not_modified_response(etag, modified_at)
+            summary_by_item = cached_report(con, generation, get_summary_by_item, start, end)
+            summary_by_year = cached_report(con, generation, get_summary_by_year, start, end)
+            summary_by_month = cached_report(con, generation, get_summary_by_month, start, end)
+
+        response = app.make_response(render_template(
+            'sales_report.html',
+            summary_by_item=summary_by_item, summary_by_year=summary_by_year, summary_by_month=summary_by_month,
+            start_date=start, end_date=end
+        ))
+        return with_validators(response, etag, modified_at)
     except (ValueError, ConnectionError) as e:
         flash(f"Database Error: {e}. Please log in again.", 'error'); return redirect(url_for('login'))
 
+DETAILED_EXPORT_HEADERS = [
+    'CustomerNo', 'CustomerName', 'ShipToCity', 'ShipToState', 'ShipToZipCode', 'SalesOrderNo',
+    'CustomerPONo', 'ItemCode', 'OrderDate', 'ItemCodeDesc', 'DetailComment', 'QuantityShipped',
+    'UnitPrice', 'ExtensionAmt', 'ProductLine', 'SalesUnitOfMeasure', 'BillToName',
+    'BillToAddress1', 'BillToCity', 'BillToState', 'BillToZipCode', 'ShipToName', 'ShipToAddress1'
+]
+# Summary exports: (CSV headers, row columns, summary query) per report type.
+SUMMARY_EXPORTS = {
+    'item': (['Item Description', 'Tons Sold', 'Revenue'], ['item', 'tons_sold', 'revenue'], get_summary_by_item),
+    'year': (['Year', 'Tons Sold', 'Revenue'], ['year', 'tons_sold', 'revenue'], get_summary_by_year),
+    'month': (['Month', 'Tons Sold', 'Revenue'], ['month', 'tons_sold', 'revenue'], get_summary_by_month),
+}
+EXPORT_BATCH_SIZE = 2000
+
+def fetch_batches(cursor, size=EXPORT_BATCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows: return
+        yield rows
+
+def generate_csv(headers, columns, batches, compress=False):
+    """Yields the CSV one encoded chunk per batch of rows, gzip-compressed on the fly if requested."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip header.
+    if headers: writer.writerow(headers)
+    for batch in batches:
+        writer.writerows([row[c] for c in columns] for row in batch)
+        chunk = buffer.getvalue().encode('utf-8')
+        buffer.seek(0); buffer.truncate()
+        if compressor: chunk = compressor.compress(chunk)
+        if chunk: yield chunk
+    tail = buffer.getvalue().encode('utf-8')  # Header row only, when there were no rows at all.
+    if compressor: yield compressor.compress(tail) + compressor.flush()
+    elif tail: yield tail
+
 @app.route('/export/sales')
 def export_sales_report():
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
 
     report_type = request.args.get('report_type', 'detailed')
     start = request.args.get('start_date')
     end = request.args.get('end_date')
+    filename = f"sales_report_{report_type}_{start}_to_{end}.csv"
+    compress = EXPORT_GZIP and 'gzip' in request.headers.get('Accept-Encoding', '')
 
     try:
-        with get_db_connection(session['db_password']) as con:
-            report_data = get_sales_report_data(con, start, end)
-
-        output = io.StringIO()
-        writer = csv.writer(output)
-
-        filename = f"sales_report_{report_type}_{start}_to_{end}.csv"
-
-        if report_type == 'detailed':
-            headers = [
-                'CustomerNo', 'CustomerName', 'ShipToCity', 'ShipToState', 'ShipToZipCode', 'SalesOrderNo',
-                'CustomerPONo', 'ItemCode', 'OrderDate', 'ItemCodeDesc', 'DetailComment', 'QuantityShipped',
-                'UnitPrice', 'ExtensionAmt', 'ProductLine', 'SalesUnitOfMeasure', 'BillToName',
-                'BillToAddress1', 'BillToCity', 'BillToState', 'BillToZipCode', 'ShipToName', 'ShipToAddress1'
-            ]
-            writer.writerow(headers)
-            for row in report_data:
-                # Corrected to access row items by key, not by .get() method
-                writer.writerow([row[h] for h in headers])
-
-        elif report_type == 'item':
-            summary_by_item = defaultdict(lambda: {'revenue': 0.0, 'tons_sold': 0.0})
-            for row in report_data:
-                revenue = row['ExtensionAmt'] or 0.0
-                quantity = row['QuantityShipped'] if row['QuantityShipped'] is not None else (row['QuantityOrdered'] or 0.0)
-                item_desc = row['ItemCodeDesc'] if (row['ItemCodeDesc'] and row['ItemCodeDesc'].strip()) else '(Not Specified)'
-                summary_by_item[item_desc]['revenue'] += revenue
-                excluded_keywords = ['freight', 'pallet', 'lease', 'dunnage', 'shipping', 'charge', 'fee', 'misc', 'covers', 'shrinkwrap']
-                if not any(keyword in item_desc.lower() for keyword in excluded_keywords):
-                    summary_by_item[item_desc]['tons_sold'] += quantity
-
-            sorted_summary = sorted(summary_by_item.items(), key=lambda item: item[1]['revenue'], reverse=True)
-            writer.writerow(['Item Description', 'Tons Sold', 'Revenue'])
-            for item, values in sorted_summary:
-                writer.writerow([item, values['tons_sold'], values['revenue']])
-
-        elif report_type == 'year':
-            summary_by_year = defaultdict(lambda: {'revenue': 0.0, 'tons_sold': 0.0})
-            for row in report_data:
-                try:
-                    order_date = datetime.strptime(row['OrderDate'], '%Y-%m-%d')
-                    year = order_date.year
-                    summary_by_year[year]['revenue'] += row['ExtensionAmt'] or 0.0
-                    excluded_keywords = ['freight', 'pallet', 'lease', 'dunnage', 'shipping', 'charge', 'fee', 'misc', 'covers', 'shrinkwrap']
-                    if not any(keyword in (row['ItemCodeDesc'] or "").lower() for keyword in excluded_keywords):
-                        summary_by_year[year]['tons_sold'] += row['QuantityShipped'] if row['QuantityShipped'] is not None else (row['QuantityOrdered'] or 0.0)
-                except (TypeError, ValueError):
-                    continue
-
-            sorted_summary = sorted(summary_by_year.items())
-            writer.writerow(['Year', 'Tons Sold', 'Revenue'])
-            for year, values in sorted_summary:
-                writer.writerow([year, values['tons_sold'], values['revenue']])
-
-        output.seek(0)
-        return Response(output, mimetype="text/csv", headers={"Content-Disposition": f"attachment;filename={filename}"})
-    except (ValueError, ConnectionError) as e:
+        # The connection is held until the last chunk is sent, and returned to the pool when the
+        # response is closed, including when the browser cancels the download.
+        with timed('db_acquire'): pooled = db_pool.acquire()
+        con = InstrumentedConnection(pooled)
+        try:
+            generation, modified_at = get_data_generation(con)
+            etag = make_etag('export_sales_report', report_type, start, end, compress, generation)
+            if not_modified(etag, modified_at):
+                db_pool.release(pooled)
+                return not_modified_response(etag, modified_at)
+            if report_type in SUMMARY_EXPORTS:
+                headers, columns, summary = SUMMARY_EXPORTS[report_type]
+                batches = [cached_report(con, generation, summary, start, end)]
+            elif report_type == 'detailed':
+                headers = columns = DETAILED_EXPORT_HEADERS
+                use_partitions(con, start, end)
+                batches = fetch_batches(con.execute(SALES_REPORT_SQL, (start, end)))
+            else:
+                headers, columns, batches = [], [], []
+        except BaseException:
+            db_pool.release(pooled)
+            raise
+
+        def stream():
+            try: yield from generate_csv(headers, columns, batches, compress=compress)
+            finally: db_pool.release(pooled)
+
+        response_headers = {"Content-Disposition": f"attachment;filename={filename}"}
+        if compress: response_headers.update({"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+        return with_validators(Response(stream(), mimetype="text/csv", headers=response_headers), etag, modified_at)
+    except (ValueError, ConnectionError, sqlite3.Error) as e:
         return f"Error exporting data: {e}", 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    # Table, route and source names and traffic volumes are not for anyone who can reach the port.
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not (is_unlocked() or (METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()))):
+        return Response("Authentication required.", status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/sales/detail')
+def api_sales_detail():
+    if not is_unlocked(): return jsonify({'error': 'Authentication required.'}), 401
+    args = request.args
+    try:
+        limit = min(max(int(args.get('limit', SALES_DETAIL_PAGE_SIZE)), 1), SALES_DETAIL_MAX_PAGE_SIZE)
+        after = decode_cursor(args.get('cursor'), 3)
+        for name in ('start_date', 'end_date'):
+            if not args.get(name): raise ValueError(f"{name} is required")
+            datetime.strptime(args[name], '%Y-%m-%d')
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f"Invalid request: {e}"}), 400
+    try:
+        page_args = dict(
+            start_date=args['start_date'], end_date=args['end_date'], after=after,
+            limit=limit, customer_no=args.get('customer_no') or None, item_code=args.get('item_code') or None,
+            descending=args.get('order', 'desc') != 'asc')
+        with db_connection() as con:
+            generation, modified_at = get_data_generation(con)
+            etag = make_etag('api_sales_detail', sorted(page_args.items()), generation)
+            if not_modified(etag, modified_at): return not_modified_response(etag, modified_at)
+            rows, next_key = cached_report(con, generation, get_sales_detail_page, **page_args)
+        return with_validators(jsonify({'rows': [dict(row) for row in rows], 'next_cursor': encode_cursor(next_key)}), etag, modified_at)
+    except (ValueError, ConnectionError) as e:
+        return jsonify({'error': f"Database Error: {e}"}), 500
+
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
     try:
-        with get_db_connection(session['db_password']) as con:
+        with db_connection() as con:
+            if request.method == 'POST' and 'exclusion_keywords' in request.form:
+                changed = set_exclusion_keywords(con, request.form['exclusion_keywords'].splitlines())
+                if changed: refresh_archive_rollups(con)
+                bump_data_generation(con)
+                flash(f"Tons-sold exclusion keywords saved; {changed} item(s) reclassified.", 'success')
+                return redirect(url_for('settings'))
             if request.method == 'POST':
                 job_id = request.form.get('job_id')
                 is_enabled = 1 if 'enabled' in request.form else 0
                 interval = int(request.form.get('interval_minutes', 1))
-                con.execute("UPDATE scheduler_jobs SET enabled = ?, interval_minutes = ? WHERE id = ?", (is_enabled, interval, job_id))
+                if interval < 1:
+                    flash("The schedule must be at least 1 minute.", 'error'); return redirect(url_for('settings'))
+                run_mode = 'subprocess' if request.form.get('run_mode') == 'subprocess' else 'inprocess'
+                con.execute("UPDATE scheduler_jobs SET enabled = ?, interval_minutes = ?, run_mode = ? WHERE id = ?", (is_enabled, interval, run_mode, job_id))
+                bump_scheduler_config_version(con)
                 con.commit()
-                flash(f"Job settings updated. Restart the application for changes to take effect.", 'success')
+                if scheduler.running:
+                    with _scheduler_lock: reconcile_scheduler(con)
+                    save_next_run_times(con)
+                    flash("Job settings updated.", 'success')
+                else: flash(f"Job settings updated; the scheduler applies them within {SCHEDULER_POLL_SECONDS} seconds.", 'success')
                 return redirect(url_for('settings'))
             jobs = con.execute("SELECT * FROM scheduler_jobs ORDER BY id").fetchall()
-            return render_template('settings.html', scheduler_jobs=jobs)
+            running = job_runner.running_ids() | {job['id'] for job in jobs if job['running_since']}
+            return render_template('settings.html', scheduler_jobs=jobs, running_jobs=running,
+                                   exclusion_keywords=get_exclusion_keywords(con))
     except (ValueError, ConnectionError) as e:
         flash(f"Database Error: {e}. Please log in again.", 'error'); return redirect(url_for('login'))
 
 @app.route('/scheduler/run_now/<int:job_id>', methods=['POST'])
 def run_now(job_id):
-    if 'db_password' not in session: return redirect(url_for('login'))
+    if not is_unlocked(): return redirect(url_for('login'))
     try:
-        with get_db_connection(session['db_password']) as con:
-            job = con.execute("SELECT script_path FROM scheduler_jobs WHERE id = ?", (job_id,)).fetchone()
-        if job:
-            scheduler.add_job(run_job, args=[job_id, job['script_path'], session['db_password']], id=f"manual_run_{job_id}_{time.time()}")
-            flash(f"Job '{job['script_path']}' triggered.", 'success')
-        else: flash(f"Job ID {job_id} not found.", 'error')
+        with db_connection() as con:
+            job = con.execute("SELECT script_path, run_mode FROM scheduler_jobs WHERE id = ?", (job_id,)).fetchone()
+            if job and not leader_lock.held:
+                # Another worker runs the scheduler; it picks the request up within SCHEDULER_POLL_SECONDS.
+                con.execute("UPDATE scheduler_jobs SET requested_action = 'run' WHERE id = ?", (job_id,))
+        if not job: flash(f"Job ID {job_id} not found.", 'error')
+        elif not leader_lock.held: flash(f"Job '{job['script_path']}' will start within {SCHEDULER_POLL_SECONDS} seconds.", 'success')
+        elif run_job(job_id, job['script_path'], job['run_mode']): flash(f"Job '{job['script_path']}' triggered.", 'success')
+        else: flash(f"Job '{job['script_path']}' is already running.", 'error')
     except Exception as e: flash(f"Failed to trigger job: {e}", 'error')
     return redirect(url_for('settings'))
 
+@app.route('/scheduler/cancel/<int:job_id>', methods=['POST'])
+def cancel_job(job_id):
+    if not is_unlocked(): return redirect(url_for('login'))
+    if job_runner.cancel(job_id): flash(f"Cancellation requested for job {job_id}; it stops at its next checkpoint.", 'success')
+    elif leader_lock.held: flash(f"Job {job_id} is not running.", 'error')
+    else:
+        try:
+            with db_connection() as con:
+                requested = con.execute("UPDATE scheduler_jobs SET requested_action = 'cancel' WHERE id = ? AND running_since IS NOT NULL", (job_id,)).rowcount
+            if requested: flash(f"Cancellation requested for job {job_id}; it stops at its next checkpoint.", 'success')
+            else: flash(f"Job {job_id} is not running.", 'error')
+        except (ValueError, ConnectionError) as e: flash(f"Database Error: {e}", 'error')
+    return redirect(url_for('settings'))
+
 @app.route('/scheduler/log/<int:job_id>')
 def get_log(job_id):
-    if 'db_password' not in session: return jsonify({'log': 'Authentication required.'}), 401
+    """The latest log of a job, as one JSON document. The Settings page follows logs with the stream below instead."""
+    if not is_unlocked(): return jsonify({'log': 'Authentication required.'}), 401
     try:
-        with get_db_connection(session['db_password']) as con:
-            log = con.execute("SELECT last_run_log FROM scheduler_jobs WHERE id = ?", (job_id,)).fetchone()
+        with db_connection() as con:
+            run = con.execute("SELECT log, log_head_bytes, log_bytes FROM job_runs WHERE job_id = ? AND log IS NOT NULL ORDER BY id DESC LIMIT 1", (job_id,)).fetchone()
+            if run:
+                data = zlib.decompress(run['log'])
+                return jsonify({'log': join_log(data[:run['log_head_bytes']], data[run['log_head_bytes']:], run['log_bytes']).decode('utf-8', errors='replace')})
+            log = con.execute("SELECT last_run_log FROM scheduler_jobs WHERE id = ?", (job_id,)).fetchone()  # Recorded before job_runs existed.
         return jsonify({'log': log['last_run_log'] if log and log['last_run_log'] else 'No log found.'})
     except (ValueError, ConnectionError):
         return jsonify({'log': 'Error: Could not access database.'}), 500
 
+@app.route('/scheduler/log/<int:job_id>/stream')
+def stream_job_log(job_id):
+    """
+    Server-Sent Events: the output of a job's latest run (or of run `run`) from byte `offset` on, while it
+    is written. Each event's id is the offset after it, so a reconnecting browser resumes where it left off.
+    An 'end' event with the run's status closes the stream once the run has finished.
+    """
+    if not is_unlocked(): return Response("Authentication required.", status=401)
+    run_id = request.args.get('run', type=int)
+    offset = request.headers.get('Last-Event-ID', type=int) or request.args.get('offset', 0, type=int)
+
+    def events(run_id, offset):
+        started = time.monotonic()
+        yield "retry: 3000\n\n"
+        while time.monotonic() - started < JOB_LOG_STREAM_MAX_AGE:
+            try:
+                with db_connection() as con:
+                    run = con.execute(f"""SELECT id, started_at, finished_at, duration_seconds, status FROM job_runs
+                                          WHERE {'id = ? AND job_id = ?' if run_id else 'job_id = ?'} ORDER BY id DESC LIMIT 1""",
+                                      (run_id, job_id) if run_id else (job_id,)).fetchone()
+                    if run is None:
+                        yield f"event: end\ndata: {json.dumps({'status': None})}\n\n"; return
+                    start, data = read_run_log(con, run, offset)
+            except (ValueError, ConnectionError, sqlite3.Error) as e:
+                yield f"event: error\ndata: {json.dumps(str(e))}\n\n"; return
+            if run_id is None:
+                run_id = run['id']
+                yield f"event: run\ndata: {json.dumps({'run': run_id, 'started_at': run['started_at']})}\n\n"
+            if data:
+                text = data.decode('utf-8', errors='replace')
+                if start > offset: text = f"\n[... {start - offset:,} bytes of output omitted ...]\n" + text
+                offset = start + len(data)
+                yield f"id: {offset}\ndata: {json.dumps(text)}\n\n"
+            if run['status'] != 'Running':
+                yield f"event: end\ndata: {json.dumps({key: run[key] for key in ('status', 'finished_at', 'duration_seconds')})}\n\n"; return
+            if not data: yield ": keep-alive\n\n"
+            time.sleep(JOB_LOG_STREAM_POLL)
+
+    return event_stream(events(run_id, offset))
+
+@app.route('/scheduler/history/<int:job_id>')
+def job_history(job_id):
+    """A job's recent runs: duration trend, status and row counts."""
+    if not is_unlocked(): return redirect(url_for('login'))
+    try:
+        with db_connection() as con:
+            job = con.execute("SELECT id, job_name FROM scheduler_jobs WHERE id = ?", (job_id,)).fetchone()
+            if not job: return "Job not found", 404
+            runs = con.execute("""SELECT id, started_at, finished_at, duration_seconds, status, rows_fetched, rows_inserted, rows_updated,
+                                         log IS NOT NULL AS has_log, log_bytes
+                                  FROM job_runs WHERE job_id = ? ORDER BY id DESC LIMIT ?""", (job_id, JOB_HISTORY_RUNS)).fetchall()
+        return render_template('job_history.html', job=job, runs=runs)
+    except (ValueError, ConnectionError) as e:
+        flash(f"Database Error: {e}", 'error'); return redirect(url_for('login'))
+
 if __name__ == '__main__':
     if not (os.path.exists('cert.pem') and os.path.exists('key.pem')):
         sys.exit("Error: SSL certificate not found. Run 'python generate_cert.py' first.")
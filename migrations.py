@@ -0,0 +1,228 @@
+import os
+import sys
+import getpass
+import argparse
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+DB_FILE = "operations_dashboard.db"
+
+# Ordered schema changes applied on top of the schema init_db.py creates (version 0). Each entry is
+# (version, description, statements); a step runs in its own transaction together with the bump of
+# 'schema_version' in config, so a database is never left half-way through a step. Never edit or
+# reorder a released step - append a new one.
+MIGRATIONS = [
+    (1, "Index sales report date filter and joins", [
+        # Serves the OrderDate range filter and its ORDER BY OrderDate DESC, SalesOrderNo DESC without a sort.
+        "CREATE INDEX IF NOT EXISTS idx_SalesOrderHeader_OrderDate ON SalesOrderHeader (OrderDate, SalesOrderNo, CustomerNo)",
+        "CREATE INDEX IF NOT EXISTS idx_SalesOrderHeader_CustomerNo ON SalesOrderHeader (CustomerNo)",
+        "CREATE INDEX IF NOT EXISTS idx_SalesOrderDetail_ItemCode ON SalesOrderDetail (ItemCode)",
+    ]),
+    (2, "Covering index for the recent sieve tests list", [
+        "CREATE INDEX IF NOT EXISTS idx_SieveTest_Date ON SieveTest (SieveTestDate, SieveTestID, SampleID, CarorTruckNumber)",
+    ]),
+    (3, "Per-job choice between in-process and subprocess execution", [
+        "ALTER TABLE scheduler_jobs ADD COLUMN run_mode TEXT NOT NULL DEFAULT 'inprocess' CHECK (run_mode IN ('inprocess', 'subprocess'))",
+    ]),
+    (4, "Content hashes of synced rows, for skipping unchanged rows", [
+        # pk is the JSON list of a row's primary key values; hash is 8 bytes of BLAKE2b over the row.
+        "CREATE TABLE IF NOT EXISTS sync_row_hash (table_name TEXT NOT NULL, pk TEXT NOT NULL, hash INTEGER NOT NULL, PRIMARY KEY (table_name, pk)) WITHOUT ROWID",
+    ]),
+    (5, "Daily sales rollup for the sales summaries", [
+        """CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+            day TEXT NOT NULL, ItemCode TEXT NOT NULL, CustomerNo TEXT NOT NULL, item TEXT NOT NULL,
+            revenue REAL NOT NULL, tons REAL NOT NULL, line_count INTEGER NOT NULL,
+            PRIMARY KEY (day, ItemCode, CustomerNo, item)
+        ) WITHOUT ROWID""",
+        "CREATE TABLE IF NOT EXISTS sales_rollup_dirty (day TEXT PRIMARY KEY) WITHOUT ROWID",
+        # Queue every existing order date; the first refresh_rollup() after the upgrade builds the rollup.
+        "INSERT OR IGNORE INTO sales_rollup_dirty (day) SELECT DISTINCT OrderDate FROM SalesOrderHeader WHERE OrderDate IS NOT NULL",
+    ]),
+    (6, "Item classification for the tons-sold exclusion rule", [
+        "CREATE TABLE IF NOT EXISTS item_class_rule (keyword TEXT PRIMARY KEY)",
+        # The keywords that were hard-coded until now, so tons sold do not change with the upgrade.
+        """INSERT OR IGNORE INTO item_class_rule (keyword) VALUES ('freight'), ('pallet'), ('lease'), ('dunnage'),
+            ('shipping'), ('charge'), ('fee'), ('misc'), ('covers'), ('shrinkwrap')""",
+        """CREATE TABLE IF NOT EXISTS item_class (
+            ItemCode TEXT NOT NULL, ItemCodeDesc TEXT NOT NULL, excluded INTEGER NOT NULL,
+            PRIMARY KEY (ItemCode, ItemCodeDesc)
+        ) WITHOUT ROWID""",
+        """INSERT OR IGNORE INTO item_class (ItemCode, ItemCodeDesc, excluded)
+            SELECT ItemCode, ItemCodeDesc, EXISTS (SELECT 1 FROM item_class_rule AS r WHERE instr(lower(ItemCodeDesc), lower(r.keyword)) > 0)
+            FROM (SELECT DISTINCT COALESCE(ItemCode, '') AS ItemCode, COALESCE(ItemCodeDesc, '') AS ItemCodeDesc FROM SalesOrderDetail)""",
+    ]),
+    (7, "Ops dashboards: event index, rollups and widget definitions", [
+        "CREATE INDEX IF NOT EXISTS idx_OPEvent_Operation_Time ON OPEvent (OpEventItemOperationID, OPEventTime)",
+        # Filled by the trigger ops_events.ensure_event_rollups() installs, which depends on the shift settings.
+        """CREATE TABLE IF NOT EXISTS opevent_rollup (
+            bucket_size TEXT NOT NULL CHECK (bucket_size IN ('minute', 'hour', 'shift')), operation_id INTEGER NOT NULL,
+            bucket_start TEXT NOT NULL, event_count INTEGER NOT NULL, value_sum REAL NOT NULL, value_min REAL NOT NULL,
+            value_max REAL NOT NULL, last_time TEXT NOT NULL, last_value REAL NOT NULL,
+            PRIMARY KEY (bucket_size, operation_id, bucket_start)
+        ) WITHOUT ROWID""",
+        "CREATE TABLE IF NOT EXISTS ops_dashboard (name TEXT PRIMARY KEY, title TEXT NOT NULL, position INTEGER NOT NULL)",
+        """INSERT OR IGNORE INTO ops_dashboard (name, title, position) VALUES ('east', 'East Operations', 1),
+            ('west_dry', 'West Dry Operations', 2), ('west_wet', 'West Wet Operations', 3), ('west_ball', 'West Ball Mill', 4)""",
+        """CREATE TABLE IF NOT EXISTS ops_widget (
+            widget_id INTEGER PRIMARY KEY AUTOINCREMENT, dashboard TEXT NOT NULL REFERENCES ops_dashboard (name),
+            position INTEGER NOT NULL, title TEXT NOT NULL, operation_id INTEGER NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('latest', 'shift_total', 'shift_average', 'trend')),
+            window_minutes INTEGER NOT NULL DEFAULT 240, unit TEXT
+        )""",
+    ]),
+    (8, "Plant sources and delivered batch ids for OPEvent ingestion", [
+        """CREATE TABLE IF NOT EXISTS ops_ingest_source (
+            name TEXT PRIMARY KEY, token_hash TEXT NOT NULL UNIQUE, created_at TEXT NOT NULL,
+            last_batch_at TEXT, events_total INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS ops_ingest_batch (
+            source TEXT NOT NULL, batch_id TEXT NOT NULL, received_at TEXT NOT NULL,
+            accepted INTEGER NOT NULL, rejected INTEGER NOT NULL, PRIMARY KEY (source, batch_id)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_ops_ingest_batch_received ON ops_ingest_batch (received_at)",
+    ]),
+    (9, "Cached sieve test results and the product trend index", [
+        # NULL until sieve_analysis.refresh_stored_results() computes it, at the first login after the upgrade.
+        "ALTER TABLE SieveTest ADD COLUMN OutOfSpec INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_SieveTest_Sample_Date ON SieveTest (SampleID, SieveTestDate, SieveTestID)",
+    ]),
+    (10, "Full-text index over sieve tests, kept in sync by triggers", [
+        # One row per test (rowid = SieveTestID). Prefix indexes make 'BOL12*'-style searches an index lookup.
+        """CREATE VIRTUAL TABLE IF NOT EXISTS sieve_test_fts USING fts5 (
+            bill_of_lading, car_truck, product, tokenize = 'unicode61', prefix = '2 3 4'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS sieve_test_fts_insert AFTER INSERT ON SieveTest BEGIN
+            INSERT INTO sieve_test_fts (rowid, bill_of_lading, car_truck, product)
+            VALUES (NEW.SieveTestID, NEW.BillofLading, NEW.CarorTruckNumber, (SELECT Name FROM Sample WHERE SampleID = NEW.SampleID));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS sieve_test_fts_update AFTER UPDATE OF SieveTestID, BillofLading, CarorTruckNumber, SampleID ON SieveTest BEGIN
+            DELETE FROM sieve_test_fts WHERE rowid = OLD.SieveTestID;
+            INSERT INTO sieve_test_fts (rowid, bill_of_lading, car_truck, product)
+            VALUES (NEW.SieveTestID, NEW.BillofLading, NEW.CarorTruckNumber, (SELECT Name FROM Sample WHERE SampleID = NEW.SampleID));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS sieve_test_fts_delete AFTER DELETE ON SieveTest BEGIN
+            DELETE FROM sieve_test_fts WHERE rowid = OLD.SieveTestID;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS sieve_test_fts_sample AFTER UPDATE OF Name ON Sample BEGIN
+            UPDATE sieve_test_fts SET product = NEW.Name WHERE rowid IN (SELECT SieveTestID FROM SieveTest WHERE SampleID = NEW.SampleID);
+        END""",
+        """INSERT INTO sieve_test_fts (rowid, bill_of_lading, car_truck, product)
+            SELECT st.SieveTestID, st.BillofLading, st.CarorTruckNumber, s.Name FROM SieveTest AS st LEFT JOIN Sample AS s ON s.SampleID = st.SampleID""",
+    ]),
+    (11, "Rejection reports of sieve test imports", [
+        # The zlib-compressed CSV of rows an upload rejected, kept a few days for download.
+        """CREATE TABLE IF NOT EXISTS sieve_import_report (
+            token TEXT PRIMARY KEY, filename TEXT, created_at TEXT NOT NULL, rejected INTEGER NOT NULL, report BLOB NOT NULL
+        )""",
+    ]),
+    (12, "Scheduler job state shared between server workers", [
+        # A worker that does not own the scheduler asks the one that does to run or cancel a job.
+        "ALTER TABLE scheduler_jobs ADD COLUMN requested_action TEXT CHECK (requested_action IN ('run', 'cancel'))",
+        "ALTER TABLE scheduler_jobs ADD COLUMN running_since TEXT",
+    ]),
+    (13, "Next scheduled run of each job, for the Settings page", [
+        "ALTER TABLE scheduler_jobs ADD COLUMN next_run_at TEXT",
+    ]),
+    (14, "Job run history with compressed logs", [
+        # log is the zlib-compressed head and tail of the output: its first log_head_bytes bytes are the start,
+        # the rest is the end, and log_bytes is how much was written in all.
+        """CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, job_id INTEGER NOT NULL, started_at TEXT NOT NULL, finished_at TEXT,
+            duration_seconds REAL, status TEXT NOT NULL, rows_fetched INTEGER, rows_inserted INTEGER, rows_updated INTEGER,
+            log BLOB, log_head_bytes INTEGER, log_bytes INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job_id, id)",
+        # Output of running jobs, copied every second so any worker can stream it; deleted when the run ends.
+        "CREATE TABLE IF NOT EXISTS job_run_chunks (run_id INTEGER NOT NULL, start_offset INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (run_id, start_offset))",
+    ]),
+    (15, "Yearly archives of closed fiscal years of sales history", [
+        # One encrypted database file per archived fiscal year, holding its SalesOrderHeader and SalesOrderDetail
+        # rows; OrderDate >= start_date AND OrderDate < end_before selects the year.
+        """CREATE TABLE IF NOT EXISTS sales_archive (
+            fiscal_year INTEGER PRIMARY KEY, path TEXT NOT NULL, start_date TEXT NOT NULL, end_before TEXT NOT NULL,
+            orders INTEGER NOT NULL, lines INTEGER NOT NULL, archived_at TEXT NOT NULL
+        )""",
+        # The invoices that live in an archive, so the sync does not bring them back into the hot tables.
+        "CREATE TABLE IF NOT EXISTS sales_archive_order (SalesOrderNo TEXT PRIMARY KEY, fiscal_year INTEGER NOT NULL) WITHOUT ROWID",
+        """CREATE TABLE IF NOT EXISTS sales_archive_rollup (
+            day TEXT NOT NULL, ItemCode TEXT NOT NULL, CustomerNo TEXT NOT NULL, item TEXT NOT NULL,
+            revenue REAL NOT NULL, tons REAL NOT NULL, line_count INTEGER NOT NULL,
+            PRIMARY KEY (day, ItemCode, CustomerNo, item)
+        ) WITHOUT ROWID""",
+        """CREATE VIEW IF NOT EXISTS sales_rollup AS
+            SELECT day, ItemCode, CustomerNo, item, revenue, tons, line_count FROM sales_daily_rollup
+            UNION ALL SELECT day, ItemCode, CustomerNo, item, revenue, tons, line_count FROM sales_archive_rollup""",
+    ]),
+]
+
+def get_schema_version(con):
+    row = con.execute("SELECT value FROM config WHERE key = 'schema_version'").fetchone()
+    return int(row[0]) if row else 0
+
+def apply_migrations(con, verbose=True):
+    """Brings the database up to the latest schema version. Returns the versions that were applied."""
+    current = get_schema_version(con)
+    latest = MIGRATIONS[-1][0] if MIGRATIONS else 0
+    if current > latest:
+        print(f"WARNING: Database schema version {current} is newer than this code knows about ({latest}).", file=sys.stderr)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current: continue
+        if verbose: print(f"MIGRATION: Applying schema version {version}: {description}")
+        try:
+            # DDL does not open a transaction implicitly, so start one to make the step atomic.
+            con.execute("BEGIN")
+            for statement in statements: con.execute(statement)
+            con.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('schema_version', ?)", (str(version),))
+            con.commit()
+        except sqlite3.Error:
+            con.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+def find_full_scans(con, sql, params=()):
+    """Runs EXPLAIN QUERY PLAN for a query and returns the plan steps that scan a whole table without an index."""
+    plan = con.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[3] for row in plan if row[3].startswith("SCAN") and "USING" not in row[3]]
+
+def check_query_plans(con):
+    # Imported here so the migration runner itself does not depend on Flask.
+    from main import SALES_REPORT_SQL, RECENT_SIEVE_TESTS_SQL
+    from sales_archive import use_partitions
+    use_partitions(con, '2000-01-01', '2000-12-31')
+    checks = [
+        ("sales report", SALES_REPORT_SQL, ('2000-01-01', '2000-12-31')),
+        ("recent sieve tests", RECENT_SIEVE_TESTS_SQL, ()),
+    ]
+    ok = True
+    for name, sql, params in checks:
+        scans = find_full_scans(con, sql, params)
+        print(f"{'FAIL' if scans else 'OK'}: {name}" + (f" - full scans: {', '.join(scans)}" if scans else ""))
+        ok = ok and not scans
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations to the encrypted database.")
+    parser.add_argument("--check-plans", action="store_true", help="Afterwards, verify the report queries do not full-scan any table.")
+    args = parser.parse_args()
+    if not os.path.exists(DB_FILE): sys.exit(f"FATAL: Database file '{DB_FILE}' not found. Please run init_db.py first.")
+    password = os.environ.get('DB_MASTER_PASSWORD') or getpass.getpass("Please enter the database master password: ")
+    con = sqlite3.connect(DB_FILE)
+    try:
+        con.execute(f"PRAGMA key = '{password}';")
+        print(f"Schema version before: {get_schema_version(con)}")
+        applied = apply_migrations(con)
+        print(f"Schema version after: {get_schema_version(con)} ({len(applied)} migration(s) applied)")
+        if args.check_plans and not check_query_plans(con): sys.exit(1)
+    except sqlite3.Error as e:
+        sys.exit(f"FATAL: Migration failed. Is the password correct? Error: {e}")
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
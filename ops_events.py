@@ -0,0 +1,204 @@
+import os
+import sys
+import math
+import getpass
+import argparse
+from datetime import datetime, timedelta
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+# Time-series engine over OPEvent. Every inserted event is folded by a trigger into opevent_rollup,
+# which holds count, sum, min, max and the latest value per operation for each minute, hour and shift,
+# so dashboards read a few rollup rows instead of scanning years of raw events.
+
+DB_FILE = "operations_dashboard.db"
+# Shifts start at this hour and last this many hours; override with 'ops_shift_start_hour' and
+# 'ops_shift_hours' in config. A change is picked up at the next login and rebuilds the shift rollup.
+SHIFT_START_HOUR, SHIFT_HOURS = 6, 12
+# Most points a trend series returns; longer ranges are read from coarser buckets and merged further.
+MAX_SERIES_POINTS = 500
+WIDGET_KINDS = ('latest', 'shift_total', 'shift_average', 'trend')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def bucket_sql(size, shift_start_hour=SHIFT_START_HOUR, shift_hours=SHIFT_HOURS, column='NEW.OPEventTime'):
+    """SQL for the start of the bucket an event time falls in, as 'YYYY-MM-DD HH:MM:SS'."""
+    if size == 'minute': return f"strftime('%Y-%m-%d %H:%M:00', {column})"
+    if size == 'hour': return f"strftime('%Y-%m-%d %H:00:00', {column})"
+    # Shifts restart at the start hour every day, like current_shift_start(), so when the hours do not
+    # divide 24 the day's last shift is cut short instead of drifting across days.
+    seconds = f"CAST(strftime('%s', {column}) AS INTEGER)"
+    anchor = f"CAST(strftime('%s', {column}, '-{shift_start_hour} hours', 'start of day', '+{shift_start_hour} hours') AS INTEGER)"
+    return f"datetime({seconds} - ({seconds} - {anchor}) % {shift_hours * 3600}, 'unixepoch')"
+
+def shift_settings(con):
+    rows = dict(con.execute("SELECT key, value FROM config WHERE key IN ('ops_shift_start_hour', 'ops_shift_hours')").fetchall())
+    start, hours = int(rows.get('ops_shift_start_hour', SHIFT_START_HOUR)), int(rows.get('ops_shift_hours', SHIFT_HOURS))
+    if not (0 <= start < 24 and 0 < hours <= 24): raise ValueError(f"Invalid shift settings: start hour {start}, {hours} hours.")
+    return start, hours
+
+def current_shift_start(now, shift_start_hour, shift_hours):
+    anchor = now.replace(hour=shift_start_hour, minute=0, second=0, microsecond=0)
+    if anchor > now: anchor -= timedelta(days=1)
+    return anchor + timedelta(hours=shift_hours * ((now - anchor) // timedelta(hours=shift_hours)))
+
+def _trigger_sql(shift_start_hour, shift_hours):
+    upserts = "".join(f"""
+        INSERT INTO opevent_rollup (bucket_size, operation_id, bucket_start, event_count, value_sum, value_min, value_max, last_time, last_value)
+        VALUES ('{size}', NEW.OpEventItemOperationID, {bucket_sql(size, shift_start_hour, shift_hours)}, 1,
+                NEW.OpEventNumber, NEW.OpEventNumber, NEW.OpEventNumber, NEW.OPEventTime, NEW.OpEventNumber)
+        ON CONFLICT (bucket_size, operation_id, bucket_start) DO UPDATE SET
+            event_count = event_count + 1, value_sum = value_sum + excluded.value_sum,
+            value_min = min(value_min, excluded.value_min), value_max = max(value_max, excluded.value_max),
+            last_value = CASE WHEN excluded.last_time >= last_time THEN excluded.last_value ELSE last_value END,
+            last_time = max(last_time, excluded.last_time);""" for size in ('minute', 'hour', 'shift'))
+    return f"CREATE TRIGGER opevent_rollup_insert AFTER INSERT ON OPEvent BEGIN{upserts}\nEND"
+
+def rebuild_event_rollups(con, shift_start_hour=None, shift_hours=None):
+    """Recomputes every rollup bucket from OPEvent, e.g. after events were corrected or deleted. Runs in the caller's transaction."""
+    if shift_start_hour is None: shift_start_hour, shift_hours = shift_settings(con)
+    con.execute("DELETE FROM opevent_rollup")
+    for size in ('minute', 'hour', 'shift'):
+        bucket = bucket_sql(size, shift_start_hour, shift_hours, column='e.OPEventTime')
+        con.execute(f"""
+            INSERT INTO opevent_rollup (bucket_size, operation_id, bucket_start, event_count, value_sum, value_min, value_max, last_time, last_value)
+            SELECT '{size}', operation_id, bucket_start, event_count, value_sum, value_min, value_max, last_time,
+                   (SELECT l.OpEventNumber FROM OPEvent AS l WHERE l.OpEventItemOperationID = operation_id AND l.OPEventTime = last_time
+                    ORDER BY l.OpEventID DESC LIMIT 1)
+            FROM (SELECT e.OpEventItemOperationID AS operation_id, {bucket} AS bucket_start, COUNT(*) AS event_count,
+                         TOTAL(e.OpEventNumber) AS value_sum, MIN(e.OpEventNumber) AS value_min, MAX(e.OpEventNumber) AS value_max,
+                         MAX(e.OPEventTime) AS last_time
+                  FROM OPEvent AS e WHERE {bucket} IS NOT NULL GROUP BY 1, 2)
+        """)
+
+def ensure_event_rollups(con):
+    """
+    Installs the rollup trigger for the configured shifts, rebuilding the rollup when the trigger is new
+    or the shift settings changed. Returns True if it rebuilt. Cheap when nothing changed.
+    """
+    start, hours = shift_settings(con)
+    signature = f"{start}:{hours}:daily"  # The suffix marks day-anchored shift buckets; older rollups are rebuilt.
+    installed = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'opevent_rollup_insert'").fetchone()
+    stored = con.execute("SELECT value FROM config WHERE key = 'ops_rollup_signature'").fetchone()
+    if installed and stored and stored[0] == signature: return False
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("DROP TRIGGER IF EXISTS opevent_rollup_insert")
+        con.execute(_trigger_sql(start, hours))
+        rebuild_event_rollups(con, start, hours)
+        con.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('ops_rollup_signature', ?)", (signature,))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    return True
+
+def get_event_generation(con):
+    """Changes whenever an event is inserted; lets the live stream skip recomputing idle dashboards."""
+    return con.execute("SELECT MAX(OpEventID) FROM OPEvent").fetchone()[0]
+
+def get_series(con, operation_id, start, end, max_points=MAX_SERIES_POINTS, shift_hours=SHIFT_HOURS):
+    """
+    Average/min/max/count points for an operation between two datetimes. Reads the finest bucket size
+    that fits in `max_points` and merges buckets further if the range still has too many.
+    """
+    span = max((end - start).total_seconds(), 60)
+    for size, seconds in (('minute', 60), ('hour', 3600), ('shift', shift_hours * 3600)):
+        if span / seconds <= max_points: break
+    step = max(seconds, math.ceil(span / max_points / seconds) * seconds)
+    rows = con.execute("""
+        SELECT MIN(bucket_start) AS t, TOTAL(value_sum) / SUM(event_count) AS avg, MIN(value_min) AS min, MAX(value_max) AS max,
+               SUM(event_count) AS count
+        FROM opevent_rollup WHERE bucket_size = ? AND operation_id = ? AND bucket_start >= ? AND bucket_start < ?
+        GROUP BY CAST(strftime('%s', bucket_start) AS INTEGER) / ? ORDER BY t
+    """, (size, operation_id, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT), step)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_dashboard(con, name):
+    return con.execute("SELECT name, title FROM ops_dashboard WHERE name = ?", (name,)).fetchone()
+
+def get_widgets(con, dashboard):
+    return con.execute("SELECT * FROM ops_widget WHERE dashboard = ? ORDER BY position, widget_id", (dashboard,)).fetchall()
+
+def get_widget_values(con, dashboard, now=None):
+    """Current value of every widget on a dashboard, read from the rollup only."""
+    now = now or datetime.now()
+    shift_start_hour, shift_hours = shift_settings(con)
+    shift_start = current_shift_start(now, shift_start_hour, shift_hours).strftime(TIME_FORMAT)
+    values = []
+    for widget in get_widgets(con, dashboard):
+        value = {'id': widget['widget_id'], 'title': widget['title'], 'kind': widget['kind'], 'unit': widget['unit'] or '', 'value': None, 'as_of': None}
+        if widget['kind'] == 'latest':
+            row = con.execute("""SELECT last_value, last_time FROM opevent_rollup WHERE bucket_size = 'minute' AND operation_id = ?
+                                 ORDER BY bucket_start DESC LIMIT 1""", (widget['operation_id'],)).fetchone()
+            if row: value.update(value=row['last_value'], as_of=row['last_time'])
+        elif widget['kind'] in ('shift_total', 'shift_average'):
+            row = con.execute("""SELECT value_sum, event_count, last_time FROM opevent_rollup
+                                 WHERE bucket_size = 'shift' AND operation_id = ? AND bucket_start = ?""", (widget['operation_id'], shift_start)).fetchone()
+            if row: value.update(value=row['value_sum'] if widget['kind'] == 'shift_total' else row['value_sum'] / row['event_count'], as_of=row['last_time'])
+        else:
+            value['points'] = get_series(con, widget['operation_id'], now - timedelta(minutes=widget['window_minutes']), now, shift_hours=shift_hours)
+        values.append(value)
+    return values
+
+def add_widget(con, dashboard, title, operation_id, kind, window_minutes=240, unit=None, position=None):
+    if kind not in WIDGET_KINDS: raise ValueError(f"Unknown widget kind '{kind}'. Use one of: {', '.join(WIDGET_KINDS)}.")
+    if not get_dashboard(con, dashboard): raise ValueError(f"Unknown dashboard '{dashboard}'.")
+    if position is None: position = con.execute("SELECT COALESCE(MAX(position), 0) + 1 FROM ops_widget WHERE dashboard = ?", (dashboard,)).fetchone()[0]
+    cur = con.execute("INSERT INTO ops_widget (dashboard, position, title, operation_id, kind, window_minutes, unit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (dashboard, position, title, operation_id, kind, window_minutes, unit))
+    return cur.lastrowid
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the ops dashboards' widgets and event rollups.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="List dashboards and their widgets.")
+    add = commands.add_parser('add-widget', help="Add a widget to a dashboard.")
+    add.add_argument('--dashboard', required=True)
+    add.add_argument('--title', required=True)
+    add.add_argument('--operation', type=int, required=True, help="OpEventItemOperationID whose events the widget shows.")
+    add.add_argument('--kind', choices=WIDGET_KINDS, default='latest')
+    add.add_argument('--window-minutes', type=int, default=240, help="Time range of a trend widget.")
+    add.add_argument('--unit')
+    remove = commands.add_parser('remove-widget', help="Remove a widget by id.")
+    remove.add_argument('widget_id', type=int)
+    commands.add_parser('rebuild', help="Recompute the event rollups from OPEvent.")
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_FILE): sys.exit(f"FATAL: Database file '{DB_FILE}' not found. Please run init_db.py first.")
+    password = os.environ.get('DB_MASTER_PASSWORD') or getpass.getpass("Please enter the database master password: ")
+    con = sqlite3.connect(DB_FILE)
+    con.row_factory = sqlite3.Row
+    try:
+        con.execute(f"PRAGMA key = '{password}';")
+        from migrations import apply_migrations
+        apply_migrations(con)
+        ensure_event_rollups(con)
+        if args.command == 'list':
+            for dash in con.execute("SELECT name, title FROM ops_dashboard ORDER BY position"):
+                print(f"{dash['name']}: {dash['title']}")
+                for w in get_widgets(con, dash['name']):
+                    print(f"  [{w['widget_id']}] {w['title']} - {w['kind']} of operation {w['operation_id']}" + (f" over {w['window_minutes']} min" if w['kind'] == 'trend' else ""))
+        elif args.command == 'add-widget':
+            widget_id = add_widget(con, args.dashboard, args.title, args.operation, args.kind, args.window_minutes, args.unit)
+            con.commit()
+            print(f"SUCCESS: Added widget {widget_id} to '{args.dashboard}'.")
+        elif args.command == 'remove-widget':
+            removed = con.execute("DELETE FROM ops_widget WHERE widget_id = ?", (args.widget_id,)).rowcount
+            con.commit()
+            print(f"SUCCESS: Removed widget {args.widget_id}." if removed else f"ERROR: No widget {args.widget_id}.")
+        elif args.command == 'rebuild':
+            con.execute("BEGIN IMMEDIATE")
+            rebuild_event_rollups(con)
+            con.commit()
+            print("SUCCESS: Rebuilt the event rollups.")
+    except (sqlite3.Error, ValueError) as e:
+        sys.exit(f"FATAL: {e}")
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
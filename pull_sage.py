@@ -1,8 +1,17 @@
 import os
+import re
+import json
+import hashlib
+import time
 import sys
 import getpass
+import argparse
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pyodbc
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from decimal import Decimal
 
 try:
@@ -11,6 +20,13 @@ except ImportError:
     print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
     sys.exit(1)
 
+from migrations import apply_migrations
+from report_cache import bump_data_generation
+from db_pool import configure_connection
+from instrumentation import metrics
+from sales_summary import mark_rollup_days, refresh_rollup, rebuild_rollup, classify_items, ROLLUP_TABLES
+from sales_archive import drop_archived_rows
+
 DB_FILE = "operations_dashboard.db"
 TABLE_MAPPINGS = [
     ("AR_Customer", "Customer", {"CustomerNo": "CustomerNo", "CustomerName": "CustomerName"}, "CustomerNo"),
@@ -44,6 +60,21 @@ TABLE_MAPPINGS = [
         ("SalesOrderNo", "LineKey")
     ),
 ]
+# Sage column used as the high-water mark for delta syncs, keyed by local table. Tables not listed here are
+# always reloaded in full. Override per table with a 'sync_watermark_column:<local table>' row in config.
+WATERMARK_COLUMNS = {"SalesOrderHeader": "InvoiceNo", "SalesOrderDetail": "InvoiceNo"}
+FULL_RECONCILE_DAYS = 7
+# Rows per Sage fetchmany() call (override with 'sync_batch_size' in config) and converted batches held in memory.
+SYNC_BATCH_SIZE = 5000
+SYNC_QUEUE_DEPTH = 4
+# Stored row hashes looked up per query when checking a batch for changes (kept under SQLite's variable limit).
+HASH_LOOKUP_CHUNK = 500
+# Tables that must sync successfully before a table starts, keyed by local table: headers reference customers
+# and detail lines reference items. Anything else runs in parallel, up to 'sync_workers' (config) at once.
+SYNC_DEPENDENCIES = {"SalesOrderHeader": ("Customer",), "SalesOrderDetail": ("CI_Item",)}
+SYNC_WORKERS = 2
+# WAL checkpoint run after a sync ('sync_checkpoint_mode' in config): PASSIVE never waits for readers; NONE skips it.
+SYNC_CHECKPOINT_MODE = "PASSIVE"
 
 def get_db_password():
     password = os.environ.get('DB_MASTER_PASSWORD')
@@ -56,13 +87,15 @@ def get_local_db_connection(password):
         sys.exit(f"FATAL: Database file '{DB_FILE}' not found. Please run init_db.py first.")
     if not password: sys.exit("FATAL: A database master password is required to connect.")
     try:
-        con = sqlite3.connect(DB_FILE, timeout=10)
+        # The connection is handed to the sync's local writer thread.
+        con = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False)
         con.row_factory = sqlite3.Row
         cur = con.cursor()
         cur.execute(f"PRAGMA key = '{password}';")
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' LIMIT 1;")
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' LIMIT 1;").fetchone()
+        configure_connection(con)
         return con
-    except sqlite3.Error as e:
+    except (sqlite3.Error, ValueError) as e:
         sys.exit(f"FATAL: Failed to connect to local database '{DB_FILE}'. Is the password correct? Error: {e}")
 
 def get_sage_creds_and_config(local_db_con):
@@ -81,80 +114,414 @@ def get_sage_creds_and_config(local_db_con):
     except sqlite3.Error as e:
         sys.exit(f"FATAL: Could not read credentials/config from the local database. Error: {e}")
 
+def connect_sage(config):
+    cnxn_str = f"DSN={config['sage_dsn']};UID={config['username']};PWD={config['password']};Company={config['sage_company_code']}"
+    return pyodbc.connect(cnxn_str, autocommit=True, readonly=True)
+
 def get_sage_connection(config):
     print(f"DEBUG: Attempting to connect to Sage 100 (DSN: {config['sage_dsn']}, User: {config['username']})...")
     try:
-        cnxn_str = f"DSN={config['sage_dsn']};UID={config['username']};PWD={config['password']};Company={config['sage_company_code']}"
-        cnxn = pyodbc.connect(cnxn_str, autocommit=True, readonly=True)
+        cnxn = connect_sage(config)
         print("DEBUG: Successfully connected to Sage 100 in read-only mode.")
         return cnxn
     except pyodbc.Error as ex:
         sys.exit(f"FATAL: Sage 100 connection failed: {ex}")
 
-def sync_table(sage_cursor, local_db_con, sage_table, local_table, column_map, pk_cols):
-    print(f"\n--- Starting sync for {sage_table} -> {local_table} ---")
-    sage_cols_str = ", ".join(f'"{k}"' for k in column_map.keys())
-    query = f"SELECT {sage_cols_str} FROM {sage_table}"
-    print(f"DEBUG: Executing Sage query: {query}")
+def load_config(local_db_con):
+    # Read once up front so extract threads never touch the local connection, which belongs to the writer.
+    return {row['key']: row['value'] for row in local_db_con.execute("SELECT key, value FROM config")}
+
+def set_config_value(local_db_con, key, value):
+    local_db_con.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, str(value)))
+
+def needs_full_reconcile(config, local_table):
+    """A delta-synced table gets a full reload when it has never had one or the last one is older than the reconcile interval."""
+    last_full = config.get(f"sync_last_full:{local_table}")
+    if not last_full: return True
+    days = int(config.get('sync_full_reconcile_days', FULL_RECONCILE_DAYS))
+    return datetime.now() - datetime.fromisoformat(last_full) >= timedelta(days=days)
+
+def to_watermark_param(value):
+    # Watermarks are stored as text; date watermarks have to go back to Sage as dates to compare correctly.
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", value): return date.fromisoformat(value)
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}T[\d:.]+", value): return datetime.fromisoformat(value)
+    return value
+
+def convert_value(value):
+    if isinstance(value, Decimal): return float(value)
+    if isinstance(value, (date, datetime)): return value.isoformat()
+    return value
+
+def build_converters(description):
+    """Resolves one converter per result column from the cursor's type codes, so cells are not type-checked one by one."""
+    converters = []
+    for column in description:
+        type_code = column[1]
+        if isinstance(type_code, type) and issubclass(type_code, Decimal): converters.append(lambda v: None if v is None else float(v))
+        elif isinstance(type_code, type) and issubclass(type_code, date): converters.append(lambda v: None if v is None else v.isoformat())
+        elif isinstance(type_code, type): converters.append(None)
+        else: converters.append(convert_value)  # Driver did not report a usable type; fall back to checking each value.
+    return converters
+
+def row_key(row, pk_idx):
+    return json.dumps([row[i] for i in pk_idx])
+
+def row_hash(row):
+    # 8 bytes is plenty to notice a changed row and fits a SQLite INTEGER.
+    return int.from_bytes(hashlib.blake2b(repr(row).encode(), digest_size=8).digest(), 'big', signed=True)
+
+def stage_table_name(local_table):
+    return f"sync_stage_{local_table}"
+
+def seen_table_name(local_table):
+    return f"temp.sync_seen_{local_table}"
+
+def changed_rows(local_db_con, state, batch):
+    """
+    Compares a batch of (key, hash, row) against the stored row hashes and returns only new and changed
+    rows, as (key, hash, *row), counting each row in state['counts'].
+    """
+    stored = {}
+    for i in range(0, len(batch), HASH_LOOKUP_CHUNK):
+        keys = [key for key, _, _ in batch[i:i + HASH_LOOKUP_CHUNK]]
+        sql = f"SELECT pk, hash FROM sync_row_hash WHERE table_name = ? AND pk IN ({', '.join('?' for _ in keys)})"
+        stored.update(local_db_con.execute(sql, (state['local_table'], *keys)).fetchall())
+    changed, counts = [], state['counts']
+    for key, digest, row in batch:
+        old = stored.get(key)
+        if old == digest:
+            counts['unchanged'] += 1; continue
+        counts['inserted' if old is None else 'updated'] += 1
+        changed.append((key, digest, *row))
+    return changed
+
+def write_staged_rows(local_db_con, state, batch):
+    """Appends one batch to the table's staging table and commits it, so no write transaction outlives a batch."""
+    stage, cols = stage_table_name(state['local_table']), ", ".join(state['columns'])
+    if not state['staged']:
+        local_db_con.execute(f"DROP TABLE IF EXISTS {stage}")
+        local_db_con.execute(f"CREATE TABLE {stage} AS SELECT '' AS sync_pk, 0 AS sync_hash, {cols} FROM {state['local_table']} WHERE 0")
+        state['staged'] = True
+    local_db_con.executemany(f"INSERT INTO {stage} VALUES ({', '.join('?' for _ in range(len(state['columns']) + 2))})", batch)
+    local_db_con.commit()
+
+def write_seen_keys(local_db_con, state, batch):
+    """
+    Records the keys of a full sync's batch in a TEMP table of the writer's connection, so finding the
+    rows Sage no longer returns takes a join in merge_staged_rows() instead of every key in memory.
+    """
+    seen = seen_table_name(state['local_table'])
+    if not state['seen_created']:
+        local_db_con.execute(f"DROP TABLE IF EXISTS {seen}")
+        local_db_con.execute(f"CREATE TABLE {seen} (pk TEXT PRIMARY KEY) WITHOUT ROWID")
+        state['seen_created'] = True
+    local_db_con.executemany(f"INSERT OR IGNORE INTO {seen} (pk) VALUES (?)", ((key,) for key, _, _ in batch))
+    local_db_con.commit()
+
+def merge_staged_rows(local_db_con, state, config_updates):
+    """
+    Publishes a staged table, its row hashes, deletions found by a full sync and its watermark in one
+    short transaction; readers see all of it or none of it. Unchanged rows were never staged, so they
+    are not rewritten.
+    """
+    table, stage, cols = state['local_table'], stage_table_name(state['local_table']), ", ".join(state['columns'])
+    local_db_con.execute("BEGIN IMMEDIATE")
+    if state['staged']:
+        state['counts']['archived'] = drop_archived_rows(local_db_con, table, stage)
+        mark_rollup_days(local_db_con, table, stage=stage)
+        if table == 'SalesOrderDetail': classify_items(local_db_con, stage)
+        # A true UPSERT updates rows in place instead of deleting and re-inserting them like INSERT OR REPLACE.
+        updates = ", ".join(f"{col} = excluded.{col}" for col in state['columns'] if col not in state['pk_cols'])
+        local_db_con.execute(f"""
+            INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage} WHERE true
+            ON CONFLICT ({', '.join(state['pk_cols'])}) DO {f'UPDATE SET {updates}' if updates else 'NOTHING'}
+        """)
+        local_db_con.execute(f"""
+            INSERT INTO sync_row_hash (table_name, pk, hash) SELECT ?, sync_pk, sync_hash FROM {stage} WHERE true
+            ON CONFLICT (table_name, pk) DO UPDATE SET hash = excluded.hash
+        """, (table,))
+    if state['full_sync']:
+        # Rows synced before that Sage no longer returns. Only a full sync sees every row, so only it can tell.
+        if not state['seen_created']: local_db_con.execute(f"CREATE TABLE IF NOT EXISTS {seen_table_name(table)} (pk TEXT PRIMARY KEY) WITHOUT ROWID")
+        gone = "temp.sync_gone"
+        local_db_con.execute(f"DROP TABLE IF EXISTS {gone}")
+        local_db_con.execute(f"""
+            CREATE TABLE {gone} AS SELECT pk FROM sync_row_hash AS h
+            WHERE table_name = ? AND NOT EXISTS (SELECT 1 FROM {seen_table_name(table)} AS s WHERE s.pk = h.pk)
+        """, (table,))
+        state['counts']['deleted'] = local_db_con.execute(f"SELECT COUNT(*) FROM {gone}").fetchone()[0]
+        if state['counts']['deleted'] and state['delete_missing']:
+            # pk is the JSON list of the key values, in pk_cols order.
+            pk_values = ", ".join(f"json_extract(pk, '$[{i}]')" for i in range(len(state['pk_cols'])))
+            if table in ROLLUP_TABLES:
+                mark_rollup_days(local_db_con, table, deleted_order_nos=[no for (no,) in local_db_con.execute(f"SELECT json_extract(pk, '$[0]') FROM {gone}")])
+            local_db_con.execute(f"DELETE FROM {table} WHERE ({', '.join(state['pk_cols'])}) IN (SELECT {pk_values} FROM {gone})")
+            local_db_con.execute(f"DELETE FROM sync_row_hash WHERE table_name = ? AND pk IN (SELECT pk FROM {gone})", (table,))
+        local_db_con.execute(f"DROP TABLE {gone}")
+    for key, value in config_updates.items(): set_config_value(local_db_con, key, value)
+    local_db_con.commit()
+
+def drop_staged_rows(local_db_con, state):
+    if state['staged']:
+        local_db_con.execute(f"DROP TABLE IF EXISTS {stage_table_name(state['local_table'])}")
+        local_db_con.commit()
+    if state['seen_created']:
+        local_db_con.execute(f"DROP TABLE IF EXISTS {seen_table_name(state['local_table'])}")
+        local_db_con.commit()
+
+def local_writer(local_db_con, writes):
+    """
+    The single thread that writes to the local database during a sync. Extract threads send it
+    ('rows', state, batch) and finally ('done', state, config_updates), and None to stop.
+    Rows whose content hash matches the stored one are dropped; new and changed rows go to a per-table
+    staging table, each batch committed on its own, so tables being extracted in parallel never share
+    a transaction and the database is never write-locked for a whole fetch. 'done' then merges the
+    staging table into the live table together with the table's watermark.
+    Nothing is published if any write for the table failed. Any error is kept in the table's state
+    rather than ending the thread, so the queue keeps draining and no extract thread blocks on it.
+    """
+    while True:
+        message = writes.get()
+        if message is None: return
+        kind, state = message[0], message[1]
+        start = time.perf_counter()
+        try:
+            if kind == 'rows':
+                if state['error']: continue  # Drop the rest of a failed table so its extract thread can wind down.
+                if state['full_sync']: write_seen_keys(local_db_con, state, message[2])
+                changed = changed_rows(local_db_con, state, message[2])
+                if changed: write_staged_rows(local_db_con, state, changed)
+                state['rows'] += len(changed)
+            elif kind == 'done':
+                if not state['error']: merge_staged_rows(local_db_con, state, message[2])
+        except Exception as e:
+            state['error'] = e
+            try:
+                if local_db_con.in_transaction: local_db_con.rollback()
+            except sqlite3.Error: pass
+        finally:
+            state['timings']['write'] += time.perf_counter() - start
+            if kind == 'done':
+                try: drop_staged_rows(local_db_con, state)
+                except Exception as e: print(f"WARNING: Could not drop staging table for '{state['local_table']}': {e}")
+                finally: state['finished'].set()
+
+def sync_table(sage_cursor, writes, config, sage_table, local_table, column_map, pk_cols, full_sync=True, cancel=None):
+    sage_cols = list(column_map.keys())
+    watermark_col = config.get(f"sync_watermark_column:{local_table}", WATERMARK_COLUMNS.get(local_table))
+    full_sync = full_sync or not watermark_col
+    print(f"\n--- Starting {'full' if full_sync else 'delta'} sync for {sage_table} -> {local_table} ---")
+    watermark = None if full_sync else config.get(f"sync_watermark:{local_table}")
+    # A change column that is not part of the mapping is selected last and stripped before the upsert.
+    extra_col = watermark_col is not None and watermark_col not in column_map
+    if extra_col: sage_cols.append(watermark_col)
+    watermark_idx = sage_cols.index(watermark_col) if watermark_col else None
+    batch_size = int(config.get('sync_batch_size', SYNC_BATCH_SIZE))
+
+    sage_cols_str = ", ".join(f'"{k}"' for k in sage_cols)
+    query, params = f"SELECT {sage_cols_str} FROM {sage_table}", ()
+    if watermark is not None:
+        # >= rather than > so rows sharing the last watermark value (e.g. the same day) are picked up again.
+        query, params = f'{query} WHERE "{watermark_col}" >= ?', (to_watermark_param(watermark),)
+    print(f"DEBUG: Executing Sage query: {query} {params if params else ''}")
     try:
-        sage_cursor.execute(query)
-        sage_rows = sage_cursor.fetchall()
-        print(f"DEBUG: Found {len(sage_rows)} rows to process from {sage_table}.")
+        sage_cursor.execute(query, *params)
+        converters = build_converters(sage_cursor.description)
     except pyodbc.Error as e:
         print(f"ERROR: Could not fetch data from Sage table {sage_table}. Aborting. Error: {e}")
         return False
 
-    if not sage_rows:
-        print(f"INFO: No rows found in {sage_table} to sync.")
-        return True
+    convert_cols = [(i, conv) for i, conv in enumerate(converters) if conv is not None]
+    width = len(column_map)
+    local_cols = list(column_map.values())
+    pk_cols = (pk_cols,) if isinstance(pk_cols, str) else tuple(pk_cols)
+    pk_idx = [local_cols.index(col) for col in pk_cols]
 
-    # This loop converts data types from Sage into types that SQLite understands.
-    data_to_upsert = []
-    for row in sage_rows:
-        new_row = []
-        for value in row:
-            if isinstance(value, Decimal):
-                new_row.append(float(value))
-            elif isinstance(value, (date, datetime)):
-                new_row.append(value.isoformat())
-            else:
-                new_row.append(value)
-        data_to_upsert.append(tuple(new_row))
-
-    local_cols_str = ", ".join(column_map.values())
-    placeholders = ", ".join("?" for _ in column_map.values())
-    sql_upsert = f"INSERT OR REPLACE INTO {local_table} ({local_cols_str}) VALUES ({placeholders})"
-
-    print(f"DEBUG: Preparing to upsert {len(data_to_upsert)} rows into '{local_table}'.")
-    local_cursor = local_db_con.cursor()
+    # Sage reads overlap local writes: this thread fetches and converts batches while the local writer
+    # inserts them. The writer's bounded queue caps how many converted batches are held in memory.
+    state = {'local_table': local_table, 'columns': local_cols, 'pk_cols': pk_cols, 'staged': False,
+             'full_sync': full_sync, 'seen_created': False, 'delete_missing': config.get('sync_delete_missing', '0') == '1',
+             'counts': dict.fromkeys(('inserted', 'updated', 'unchanged', 'deleted', 'archived'), 0),
+             'timings': dict.fromkeys(('fetch', 'convert', 'write'), 0.0),
+             'rows': 0, 'error': None, 'finished': threading.Event()}
+    print(f"DEBUG: Streaming rows from {sage_table} into '{local_table}' in batches of {batch_size}.")
+    fetched, new_watermark = 0, None
     try:
-        local_cursor.executemany(sql_upsert, data_to_upsert)
-        local_db_con.commit()
-        print(f"SUCCESS: Committed {local_cursor.rowcount} changes to '{local_table}'.")
-        return True
-    except sqlite3.Error as e:
-        print(f"ERROR: Failed to write to local table '{local_table}'. Rolling back. Error: {e}")
-        local_db_con.rollback()
+        while not state['error']:
+            if cancel is not None and cancel.is_set():
+                print(f"INFO: Sync of {sage_table} cancelled after {fetched} rows.")
+                state['error'] = "Cancelled"
+                break
+            start = time.perf_counter()
+            rows = sage_cursor.fetchmany(batch_size)
+            state['timings']['fetch'] += time.perf_counter() - start
+            if not rows: break
+            start = time.perf_counter()
+            batch = []
+            for row in rows:
+                new_row = list(row)
+                for i, conv in convert_cols: new_row[i] = conv(new_row[i])
+                if watermark_idx is not None and new_row[watermark_idx] is not None:
+                    if new_watermark is None or new_row[watermark_idx] > new_watermark: new_watermark = new_row[watermark_idx]
+                new_row = tuple(new_row[:width]) if extra_col else tuple(new_row)
+                batch.append((row_key(new_row, pk_idx), row_hash(new_row), new_row))
+            state['timings']['convert'] += time.perf_counter() - start
+            fetched += len(batch)
+            writes.put(('rows', state, batch))
+    except pyodbc.Error as e:
+        # Rows already written are valid Sage data; the watermark is not advanced, so the next run fetches them again.
+        print(f"ERROR: Could not fetch data from Sage table {sage_table}. Aborting. Error: {e}")
+        state['error'] = e
+
+    config_updates = {}
+    if new_watermark is not None: config_updates[f"sync_watermark:{local_table}"] = new_watermark
+    if full_sync: config_updates[f"sync_last_full:{local_table}"] = datetime.now().isoformat(timespec='seconds')
+    writes.put(('done', state, config_updates))
+    state['finished'].wait()
+    for phase, seconds in state['timings'].items(): metrics.inc('sync_phase_seconds_total', seconds, table=local_table, phase=phase)
+    print(f"DEBUG: '{local_table}' phases: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in state['timings'].items()))
+
+    # Anything but a database or Sage error is a bug in the sync itself; let run_sync report it as one.
+    if isinstance(state['error'], Exception) and not isinstance(state['error'], (sqlite3.Error, pyodbc.Error)): raise state['error']
+    if state['error']:
+        print(f"ERROR: Sync of '{local_table}' failed after {state['rows']} rows were written. Error: {state['error']}")
         return False
+    if not fetched: print(f"INFO: No rows found in {sage_table} to sync.")
+    counts = state['counts']
+    deleted = f"{counts['deleted']} deleted" if state['delete_missing'] else f"{counts['deleted']} missing from Sage (kept)"
+    print(f"SUCCESS: Synced {fetched} fetched rows to '{local_table}': {counts['inserted']} inserted, "
+          f"{counts['updated']} updated, {counts['unchanged']} unchanged, {deleted}.")
+    if counts['archived']:
+        print(f"WARNING: {counts['archived']} new or changed row(s) of '{local_table}' belong to archived fiscal years and were not applied.")
+    return True
+
+def extract_table(sage_config, writes, config, mapping, full_sync, cancel=None):
+    # Each extract gets its own Sage connection so tables can be fetched in parallel.
+    sage_tbl, local_tbl, col_map, pk = mapping
+    try:
+        sage_conn = connect_sage(sage_config)
+    except pyodbc.Error as e:
+        print(f"ERROR: Sage 100 connection for {sage_tbl} failed: {e}")
+        return False
+    try:
+        return sync_table(sage_conn.cursor(), writes, config, sage_tbl, local_tbl, col_map, pk, full_sync=full_sync, cancel=cancel)
+    finally:
+        sage_conn.close()
 
-def main():
-    print("--- Starting Sage 100 to Local DB Sync Process ---")
+def run_sync(local_conn, sage_config, full_sync=False, workers=None, cancel=None):
+    """
+    Syncs every table in TABLE_MAPPINGS. A table starts once all of its SYNC_DEPENDENCIES have synced,
+    up to `workers` tables are extracted at once, and all writes go through one local writer thread.
+    Returns a {local table: 'Success' | 'Failure' | 'Skipped'} map.
+    """
+    config = load_config(local_conn)
+    workers = workers or int(config.get('sync_workers', SYNC_WORKERS))
+    writes = queue.Queue(maxsize=SYNC_QUEUE_DEPTH * workers)
+    # Threads run in a copy of the caller's context so an in-process job runner still captures their output.
+    writer = threading.Thread(target=contextvars.copy_context().run, args=(local_writer, local_conn, writes), daemon=True)
+    writer.start()
+    pending = {mapping[1]: mapping for mapping in TABLE_MAPPINGS}
+    status, running = {}, {}
+    print(f"DEBUG: Syncing {len(pending)} tables with up to {workers} parallel extracts.")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for local_tbl, mapping in list(pending.items()):
+                    deps = SYNC_DEPENDENCIES.get(local_tbl, ())
+                    if cancel is not None and cancel.is_set():
+                        status[local_tbl] = 'Skipped'
+                    elif any(status.get(dep, 'Success') != 'Success' for dep in deps):
+                        print(f"ERROR: Skipping {mapping[0]} because a table it depends on did not sync.")
+                        status[local_tbl] = 'Skipped'
+                    elif all(status.get(dep) == 'Success' for dep in deps):
+                        table_full = full_sync or needs_full_reconcile(config, local_tbl)
+                        running[pool.submit(contextvars.copy_context().run, extract_table, sage_config, writes, config, mapping, table_full, cancel)] = local_tbl
+                    else: continue
+                    del pending[local_tbl]
+                if not running:
+                    # Whatever is still pending depends on a table that is not being synced at all.
+                    for local_tbl in pending: status[local_tbl] = 'Skipped'
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    local_tbl = running.pop(future)
+                    try: ok = future.result()
+                    except Exception as e:
+                        print(f"ERROR: Sync of '{local_tbl}' raised an unexpected error: {e}")
+                        ok = False
+                    status[local_tbl] = 'Success' if ok else 'Failure'
+    finally:
+        writes.put(None)
+        writer.join()
+    try:
+        # Re-aggregate the sales rollup for the order dates this sync touched, also those of failed tables' partial writes.
+        days = refresh_rollup(local_conn)
+        if days: print(f"DEBUG: Refreshed the daily sales rollup for {days} day(s).")
+    except sqlite3.Error as e:
+        print(f"ERROR: Could not refresh the daily sales rollup; it will be retried on the next sync. Error: {e}")
+    if 'Success' in status.values():
+        # Tell the web app's report cache that synced data changed, also when run outside the scheduler.
+        try:
+            bump_data_generation(local_conn)
+            local_conn.commit()
+        except sqlite3.Error as e:
+            print(f"ERROR: Could not mark report data as changed. Error: {e}")
+    checkpoint_mode = config.get('sync_checkpoint_mode', SYNC_CHECKPOINT_MODE).upper()
+    if checkpoint_mode in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        # Fold the sync's writes back into the database file so the WAL does not keep growing.
+        try:
+            busy, log_pages, checkpointed = local_conn.execute(f"PRAGMA wal_checkpoint({checkpoint_mode})").fetchone()
+            print(f"DEBUG: WAL checkpoint ({checkpoint_mode}): {checkpointed} of {log_pages} pages{' (busy)' if busy else ''}.")
+        except sqlite3.Error as e:
+            print(f"WARNING: WAL checkpoint failed: {e}")
+    return status
+
+def main(full_sync=False, workers=None, local_conn=None, cancel=None):
+    """
+    Runs one sync. Called with no arguments from the command line; an in-process job runner passes an
+    already-unlocked `local_conn` (left open afterwards) and a `cancel` event that stops the sync early.
+    Returns True if every table synced.
+    """
+    print(f"--- Starting Sage 100 to Local DB Sync Process{' (forced full reload)' if full_sync else ''} ---")
     start_time = datetime.now()
-    master_password = get_db_password()
-    local_conn = get_local_db_connection(master_password)
-    sage_config = get_sage_creds_and_config(local_conn)
-    sage_conn = get_sage_connection(sage_config)
+    owns_conn = local_conn is None
+    if owns_conn: local_conn = get_local_db_connection(get_db_password())
     try:
-        sage_cursor = sage_conn.cursor()
-        for sage_tbl, local_tbl, col_map, pk in TABLE_MAPPINGS:
-            if not sync_table(sage_cursor, local_conn, sage_tbl, local_tbl, col_map, pk):
-                print(f"FATAL: Sync failed for table {sage_tbl}. Aborting further sync operations.")
-                break
+        try: apply_migrations(local_conn)
+        except sqlite3.Error as e: sys.exit(f"FATAL: Could not upgrade the local database schema. Error: {e}")
+        sage_config = get_sage_creds_and_config(local_conn)
+        status = run_sync(local_conn, sage_config, full_sync=full_sync, workers=workers, cancel=cancel)
     finally:
-        if local_conn: local_conn.close(); print("\nDEBUG: Local database connection closed.")
-        if sage_conn: sage_conn.close(); print("DEBUG: Sage 100 connection closed.")
+        if owns_conn: local_conn.close(); print("\nDEBUG: Local database connection closed.")
+    print("\n--- Sync results ---")
+    for _, local_tbl, _, _ in TABLE_MAPPINGS: print(f"{local_tbl}: {status.get(local_tbl, 'Skipped')}")
     end_time = datetime.now()
     print(f"\n--- Sync process finished in {end_time - start_time} ---")
+    return all(result == 'Success' for result in status.values())
+
+def rebuild(start_date=None, end_date=None):
+    """Rebuilds the daily sales rollup from the synced invoice lines, e.g. after loading history by other means."""
+    local_conn = get_local_db_connection(get_db_password())
+    try:
+        apply_migrations(local_conn)
+        days = rebuild_rollup(local_conn, start_date, end_date)
+        bump_data_generation(local_conn)
+        local_conn.commit()
+        print(f"SUCCESS: Rebuilt the daily sales rollup for {days} day(s).")
+        return True
+    except sqlite3.Error as e:
+        print(f"ERROR: Could not rebuild the daily sales rollup. Error: {e}")
+        return False
+    finally:
+        local_conn.close()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Sync Sage 100 tables into the local encrypted database.")
+    parser.add_argument("--full", action="store_true", help="Ignore stored watermarks and reload every table in full.")
+    parser.add_argument("--workers", type=int, help=f"Tables to extract in parallel (default: config 'sync_workers' or {SYNC_WORKERS}).")
+    parser.add_argument("--rebuild-rollup", action="store_true", help="Do not sync; rebuild the daily sales rollup from the local invoice lines.")
+    parser.add_argument("--since", help="With --rebuild-rollup, only rebuild order dates on or after this YYYY-MM-DD date.")
+    parser.add_argument("--until", help="With --rebuild-rollup, only rebuild order dates on or before this YYYY-MM-DD date.")
+    args = parser.parse_args()
+    if args.rebuild_rollup: sys.exit(0 if rebuild(args.since, args.until) else 1)
+    sys.exit(0 if main(full_sync=args.full, workers=args.workers) else 1)
@@ -0,0 +1,50 @@
+import time
+import threading
+import hashlib
+from collections import OrderedDict
+
+# The data generation is a counter in the config table that is bumped whenever report data changes
+# (a finished sync, a saved sieve test). It is part of every cache key and ETag, so nothing cached
+# before a change is ever served after it, in this process or any other.
+
+def get_data_generation(db_conn):
+    """Returns (generation, unix time it was last bumped)."""
+    rows = dict(db_conn.execute("SELECT key, value FROM config WHERE key IN ('data_generation', 'data_generation_at')").fetchall())
+    return int(rows.get('data_generation', 0)), float(rows.get('data_generation_at', 0))
+
+def bump_data_generation(db_conn):
+    """Marks report data as changed. Runs in the caller's transaction; the caller commits."""
+    db_conn.execute("""
+        INSERT INTO config (key, value) VALUES ('data_generation', '1')
+        ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    """)
+    db_conn.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('data_generation_at', ?)", (str(time.time()),))
+
+def make_etag(*parts):
+    return hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()
+
+class ReportCache:
+    """A thread-safe LRU cache of report query results holding at most `max_entries` results."""
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        # Computed outside the lock so a slow report does not block cache hits for other requests.
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock: self._entries.clear()
@@ -0,0 +1,283 @@
+import os
+import sys
+import glob
+import getpass
+import argparse
+from datetime import datetime, date
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+from report_cache import bump_data_generation
+from sales_summary import ROLLUP_SELECT, lines_from, refresh_rollup, mark_all_rollup_days
+
+# Closed fiscal years of sales history can be moved out of the hot database into one encrypted database
+# file per year, under ARCHIVE_DIR. An archive is attached with the hot database's own key, and only when
+# a query's date range reaches into its year: reports read the TEMP view sales_order_lines, which
+# use_partitions() defines per connection over the hot tables and the archives the range needs. The daily
+# rollup of an archived year moves to sales_archive_rollup, so the summaries never attach anything.
+# Archived invoices are closed: the sync does not bring them back or apply later Sage changes to them
+# (restore the year, sync and archive it again for that).
+
+DB_FILE = "operations_dashboard.db"
+ARCHIVE_DIR = "archive"
+ARCHIVED_TABLES = ('SalesOrderHeader', 'SalesOrderDetail')
+# SQLite attaches at most 10 databases to a connection, so one query can read at most this many archives.
+# Archives a query does not need are detached to make room.
+MAX_ATTACHED_ARCHIVES = 10
+# Detail columns of sales_order_lines, after every SalesOrderHeader column.
+LINE_COLUMNS = "d.LineKey, d.ItemCode, d.ItemCodeDesc, d.QuantityOrdered, d.QuantityShipped, d.UnitPrice, d.ExtensionAmt, d.CommentText AS DetailComment"
+
+def fiscal_year_start_month(db_conn):
+    row = db_conn.execute("SELECT value FROM config WHERE key = 'fiscal_year_start_month'").fetchone()
+    month = int(row[0]) if row else 1
+    if not 1 <= month <= 12: raise ValueError(f"Invalid fiscal_year_start_month {month}.")
+    return month
+
+def fiscal_year_range(year, start_month=1):
+    """(first day, first day of the next year) of a fiscal year, named after the calendar year it ends in."""
+    if start_month == 1: return f"{year:04d}-01-01", f"{year + 1:04d}-01-01"
+    return f"{year - 1:04d}-{start_month:02d}-01", f"{year:04d}-{start_month:02d}-01"
+
+def current_fiscal_year(start_month=1, today=None):
+    today = today or date.today()
+    return today.year + (1 if start_month > 1 and today.month >= start_month else 0)
+
+def archive_alias(year):
+    return f"sales_fy{int(year)}"
+
+def attached_archives(db_conn):
+    """{schema name: file} of the archives attached to a connection."""
+    return {row[1]: row[2] for row in db_conn.execute("PRAGMA database_list") if row[1].startswith('sales_fy')}
+
+def same_file(attached, path):
+    return os.path.normcase(os.path.abspath(attached)) == os.path.normcase(os.path.abspath(path))
+
+def attach_archive(db_conn, year, path, keep=()):
+    """
+    Attaches an archive unless that file already is, detaching others not in `keep` to stay under the
+    limit. Returns its schema name. Every archiving of a year writes a new file, so a connection that
+    still has an earlier archive of the year attached re-attaches the current one.
+    """
+    alias = archive_alias(year)
+    attached = attached_archives(db_conn)
+    if alias in attached:
+        if same_file(attached[alias], path): return alias
+        db_conn.execute(f"DETACH DATABASE {alias}")
+        del attached[alias]
+    if not os.path.exists(path): raise ValueError(f"The archive of fiscal year {year} is missing: '{path}'.")
+    for other in [name for name in attached if name not in keep][:max(0, len(attached) + 1 - MAX_ATTACHED_ARCHIVES)]:
+        db_conn.execute(f"DETACH DATABASE {other}")
+    # Without a KEY clause SQLCipher opens the file with the main database's key, which costs no key derivation.
+    db_conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+    return alias
+
+def detach_archive(db_conn, year):
+    if archive_alias(year) in attached_archives(db_conn): db_conn.execute(f"DETACH DATABASE {archive_alias(year)}")
+
+def remove_file(path):
+    # On Windows a file another connection still has open cannot be deleted; it is retried by the next archive of the year.
+    for name in (path, path + "-journal", path + "-wal", path + "-shm"):
+        try:
+            if os.path.exists(name): os.remove(name)
+        except OSError as e:
+            print(f"WARNING: Could not delete '{name}': {e}")
+
+def table_columns(db_conn, schema, table):
+    return [row[1] for row in db_conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def lines_select(db_conn, schema, header_columns):
+    # A header column added to the hot table after a year was archived reads as NULL for that year.
+    present = set(table_columns(db_conn, schema, 'SalesOrderHeader'))
+    columns = ", ".join(f"h.{col}" if col in present else f"NULL AS {col}" for col in header_columns)
+    return (f"SELECT {columns}, {LINE_COLUMNS} FROM {schema}.SalesOrderHeader AS h "
+            f"INNER JOIN {schema}.SalesOrderDetail AS d ON h.SalesOrderNo = d.SalesOrderNo")
+
+def use_partitions(db_conn, start_date, end_date):
+    """
+    Defines the TEMP view sales_order_lines on this connection: the hot detail lines joined to their
+    headers, plus those of every archived fiscal year that overlaps start_date..end_date, attaching
+    those archives. Call it outside a transaction, before querying the view. Returns the archived years used.
+    """
+    archives = db_conn.execute("SELECT fiscal_year, path FROM sales_archive WHERE start_date <= ? AND end_before > ? ORDER BY fiscal_year",
+                               (end_date, start_date)).fetchall()
+    if len(archives) > MAX_ATTACHED_ARCHIVES:
+        raise ValueError(f"The range spans {len(archives)} archived fiscal years; at most {MAX_ATTACHED_ARCHIVES} can be read at once.")
+    aliases = [archive_alias(year) for year, _ in archives]
+    schemas = ['main'] + [attach_archive(db_conn, year, path, keep=aliases) for year, path in archives]
+    header_columns = table_columns(db_conn, 'main', 'SalesOrderHeader')
+    body = "\nUNION ALL ".join(lines_select(db_conn, schema, header_columns) for schema in schemas)
+    current = db_conn.execute("SELECT sql FROM sqlite_temp_master WHERE type = 'view' AND name = 'sales_order_lines'").fetchone()
+    if current is None or not current[0].endswith(body):
+        db_conn.execute("DROP VIEW IF EXISTS temp.sales_order_lines")
+        db_conn.execute(f"CREATE TEMP VIEW sales_order_lines AS {body}")
+    return [year for year, _ in archives]
+
+def drop_archived_rows(db_conn, table, stage):
+    """Removes the rows of archived invoices from a sync's staging table. Returns how many there were."""
+    if table not in ARCHIVED_TABLES: return 0
+    return db_conn.execute(f"DELETE FROM {stage} WHERE SalesOrderNo IN (SELECT SalesOrderNo FROM sales_archive_order)").rowcount
+
+def create_archive_tables(db_conn, alias):
+    for table in ARCHIVED_TABLES:
+        info = db_conn.execute(f"PRAGMA main.table_info({table})").fetchall()
+        columns = ", ".join(f"{row[1]} {row[2]}".strip() for row in info)
+        pk = ", ".join(row[1] for row in sorted((row for row in info if row[5]), key=lambda row: row[5]))
+        db_conn.execute(f"CREATE TABLE {alias}.{table} ({columns}, PRIMARY KEY ({pk}))")
+    db_conn.execute(f"CREATE INDEX {alias}.idx_SalesOrderHeader_OrderDate ON SalesOrderHeader (OrderDate, SalesOrderNo, CustomerNo)")
+
+def copy_rows(db_conn, source, target, where, params=()):
+    """Copies the matching rows of each archived table; SalesOrderDetail rows follow their invoice headers."""
+    for table in ARCHIVED_TABLES:
+        present = set(table_columns(db_conn, source, table))
+        columns = ", ".join(col for col in table_columns(db_conn, target, table) if col in present)
+        condition = where if table == 'SalesOrderHeader' else f"SalesOrderNo IN (SELECT SalesOrderNo FROM {source}.SalesOrderHeader WHERE {where})"
+        db_conn.execute(f"INSERT OR IGNORE INTO {target}.{table} ({columns}) SELECT {columns} FROM {source}.{table} WHERE {condition}", params)
+
+def archive_year(db_conn, year, archive_dir=ARCHIVE_DIR):
+    """
+    Moves a closed fiscal year's invoices into their own archive file and their rollup rows into
+    sales_archive_rollup. The archive is written and committed before anything is deleted from the
+    hot tables, so an interrupted run loses nothing and can simply be repeated. Returns (orders, lines).
+    """
+    start_month = fiscal_year_start_month(db_conn)
+    if year >= current_fiscal_year(start_month): raise ValueError(f"Fiscal year {year} is not closed yet.")
+    if db_conn.execute("SELECT 1 FROM sales_archive WHERE fiscal_year = ?", (year,)).fetchone():
+        raise ValueError(f"Fiscal year {year} is already archived.")
+    start, end_before = fiscal_year_range(year, start_month)
+    refresh_rollup(db_conn)  # The rollup rows that move must be current.
+    os.makedirs(archive_dir, exist_ok=True)
+    # The year is not registered, so any file of it is left over from an interrupted run or a restore.
+    for leftover in glob.glob(os.path.join(archive_dir, f"sales_FY{year}_*.db")): remove_file(leftover)
+    archived_at = datetime.now()
+    path = os.path.join(archive_dir, f"sales_FY{year}_{archived_at:%Y%m%d%H%M%S}.db")
+    alias = archive_alias(year)
+    db_conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+    try:
+        # The write lock on the hot database keeps the sync out until the copy is committed and the rows deleted.
+        db_conn.execute("BEGIN IMMEDIATE")
+        create_archive_tables(db_conn, alias)
+        copy_rows(db_conn, 'main', alias, "OrderDate >= ? AND OrderDate < ?", (start, end_before))
+        db_conn.commit()
+        orders = db_conn.execute(f"SELECT COUNT(*) FROM {alias}.SalesOrderHeader").fetchone()[0]
+        lines = db_conn.execute(f"SELECT COUNT(*) FROM {alias}.SalesOrderDetail").fetchone()[0]
+        db_conn.execute("BEGIN IMMEDIATE")
+        db_conn.execute(f"INSERT INTO sales_archive_order (SalesOrderNo, fiscal_year) SELECT SalesOrderNo, ? FROM {alias}.SalesOrderHeader", (year,))
+        db_conn.execute(f"DELETE FROM main.SalesOrderDetail WHERE (SalesOrderNo, LineKey) IN (SELECT SalesOrderNo, LineKey FROM {alias}.SalesOrderDetail)")
+        db_conn.execute(f"DELETE FROM main.SalesOrderHeader WHERE SalesOrderNo IN (SELECT SalesOrderNo FROM {alias}.SalesOrderHeader)")
+        # The rows' sync hashes stay, so a full sync sees archived rows as unchanged instead of new.
+        db_conn.execute("INSERT INTO sales_archive_rollup SELECT * FROM sales_daily_rollup WHERE day >= ? AND day < ?", (start, end_before))
+        db_conn.execute("DELETE FROM sales_daily_rollup WHERE day >= ? AND day < ?", (start, end_before))
+        db_conn.execute("INSERT INTO sales_archive (fiscal_year, path, start_date, end_before, orders, lines, archived_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (year, path, start, end_before, orders, lines, archived_at.isoformat(timespec='seconds')))
+        bump_data_generation(db_conn)
+        db_conn.commit()
+    except Exception:
+        if db_conn.in_transaction: db_conn.rollback()
+        db_conn.execute(f"DETACH DATABASE {alias}")
+        if not db_conn.execute("SELECT 1 FROM sales_archive WHERE fiscal_year = ?", (year,)).fetchone(): remove_file(path)
+        raise
+    db_conn.execute(f"DETACH DATABASE {alias}")
+    return orders, lines
+
+def restore_year(db_conn, year):
+    """Moves an archived fiscal year back into the hot tables and deletes its archive file. Returns (orders, lines)."""
+    archive = db_conn.execute("SELECT path, start_date, end_before, orders, lines FROM sales_archive WHERE fiscal_year = ?", (year,)).fetchone()
+    if not archive: raise ValueError(f"Fiscal year {year} is not archived.")
+    path, start, end_before, orders, lines = archive
+    detach_archive(db_conn, year)
+    alias = attach_archive(db_conn, year, path)
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        copy_rows(db_conn, alias, 'main', "true")
+        db_conn.execute("DELETE FROM sales_archive_order WHERE fiscal_year = ?", (year,))
+        db_conn.execute("DELETE FROM sales_archive_rollup WHERE day >= ? AND day < ?", (start, end_before))
+        mark_all_rollup_days(db_conn, start, end_before)
+        db_conn.execute("DELETE FROM sales_archive WHERE fiscal_year = ?", (year,))
+        bump_data_generation(db_conn)
+        db_conn.commit()
+    except Exception:
+        if db_conn.in_transaction: db_conn.rollback()
+        raise
+    finally:
+        db_conn.execute(f"DETACH DATABASE {alias}")
+    refresh_rollup(db_conn)
+    remove_file(path)
+    return orders, lines
+
+def refresh_archive_rollups(db_conn):
+    """Re-aggregates the rollup of every archived fiscal year, e.g. after the tons-sold exclusion keywords changed."""
+    for year, path, start, end_before in db_conn.execute("SELECT fiscal_year, path, start_date, end_before FROM sales_archive ORDER BY fiscal_year").fetchall():
+        alias = attach_archive(db_conn, year, path)
+        try:
+            db_conn.execute("BEGIN IMMEDIATE")
+            db_conn.execute("DELETE FROM sales_archive_rollup WHERE day >= ? AND day < ?", (start, end_before))
+            db_conn.execute(f"INSERT INTO sales_archive_rollup (day, ItemCode, CustomerNo, item, revenue, tons, line_count) "
+                            f"{ROLLUP_SELECT} {lines_from(alias)} WHERE h.OrderDate IS NOT NULL GROUP BY 1, 2, 3, 4")
+            db_conn.commit()
+        except Exception:
+            if db_conn.in_transaction: db_conn.rollback()
+            raise
+        finally:
+            db_conn.execute(f"DETACH DATABASE {alias}")
+
+def hot_fiscal_years(db_conn, start_month=1):
+    """[(fiscal year, orders)] of the invoices in the hot tables."""
+    year_sql = "CAST(substr(OrderDate, 1, 4) AS INTEGER)"
+    if start_month > 1: year_sql += f" + (CAST(substr(OrderDate, 6, 2) AS INTEGER) >= {start_month})"
+    return db_conn.execute(f"""
+        SELECT {year_sql} AS fiscal_year, COUNT(*) FROM SalesOrderHeader
+        WHERE OrderDate GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-*' GROUP BY fiscal_year ORDER BY fiscal_year
+    """).fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive closed fiscal years of sales history into separate encrypted files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="Show the archived fiscal years and the fiscal years still in the hot database.")
+    archive = commands.add_parser("archive", help="Move closed fiscal years out of the hot database.")
+    archive.add_argument("years", nargs="*", type=int, help="Fiscal years to archive, named after the calendar year they end in.")
+    archive.add_argument("--closed", action="store_true", help="Archive every closed fiscal year except the most recent --keep ones.")
+    archive.add_argument("--keep", type=int, default=1, help="With --closed, closed fiscal years to keep in the hot database (default 1).")
+    archive.add_argument("--vacuum", action="store_true", help="Afterwards, rebuild the hot database file so it shrinks on disk.")
+    restore = commands.add_parser("restore", help="Move an archived fiscal year back into the hot database.")
+    restore.add_argument("years", nargs="+", type=int)
+    args = parser.parse_args()
+    if not os.path.exists(DB_FILE): sys.exit(f"FATAL: Database file '{DB_FILE}' not found. Please run init_db.py first.")
+    password = os.environ.get('DB_MASTER_PASSWORD') or getpass.getpass("Please enter the database master password: ")
+    con = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    try:
+        con.execute(f"PRAGMA key = '{password}';")
+        from migrations import apply_migrations
+        apply_migrations(con)
+        start_month = fiscal_year_start_month(con)
+        if args.command == 'list':
+            for year, start, end_before, orders, lines, path in con.execute("SELECT fiscal_year, start_date, end_before, orders, lines, path FROM sales_archive ORDER BY fiscal_year"):
+                print(f"FY{year} ({start} to before {end_before}): archived, {orders} invoices, {lines} lines in '{path}'")
+            current = current_fiscal_year(start_month)
+            for year, orders in hot_fiscal_years(con, start_month):
+                print(f"FY{year}: {'closed' if year < current else 'open'}, {orders} invoices in the hot database")
+            return
+        years = args.years
+        if args.command == 'archive' and args.closed:
+            closed = [year for year, _ in hot_fiscal_years(con, start_month) if year < current_fiscal_year(start_month)]
+            years = sorted(set(years) | set(closed[:max(0, len(closed) - args.keep)]))
+        if not years: print("INFO: Nothing to do.")
+        for year in years:
+            started = datetime.now()
+            orders, lines = archive_year(con, year) if args.command == 'archive' else restore_year(con, year)
+            seconds = (datetime.now() - started).total_seconds()
+            print(f"SUCCESS: {'Archived' if args.command == 'archive' else 'Restored'} fiscal year {year}: {orders} invoices, {lines} lines in {seconds:.1f}s.")
+        if args.command == 'archive' and args.vacuum and years:
+            print("INFO: Vacuuming the hot database...")
+            con.execute("VACUUM")
+            print(f"SUCCESS: The hot database is now {os.path.getsize(DB_FILE) / 1048576:.1f} MB.")
+    except (ValueError, OSError, sqlite3.Error) as e:
+        sys.exit(f"FATAL: {e}")
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
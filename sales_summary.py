@@ -0,0 +1,131 @@
+# Lines whose item description contains any keyword in item_class_rule (edited on the Settings page)
+# are not product and do not count toward tons sold; they still count toward revenue. Each distinct
+# (ItemCode, ItemCodeDesc) pair is classified once, in item_class, when the sync first sees it and
+# again only when the keywords change, so the rollup joins a flag instead of matching strings.
+# lower() is ASCII-only, like the case-insensitive LIKE match this replaced.
+EXCLUDED_FLAG_SQL = "EXISTS (SELECT 1 FROM item_class_rule AS r WHERE instr(lower({desc}), lower(r.keyword)) > 0)"
+
+ITEM_DESC_SQL = "CASE WHEN TRIM(COALESCE(d.ItemCodeDesc, '')) = '' THEN '(Not Specified)' ELSE d.ItemCodeDesc END"
+REVENUE_SQL = "TOTAL(d.ExtensionAmt)"
+TONS_SQL = "TOTAL(CASE WHEN ic.excluded THEN 0 ELSE COALESCE(d.QuantityShipped, d.QuantityOrdered, 0) END)"
+
+# Detail lines joined to their invoice header; the rollup below is built from this. An archived fiscal
+# year (see sales_archive.py) has the same two tables in its own attached database, `schema`.
+def lines_from(schema='main'):
+    return f"""
+    FROM {schema}.SalesOrderHeader AS h INNER JOIN {schema}.SalesOrderDetail AS d ON h.SalesOrderNo = d.SalesOrderNo
+    LEFT JOIN main.item_class AS ic ON ic.ItemCode = COALESCE(d.ItemCode, '') AND ic.ItemCodeDesc = COALESCE(d.ItemCodeDesc, '')
+"""
+LINES_FROM = lines_from()
+# One rollup row per group of lines: (day, ItemCode, CustomerNo, item, revenue, tons, line_count).
+ROLLUP_SELECT = f"""
+    SELECT h.OrderDate, COALESCE(d.ItemCode, ''), COALESCE(h.CustomerNo, ''), {ITEM_DESC_SQL},
+           {REVENUE_SQL}, {TONS_SQL}, COUNT(*)
+"""
+# Lines without a parseable YYYY-MM-DD order date are left out of the by-year and by-month summaries.
+VALID_DATE_SQL = "day GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'"
+
+def classify_items(db_conn, stage):
+    """Classifies the item pairs in a staged SalesOrderDetail batch that have not been seen before. Runs in the caller's transaction."""
+    db_conn.execute(f"""
+        INSERT OR IGNORE INTO item_class (ItemCode, ItemCodeDesc, excluded)
+        SELECT ItemCode, ItemCodeDesc, {EXCLUDED_FLAG_SQL.format(desc='ItemCodeDesc')}
+        FROM (SELECT DISTINCT COALESCE(ItemCode, '') AS ItemCode, COALESCE(ItemCodeDesc, '') AS ItemCodeDesc FROM {stage})
+    """)
+
+def get_exclusion_keywords(db_conn):
+    return [row[0] for row in db_conn.execute("SELECT keyword FROM item_class_rule ORDER BY keyword")]
+
+def set_exclusion_keywords(db_conn, keywords):
+    """
+    Replaces the keyword rules, reclassifies every item and re-aggregates the rollup for the days that
+    have lines of a reclassified item. Returns the number of items whose classification changed.
+    """
+    keywords = sorted({keyword.strip().lower() for keyword in keywords if keyword.strip()})
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        db_conn.execute("DELETE FROM item_class_rule")
+        db_conn.executemany("INSERT INTO item_class_rule (keyword) VALUES (?)", ((keyword,) for keyword in keywords))
+        db_conn.execute(f"""
+            INSERT OR IGNORE INTO sales_rollup_dirty (day)
+            SELECT DISTINCT h.OrderDate {LINES_FROM} WHERE ic.excluded != {EXCLUDED_FLAG_SQL.format(desc='ic.ItemCodeDesc')} AND h.OrderDate IS NOT NULL
+        """)
+        flag = EXCLUDED_FLAG_SQL.format(desc='ItemCodeDesc')
+        changed = db_conn.execute(f"UPDATE item_class SET excluded = {flag} WHERE excluded != {flag}").rowcount
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    refresh_rollup(db_conn)
+    return changed
+
+# Summaries read sales_daily_rollup (one row per order date x item code x customer x item description)
+# instead of the detail lines. Days whose lines may have changed are queued in sales_rollup_dirty, by the
+# sync or by a rebuild, and re-aggregated by refresh_rollup(). The lines of archived fiscal years are
+# aggregated into sales_archive_rollup instead; the sales_rollup view reads both.
+ROLLUP_TABLES = ('SalesOrderHeader', 'SalesOrderDetail')
+
+def mark_rollup_days(db_conn, table, stage=None, deleted_order_nos=()):
+    """
+    Queues the order dates a sync write is about to touch: those of the rows in `stage` (before and,
+    for headers, after the change) and those of deleted invoices. Call it before the write, in the
+    same transaction, so the old dates can still be read.
+    """
+    if table not in ROLLUP_TABLES: return
+    queue_days = "INSERT OR IGNORE INTO sales_rollup_dirty (day) SELECT OrderDate FROM ({}) WHERE OrderDate IS NOT NULL"
+    if stage:
+        db_conn.execute(queue_days.format(f"SELECT OrderDate FROM SalesOrderHeader WHERE SalesOrderNo IN (SELECT SalesOrderNo FROM {stage})"))
+        if table == 'SalesOrderHeader': db_conn.execute(queue_days.format(f"SELECT OrderDate FROM {stage}"))
+    db_conn.executemany(queue_days.format("SELECT OrderDate FROM SalesOrderHeader WHERE SalesOrderNo = ?"), ((no,) for no in deleted_order_nos))
+
+def mark_all_rollup_days(db_conn, start_date=None, end_date=None):
+    sql, params = "INSERT OR IGNORE INTO sales_rollup_dirty (day) SELECT DISTINCT OrderDate FROM SalesOrderHeader WHERE OrderDate IS NOT NULL", ()
+    if start_date: sql, params = sql + " AND OrderDate >= ?", params + (start_date,)
+    if end_date: sql, params = sql + " AND OrderDate <= ?", params + (end_date,)
+    db_conn.execute(sql, params)
+
+def refresh_rollup(db_conn):
+    """Re-aggregates every queued day in one transaction. Returns the number of days refreshed."""
+    days = db_conn.execute("SELECT COUNT(*) FROM sales_rollup_dirty").fetchone()[0]
+    if not days: return 0
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        db_conn.execute("DELETE FROM sales_daily_rollup WHERE day IN (SELECT day FROM sales_rollup_dirty)")
+        db_conn.execute(f"""
+            INSERT INTO sales_daily_rollup (day, ItemCode, CustomerNo, item, revenue, tons, line_count)
+            {ROLLUP_SELECT} {LINES_FROM} WHERE h.OrderDate IN (SELECT day FROM sales_rollup_dirty)
+            GROUP BY 1, 2, 3, 4
+        """)
+        db_conn.execute("DELETE FROM sales_rollup_dirty")
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    return days
+
+def rebuild_rollup(db_conn, start_date=None, end_date=None):
+    """Re-aggregates every order date, or those in the given range, e.g. after a backfill."""
+    mark_all_rollup_days(db_conn, start_date, end_date)
+    db_conn.commit()
+    return refresh_rollup(db_conn)
+
+def get_summary_by_item(db_conn, start_date, end_date):
+    sql = """
+        SELECT item, TOTAL(tons) AS tons_sold, TOTAL(revenue) AS revenue
+        FROM sales_rollup WHERE day BETWEEN ? AND ? GROUP BY item ORDER BY revenue DESC
+    """
+    return db_conn.execute(sql, (start_date, end_date)).fetchall()
+
+def get_summary_by_year(db_conn, start_date, end_date):
+    sql = f"""
+        SELECT CAST(substr(day, 1, 4) AS INTEGER) AS year, TOTAL(tons) AS tons_sold, TOTAL(revenue) AS revenue
+        FROM sales_rollup WHERE day BETWEEN ? AND ? AND {VALID_DATE_SQL} GROUP BY year ORDER BY year
+    """
+    return db_conn.execute(sql, (start_date, end_date)).fetchall()
+
+def get_summary_by_month(db_conn, start_date, end_date):
+    sql = f"""
+        SELECT substr(day, 1, 7) AS month, TOTAL(tons) AS tons_sold, TOTAL(revenue) AS revenue
+        FROM sales_rollup WHERE day BETWEEN ? AND ? AND {VALID_DATE_SQL} GROUP BY month ORDER BY month
+    """
+    return db_conn.execute(sql, (start_date, end_date)).fetchall()
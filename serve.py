@@ -0,0 +1,64 @@
+import os
+import sys
+import argparse
+import multiprocessing
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    print("Error: gunicorn is not installed. Please install it using: pip install gunicorn", file=sys.stderr)
+    sys.exit(1)
+
+# Production entry point: serves the dashboard over HTTPS with several worker processes, each with a pool
+# of threads, under gunicorn. The app is imported once in the parent process and the workers are forked
+# from it, which is what lets them share the session key and the database unlock (see workers.py).
+# Exactly one worker runs the scheduler at a time. `python main.py` remains the single-process
+# development server.
+
+DEFAULT_BIND = '0.0.0.0:5000'
+DEFAULT_WORKERS = min(4, multiprocessing.cpu_count())
+# Each open live dashboard or job log holds a thread for its event stream. main.py caps those at
+# MAX_STREAMS_PER_WORKER per worker, so keep --threads well above that cap or pages queue behind streams.
+DEFAULT_THREADS = 16
+
+def post_fork(server, worker):
+    import main
+    main.start_worker()
+
+def worker_exit(server, worker):
+    import main
+    main.stop_worker()
+
+class DashboardServer(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items(): self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Operations Dashboard with several worker processes.")
+    parser.add_argument("--bind", default=DEFAULT_BIND, help=f"Address and port to listen on (default {DEFAULT_BIND}).")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Worker processes (default {DEFAULT_WORKERS}).")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help=f"Request threads per worker (default {DEFAULT_THREADS}).")
+    args = parser.parse_args()
+    if not (os.path.exists('cert.pem') and os.path.exists('key.pem')):
+        sys.exit("Error: SSL certificate not found. Run 'python generate_cert.py' first.")
+    if not os.path.exists('operations_dashboard.db'):
+        sys.exit("Error: Database 'operations_dashboard.db' not found. Run 'python init_db.py' first.")
+    print(f"--- Starting Operations Dashboard with {args.workers} worker(s) x {args.threads} thread(s) on {args.bind} ---")
+    DashboardServer({
+        'bind': args.bind, 'workers': args.workers, 'threads': args.threads, 'worker_class': 'gthread',
+        'certfile': 'cert.pem', 'keyfile': 'key.pem', 'preload_app': True,
+        'post_fork': post_fork, 'worker_exit': worker_exit,
+        # A worker's heartbeat, not a request, must arrive within this; long exports and event streams are fine.
+        'timeout': 60, 'graceful_timeout': 30, 'accesslog': '-',
+    }).run()
+
+if __name__ == "__main__":
+    main()
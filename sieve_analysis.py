@@ -0,0 +1,165 @@
+import numpy as np
+
+# Sieve test analytics. A test's detail rows are the weights retained on each US sieve; from them come
+# the percent retained per sieve, the cumulative percent retained (coarsest sieve first), and the AFS
+# grain fineness number: the weighted average of each sieve's AFS multiplier by percent retained.
+# Everything is computed on NumPy arrays holding the rows of any number of tests at once, grouped by
+# test, so one test and a product's whole history take the same code path and no per-test loop.
+#
+# USSieve 0 is the pan. SpecLow/SpecHigh bound a sieve's percent retained; either may be NULL.
+
+# AFS multipliers of the standard sieve set. A sieve outside the set takes the multiplier of the next
+# coarser standard sieve, so e.g. a 60 sieve counts like the 50 sieve above it.
+AFS_MULTIPLIERS = {6: 3, 12: 5, 20: 10, 30: 20, 40: 30, 50: 40, 70: 50, 100: 70, 140: 100, 200: 140, 270: 200}
+PAN_SIEVE, PAN_MULTIPLIER = 0, 300
+STANDARD_SIEVES = np.array(sorted(AFS_MULTIPLIERS))
+STANDARD_MULTIPLIERS = np.array([AFS_MULTIPLIERS[s] for s in STANDARD_SIEVES], dtype=float)
+# Tests per query when (re)computing stored results, to bound memory on large histories.
+STORE_CHUNK = 20000
+ROLLING_WINDOW = 10
+
+# Detail rows ordered by test, coarsest sieve first and the pan last, as every function here expects.
+DETAIL_SQL = """
+    SELECT d.SieveTestID, d.USSieve, COALESCE(d.Weight, 0), d.SpecLow, d.SpecHigh
+    FROM SieveTestDetail AS d {join} WHERE {where}
+    ORDER BY d.SieveTestID, d.USSieve = 0, d.USSieve
+"""
+
+def afs_multipliers(sieves):
+    index = np.clip(np.searchsorted(STANDARD_SIEVES, sieves, side='right') - 1, 0, len(STANDARD_SIEVES) - 1)
+    return np.where(sieves == PAN_SIEVE, PAN_MULTIPLIER, STANDARD_MULTIPLIERS[index])
+
+def load_details(db_conn, where="1", params=(), join=""):
+    """Detail rows matching `where` as arrays: test ids, sieves, weights, spec lows and spec highs (NaN when NULL)."""
+    rows = db_conn.execute(DETAIL_SQL.format(join=join, where=where), params).fetchall()
+    if not rows: return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0)
+    test_ids, sieves, weights, spec_low, spec_high = zip(*rows)
+    return (np.array(test_ids, dtype=np.int64), np.array(sieves, dtype=np.int64), np.array(weights, dtype=float),
+            np.array(spec_low, dtype=float), np.array(spec_high, dtype=float))
+
+def analyze(test_ids, sieves, weights, spec_low=None, spec_high=None):
+    """
+    Analyses the detail rows of many tests, given as parallel arrays grouped by test in DETAIL_SQL's order.
+    Returns per-row arrays (percent, cumulative, out_of_spec) and per-test arrays (tests, total, afs, out_of_spec).
+    A test with no weight has NaN percentages and AFS.
+    """
+    if not len(test_ids):
+        empty = np.empty(0)
+        return {'percent': empty, 'cumulative': empty, 'row_out_of_spec': empty.astype(bool),
+                'tests': test_ids, 'total': empty, 'afs': empty, 'out_of_spec': empty.astype(bool)}
+    starts = np.flatnonzero(np.r_[True, test_ids[1:] != test_ids[:-1]])
+    group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(test_ids)]))
+    total = np.add.reduceat(weights, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percent = weights * 100 / total[group]
+        afs = np.add.reduceat(weights * afs_multipliers(sieves), starts) / total
+    running = np.cumsum(percent)
+    cumulative = running - (running[starts] - percent[starts])[group]
+    row_out_of_spec = np.zeros(len(test_ids), dtype=bool)
+    if spec_low is not None:
+        with np.errstate(invalid='ignore'):
+            row_out_of_spec = (percent < spec_low) | (percent > spec_high)  # Comparisons with NaN (no spec) are False.
+    return {'percent': percent, 'cumulative': cumulative, 'row_out_of_spec': row_out_of_spec,
+            'tests': test_ids[starts], 'total': total, 'afs': afs, 'out_of_spec': np.logical_or.reduceat(row_out_of_spec, starts)}
+
+def analyze_test(db_conn, test_id):
+    """Per-sieve rows and totals of one test, for its detail page."""
+    test_ids, sieves, weights, spec_low, spec_high = load_details(db_conn, "d.SieveTestID = ?", (test_id,))
+    result = analyze(test_ids, sieves, weights, spec_low, spec_high)
+    rows = [{'sieve': int(s), 'label': 'Pan' if s == PAN_SIEVE else str(s), 'weight': float(w), 'percent': _number(p), 'cumulative': _number(c),
+             'spec_low': _number(lo), 'spec_high': _number(hi), 'out_of_spec': bool(o)}
+            for s, w, p, c, lo, hi, o in zip(sieves, weights, result['percent'], result['cumulative'], spec_low, spec_high, result['row_out_of_spec'])]
+    return {'rows': rows, 'total': float(result['total'][0]) if rows else 0.0,
+            'afs': _number(result['afs'][0]) if rows else None, 'out_of_spec': bool(result['out_of_spec'][0]) if rows else False}
+
+def _number(value):
+    return None if np.isnan(value) else float(value)
+
+def _store(db_conn, test_ids, keep_existing=False):
+    afs_sql = "COALESCE(StoredAFS, ?)" if keep_existing else "?"
+    for i in range(0, len(test_ids), STORE_CHUNK):
+        chunk = test_ids[i:i + STORE_CHUNK]
+        result = analyze(*load_details(db_conn, "d.SieveTestID BETWEEN ? AND ?", (chunk[0], chunk[-1])))
+        wanted = np.isin(result['tests'], chunk)
+        db_conn.executemany(f"UPDATE SieveTest SET StoredAFS = {afs_sql}, OutOfSpec = ? WHERE SieveTestID = ?",
+                            zip(map(_number, result['afs'][wanted]), result['out_of_spec'][wanted].astype(int).tolist(), result['tests'][wanted].tolist()))
+        # A test without detail rows has nothing out of spec; marking it keeps it from being picked up again.
+        db_conn.executemany("UPDATE SieveTest SET OutOfSpec = 0 WHERE SieveTestID = ?", ((t,) for t in np.setdiff1d(chunk, result['tests']).tolist()))
+
+def store_results(db_conn, test_ids):
+    """Caches the AFS number and out-of-spec flag of the given tests on SieveTest. Runs in the caller's transaction."""
+    _store(db_conn, sorted(set(test_ids)))
+
+def refresh_stored_results(db_conn, everything=False):
+    """
+    Computes the cached results of tests that have none yet, or of every test. StoredAFS values already
+    present (e.g. from the lab's previous system) are kept unless `everything` is set. Returns the test count.
+    """
+    where = "1" if everything else "OutOfSpec IS NULL"
+    pending = [row[0] for row in db_conn.execute(f"SELECT SieveTestID FROM SieveTest WHERE {where} ORDER BY SieveTestID")]
+    if not pending: return 0
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        _store(db_conn, pending, keep_existing=not everything)
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    return len(pending)
+
+def rolling_mean(values, selected, window=ROLLING_WINDOW):
+    """
+    For each position, the mean of the last `window` selected, non-NaN values at or before it (NaN before
+    the first). Unselected positions carry the average forward without contributing to it.
+    """
+    use = selected & ~np.isnan(values)
+    picked = values[use]
+    sums = np.r_[0, np.cumsum(picked)]
+    ends = np.arange(1, len(picked) + 1)
+    starts = np.maximum(ends - window, 0)
+    means = (sums[ends] - sums[starts]) / (ends - starts)
+    last = np.cumsum(use) - 1  # Index into `picked` of the latest selected value so far.
+    return np.where(last >= 0, means[np.maximum(last, 0)] if len(picked) else np.nan, np.nan)
+
+def get_product_trend(db_conn, sample_id, start_date, end_date, window=ROLLING_WINDOW):
+    """
+    A product's tests in a date range with their AFS number, its rolling average over the tests selected
+    for averaging, and out-of-spec flags, plus the average distribution per sieve of the selected tests.
+    """
+    tests = db_conn.execute("""
+        SELECT SieveTestID, SieveTestDate, CarorTruckNumber, BillofLading, COALESCE(Selected4Avg, 1) AS Selected4Avg,
+               InternalTest, StoredAFS, OutOfSpec
+        FROM SieveTest WHERE SampleID = ? AND SieveTestDate BETWEEN ? AND ? ORDER BY SieveTestDate, SieveTestID
+    """, (sample_id, start_date, end_date)).fetchall()
+    afs = np.array([np.nan if t['StoredAFS'] is None else t['StoredAFS'] for t in tests], dtype=float)
+    selected = np.array([bool(t['Selected4Avg']) for t in tests], dtype=bool)
+    rolling = rolling_mean(afs, selected, window) if tests else afs
+    rows = [dict(t, afs=_number(a), rolling_afs=_number(r)) for t, a, r in zip(tests, afs, rolling)]
+
+    test_ids, sieves, weights, spec_low, spec_high = load_details(
+        db_conn, "t.SampleID = ? AND t.SieveTestDate BETWEEN ? AND ? AND COALESCE(t.Selected4Avg, 1) = 1", (sample_id, start_date, end_date),
+        join="INNER JOIN SieveTest AS t ON t.SieveTestID = d.SieveTestID")
+    result = analyze(test_ids, sieves, weights)
+    distribution = []
+    if len(test_ids):
+        # Mean percent retained per sieve over the selected tests, counting a sieve missing from a test as 0%.
+        keys, column = np.unique(np.where(sieves == PAN_SIEVE, np.iinfo(np.int64).max, sieves), return_inverse=True)
+        matrix = np.zeros((len(result['tests']), len(keys)))
+        matrix[np.searchsorted(result['tests'], test_ids), column] = np.nan_to_num(result['percent'])
+        means = matrix.mean(axis=0)
+        cumulative = np.cumsum(means)
+        distribution = [{'label': 'Pan' if s == PAN_SIEVE else str(s), 'percent': float(p), 'cumulative': float(c)}
+                        for s, p, c in zip(np.where(keys == np.iinfo(np.int64).max, PAN_SIEVE, keys), means, cumulative)]
+    selected_afs = afs[selected & ~np.isnan(afs)]
+    return {'tests': rows, 'distribution': distribution, 'window': window,
+            'average_afs': float(selected_afs.mean()) if len(selected_afs) else None,
+            'out_of_spec_count': sum(1 for t in tests if t['OutOfSpec'])}
+
+def get_product_summaries(db_conn):
+    """Per product: test count, latest test date, mean AFS of the tests selected for averaging, and out-of-spec count."""
+    return db_conn.execute("""
+        SELECT s.SampleID, s.Name, COUNT(t.SieveTestID) AS test_count, MAX(t.SieveTestDate) AS latest_date,
+               AVG(CASE WHEN COALESCE(t.Selected4Avg, 1) = 1 THEN t.StoredAFS END) AS average_afs, TOTAL(t.OutOfSpec) AS out_of_spec_count
+        FROM Sample AS s LEFT JOIN SieveTest AS t ON t.SampleID = s.SampleID
+        GROUP BY s.SampleID ORDER BY s.Name
+    """).fetchall()
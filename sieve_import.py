@@ -0,0 +1,279 @@
+import io
+import os
+import re
+import sys
+import csv
+import zlib
+import secrets
+import getpass
+import argparse
+from datetime import datetime, date, timedelta
+
+try:
+    from sqlcipher3 import dbapi2 as sqlite3
+except ImportError:
+    print("Error: sqlcipher3-wheels is not installed. Please install it using: pip install sqlcipher3-wheels", file=sys.stderr)
+    sys.exit(1)
+
+from report_cache import bump_data_generation
+from sieve_analysis import store_results, PAN_SIEVE
+
+# Bulk import of historical sieve tests from a CSV file or an .xlsx workbook, one test per row: a date,
+# a product and optionally car/truck number, bill of lading and the legacy test id, then one column per
+# sieve ("20", "#30", "40 mesh", "Pan") holding the weight retained. Rows are read as a stream and stored
+# in batches, each batch's headers and details with one executemany apiece in one transaction. Rows that
+# cannot be imported are written to a rejection report with their row number and reason.
+
+DB_FILE = "operations_dashboard.db"
+BATCH_TESTS = 5000
+REPORT_RETENTION = timedelta(days=7)
+# Header names (compared lower-case, without spaces and punctuation) accepted for each test field.
+HEADER_ALIASES = {
+    'date': ('sievetestdate', 'date', 'testdate'),
+    'product': ('product', 'sample', 'samplename', 'name'),
+    'car_truck': ('carortrucknumber', 'cartruck', 'carortruck', 'truck', 'car'),
+    'bol': ('billoflading', 'bol', 'bolnumber'),
+    'test_id': ('sievetestid', 'testid', 'id'),
+    'internal': ('internaltest', 'internal'),
+    'selected': ('selected4avg', 'selected', 'includeinaverages'),
+}
+SIEVE_HEADER_RE = re.compile(r"^(?:us\s*)?#?\s*(\d+)\s*(?:mesh)?$", re.IGNORECASE)
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M')
+TRUE_VALUES, FALSE_VALUES = {'1', 'true', 'yes', 'y', 'x'}, {'0', 'false', 'no', 'n', ''}
+
+def _normalize(header):
+    return re.sub(r"[^a-z0-9]", "", str(header or '').lower())
+
+def map_columns(header):
+    """Maps a header row to ({field: column index}, [(column index, sieve)]). Raises ValueError if required columns are missing."""
+    fields, sieves = {}, []
+    for i, name in enumerate(header):
+        name = str(name or '').strip()
+        match = SIEVE_HEADER_RE.match(name)
+        if match: sieves.append((i, int(match.group(1)))); continue
+        if name.lower() == 'pan': sieves.append((i, PAN_SIEVE)); continue
+        field = next((f for f, aliases in HEADER_ALIASES.items() if _normalize(name) in aliases), None)
+        if field and field not in fields: fields[field] = i
+    missing = [f for f in ('date', 'product') if f not in fields]
+    if missing: raise ValueError(f"The header row has no {' or '.join(missing)} column.")
+    if not sieves: raise ValueError("The header row has no sieve columns (e.g. '20', '#30', 'Pan').")
+    return fields, sieves
+
+def parse_date(value):
+    if isinstance(value, datetime): return value.date().isoformat()
+    if isinstance(value, date): return value.isoformat()
+    text = str(value or '').strip()
+    for fmt in DATE_FORMATS:
+        try: return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError: pass
+    raise ValueError(f"Unrecognized date {text!r}")
+
+def parse_flag(value, default):
+    text = str(value if value is not None else '').strip().lower()
+    if text in TRUE_VALUES: return 1
+    if text in FALSE_VALUES: return default if text == '' else 0
+    raise ValueError(f"Expected yes/no, got {value!r}")
+
+def cell_text(value):
+    """A cell as text, or None if blank. Spreadsheets store numbers as floats; 12345.0 reads as '12345'."""
+    if value is None: return None
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    return str(value).strip() or None
+
+def read_rows(stream, filename):
+    """Yields a file's rows as lists of cell values, header first. `stream` is a binary file object."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError("Reading .xlsx files requires openpyxl (pip install openpyxl); or save the sheet as CSV.")
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try: yield from (list(row) for row in workbook.active.iter_rows(values_only=True))
+        finally: workbook.close()
+        return
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    sample = text.read(4096)
+    dialect = csv.Sniffer().sniff(sample, delimiters=',;\t') if sample.strip() else csv.excel
+    yield from csv.reader(_chain(sample, text), dialect)
+
+def _chain(first, rest):
+    """Lines of `first` followed by the rest of a text stream, without reading the stream into memory."""
+    buffered = io.StringIO(first + rest.readline())
+    yield from buffered
+    yield from rest
+
+class SieveImporter:
+    """
+    Imports rows into SieveTest/SieveTestDetail in batched transactions. Product names are resolved to
+    SampleIDs from a map loaded once; tests already in the database (same date, product and bill of
+    lading) are skipped, so an import can be re-run after fixing its rejected rows.
+    """
+    def __init__(self, db_conn, create_samples=False, batch_tests=BATCH_TESTS, rejects=None):
+        self.db_conn, self.create_samples, self.batch_tests = db_conn, create_samples, batch_tests
+        self.rejects = rejects  # A csv.writer for the rejection report, or None.
+        self.samples = {name.strip().lower(): sample_id for sample_id, name in db_conn.execute("SELECT SampleID, Name FROM Sample")}
+        self.existing = {tuple(row) for row in db_conn.execute("SELECT SieveTestDate, SampleID, BillofLading FROM SieveTest WHERE COALESCE(BillofLading, '') <> ''")}
+        self.existing_ids = set()  # Legacy ids already used by this import.
+        self.stats = {'rows': 0, 'imported': 0, 'rejected': 0, 'duplicates': 0, 'samples_created': 0}
+        self.rejected = []  # The first rejections, for display: (row number, reason).
+
+    def reject(self, row_number, reason, row):
+        self.stats['rejected'] += 1
+        if len(self.rejected) < 100: self.rejected.append((row_number, reason))
+        if self.rejects: self.rejects.writerow([row_number, reason] + ['' if v is None else v for v in row])
+
+    def run(self, rows):
+        rows = iter(rows)
+        header = next(rows, None)
+        if header is None: raise ValueError("The file is empty.")
+        fields, sieves = map_columns(header)
+        if self.rejects: self.rejects.writerow(['Row', 'Reason'] + ['' if v is None else v for v in header])
+        batch = []
+        for row_number, row in enumerate(rows, 2):
+            if not any(str(v).strip() for v in row if v is not None): continue
+            self.stats['rows'] += 1
+            try:
+                test = self.parse(row, fields, sieves)
+            except ValueError as e:
+                self.reject(row_number, str(e), row); continue
+            if test is None:
+                self.stats['duplicates'] += 1; continue
+            batch.append((row_number, row, test))
+            if len(batch) >= self.batch_tests: self.store(batch); batch = []
+        if batch: self.store(batch)
+        return self.stats
+
+    def cell(self, row, fields, field):
+        i = fields.get(field)
+        value = row[i] if i is not None and i < len(row) else None
+        return value.strip() if isinstance(value, str) else value
+
+    def parse(self, row, fields, sieves):
+        """The test a row describes, or None if it is already in the database. Raises ValueError if the row is invalid."""
+        test_date = parse_date(self.cell(row, fields, 'date'))
+        product = cell_text(self.cell(row, fields, 'product'))
+        if not product: raise ValueError("Missing product")
+        # An unknown product is added as a sample by store(), and only if the row is actually imported.
+        sample_id = self.samples.get(product.lower())
+        if sample_id is None and not self.create_samples: raise ValueError(f"Unknown product {product!r}")
+        bol = cell_text(self.cell(row, fields, 'bol'))
+        test_id = self.cell(row, fields, 'test_id')
+        if test_id not in (None, ''):
+            try: test_id = int(float(test_id))
+            except ValueError: raise ValueError(f"Invalid test id {test_id!r}")
+        else: test_id = None
+        details = []
+        for i, sieve in sieves:
+            value = row[i] if i < len(row) else None
+            if value is None or str(value).strip() == '': continue
+            try: weight = float(value)
+            except ValueError: raise ValueError(f"Invalid weight {value!r} for sieve {sieve or 'Pan'}")
+            if weight < 0: raise ValueError(f"Negative weight for sieve {sieve or 'Pan'}")
+            details.append((sieve, weight))
+        if not details: raise ValueError("No sieve weights")
+        car_truck = cell_text(self.cell(row, fields, 'car_truck'))
+        internal, selected = parse_flag(self.cell(row, fields, 'internal'), 0), parse_flag(self.cell(row, fields, 'selected'), 1)
+        if sample_id is not None and bol and (test_date, sample_id, bol) in self.existing: return None
+        return {'id': test_id, 'date': test_date, 'sample_id': sample_id, 'product': product, 'bol': bol, 'car_truck': car_truck,
+                'internal': internal, 'selected': selected,
+                'details': details}
+
+    def store(self, batch):
+        """Inserts a batch of tests, with their details and cached results, in one transaction."""
+        con = self.db_conn
+        created = []  # Names of the samples this batch adds, forgotten again if it rolls back.
+        try:
+            if not con.in_transaction: con.execute("BEGIN IMMEDIATE")
+            legacy_ids = [test['id'] for _, _, test in batch if test['id'] is not None]
+            taken = self.existing_ids | {row[0] for row in _select_in(con, "SELECT SieveTestID FROM SieveTest WHERE SieveTestID IN ({})", legacy_ids)}
+            next_id = max(con.execute("SELECT COALESCE(MAX(SieveTestID), 0) FROM SieveTest").fetchone()[0], max(legacy_ids, default=0)) + 1
+            headers, details = [], []
+            for row_number, row, test in batch:
+                if test['id'] is not None and test['id'] in taken:
+                    self.reject(row_number, f"Test id {test['id']} already exists", row); continue
+                if test['sample_id'] is None:
+                    test['sample_id'] = self.samples.get(test['product'].lower())
+                    if test['sample_id'] is None:
+                        test['sample_id'] = con.execute("INSERT INTO Sample (Name) VALUES (?)", (test['product'],)).lastrowid
+                        self.samples[test['product'].lower()] = test['sample_id']
+                        created.append(test['product'].lower())
+                key = (test['date'], test['sample_id'], test['bol'])
+                if test['bol'] and key in self.existing:
+                    self.stats['duplicates'] += 1; continue  # Listed twice in the file.
+                if test['id'] is None: test['id'], next_id = next_id, next_id + 1
+                taken.add(test['id'])
+                if test['bol']: self.existing.add(key)
+                headers.append((test['id'], test['date'], test['car_truck'], test['bol'], test['sample_id'], test['internal'], test['selected']))
+                details.extend((test['id'], sieve, weight) for sieve, weight in test['details'])
+            con.executemany("""INSERT INTO SieveTest (SieveTestID, SieveTestDate, CarorTruckNumber, BillofLading, SampleID, InternalTest, Selected4Avg)
+                               VALUES (?, ?, ?, ?, ?, ?, ?)""", headers)
+            # A sieve listed twice for a test (e.g. '30' and '#30') keeps the last weight.
+            con.executemany("INSERT OR REPLACE INTO SieveTestDetail (SieveTestID, USSieve, Weight) VALUES (?, ?, ?)", details)
+            store_results(con, [h[0] for h in headers])
+            if headers: bump_data_generation(con)
+            con.commit()
+        except Exception:
+            con.rollback()
+            for name in created: del self.samples[name]
+            raise
+        self.existing_ids = taken
+        self.stats['imported'] += len(headers)
+        self.stats['samples_created'] += len(created)
+
+def _select_in(con, sql, values, chunk=500):
+    values = list(values)
+    for i in range(0, len(values), chunk):
+        part = values[i:i + chunk]
+        yield from con.execute(sql.format(', '.join('?' for _ in part)), part)
+
+def import_file(db_conn, stream, filename, create_samples=False, rejects=None, batch_tests=BATCH_TESTS):
+    """Imports a CSV or .xlsx file. Returns the importer, whose `stats` and `rejected` describe the outcome."""
+    importer = SieveImporter(db_conn, create_samples=create_samples, batch_tests=batch_tests, rejects=rejects)
+    importer.run(read_rows(stream, filename))
+    return importer
+
+def save_report(db_conn, filename, rejected, text):
+    """Stores an upload's rejection report for later download and drops expired ones. Returns its token."""
+    token = secrets.token_urlsafe(16)
+    db_conn.execute("DELETE FROM sieve_import_report WHERE created_at < ?", ((datetime.now() - REPORT_RETENTION).isoformat(timespec='seconds'),))
+    db_conn.execute("INSERT INTO sieve_import_report (token, filename, created_at, rejected, report) VALUES (?, ?, ?, ?, ?)",
+                    (token, filename, datetime.now().isoformat(timespec='seconds'), rejected, zlib.compress(text.encode('utf-8'))))
+    db_conn.commit()
+    return token
+
+def get_report(db_conn, token):
+    """(filename, CSV text) of a stored rejection report, or None."""
+    row = db_conn.execute("SELECT filename, report FROM sieve_import_report WHERE token = ?", (token,)).fetchone()
+    return (row[0], zlib.decompress(row[1]).decode('utf-8')) if row else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Import historical sieve tests from a CSV file or .xlsx workbook.")
+    parser.add_argument("file", help="CSV (comma, semicolon or tab separated) or .xlsx file, one test per row.")
+    parser.add_argument("--rejects", help="Where to write the rejection report (default: <file>.rejects.csv).")
+    parser.add_argument("--create-samples", action="store_true", help="Add unknown product names as new samples instead of rejecting their rows.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_TESTS, help=f"Tests per transaction (default {BATCH_TESTS}).")
+    args = parser.parse_args()
+    if not os.path.exists(DB_FILE): sys.exit(f"FATAL: Database file '{DB_FILE}' not found. Please run init_db.py first.")
+    if not os.path.exists(args.file): sys.exit(f"FATAL: File '{args.file}' not found.")
+    password = os.environ.get('DB_MASTER_PASSWORD') or getpass.getpass("Please enter the database master password: ")
+    rejects_path = args.rejects or os.path.splitext(args.file)[0] + ".rejects.csv"
+    con = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        con.execute(f"PRAGMA key = '{password}';")
+        from migrations import apply_migrations
+        apply_migrations(con)
+        started = datetime.now()
+        with open(args.file, 'rb') as f, open(rejects_path, 'w', newline='', encoding='utf-8') as report:
+            stats = import_file(con, f, args.file, create_samples=args.create_samples, rejects=csv.writer(report), batch_tests=args.batch_size).stats
+        seconds = (datetime.now() - started).total_seconds()
+        print(f"SUCCESS: Imported {stats['imported']} of {stats['rows']} tests in {seconds:.1f}s; {stats['duplicates']} already present, "
+              f"{stats['rejected']} rejected, {stats['samples_created']} new sample(s).")
+        if stats['rejected']: print(f"WARNING: Rejected rows and reasons are in '{rejects_path}'.")
+        else: os.remove(rejects_path)
+    except (ValueError, sqlite3.Error) as e:
+        sys.exit(f"FATAL: Import failed: {e}")
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import os
+import json
+import mmap
+import struct
+import multiprocessing
+
+# Coordination between the worker processes of a multi-worker server (see serve.py). The server imports
+# the app once and forks its workers from it, so anything created at import time is inherited by every
+# worker: that is how they share the unlock, through an anonymous shared memory map that never touches
+# disk. The scheduler belongs to whichever process holds an exclusive lock on a file; the lock is
+# released by the operating system when that process exits, and another worker then claims it.
+# Metrics are kept per process and added up from a shared map of per-worker slots when scraped.
+
+_HEADER = struct.Struct('<QI')  # version, payload length
+
+class SharedUnlock:
+    """
+    The database unlock (session token and master password) shared by all workers forked after it is
+    created. The first unlock wins: later ones adopt its token, so one browser session is valid in every
+    worker. Like the connection pool, this keeps the password in server memory only.
+    """
+    def __init__(self, size=4096):
+        self._map = mmap.mmap(-1, size)
+        self._lock = multiprocessing.Lock()
+        self._seen, self._value = 0, None  # Per process: last version read and its value.
+
+    def _version(self):
+        return _HEADER.unpack_from(self._map, 0)[0]
+
+    def read(self):
+        """(token, password), or None while no worker has unlocked the database."""
+        if self._version() == self._seen: return self._value
+        with self._lock:
+            version, length = _HEADER.unpack_from(self._map, 0)
+            payload = json.loads(self._map[_HEADER.size:_HEADER.size + length]) if length else None
+        self._seen, self._value = version, tuple(payload) if payload else None
+        return self._value
+
+    def publish(self, token, password):
+        """Shares an unlock unless one is already shared. Returns the shared (token, password)."""
+        with self._lock:
+            version, length = _HEADER.unpack_from(self._map, 0)
+            if length: return tuple(json.loads(self._map[_HEADER.size:_HEADER.size + length]))
+            payload = json.dumps([token, password]).encode()
+            if _HEADER.size + len(payload) > len(self._map): raise ValueError("The password is too long to share between workers.")
+            self._map[_HEADER.size:_HEADER.size + len(payload)] = payload
+            _HEADER.pack_into(self._map, 0, version + 1, len(payload))
+        return token, password
+
+class WorkerSlots:
+    """
+    One slot of JSON data per worker process, readable by every worker forked after it is created. A
+    worker claims a free slot the first time it publishes; when none is free it takes over the slot of
+    a worker that has exited. Used to add up the per-worker metrics (see instrumentation.py).
+    """
+    _SLOT = struct.Struct('<QI')  # pid, payload length
+
+    def __init__(self, slots=32, size=512 * 1024):
+        self.slots, self.size = slots, size
+        self._map = mmap.mmap(-1, slots * size)
+        self._lock = multiprocessing.Lock()
+        self._pid, self._index = None, None  # Per process: the slot claimed, checked against the pid after a fork.
+
+    def _claim(self, pid):
+        owners = [self._SLOT.unpack_from(self._map, i * self.size)[0] for i in range(self.slots)]
+        for i, owner in enumerate(owners):
+            if owner in (0, pid): return i
+        for i, owner in enumerate(owners):
+            if not _alive(owner): return i
+        raise ValueError(f"All {self.slots} worker slots are in use.")
+
+    def publish(self, data):
+        """Replaces this process's slot with `data`."""
+        pid, payload = os.getpid(), json.dumps(data).encode()
+        if self._SLOT.size + len(payload) > self.size: raise ValueError(f"{len(payload)} bytes do not fit in a {self.size} byte worker slot.")
+        with self._lock:
+            if self._pid != pid: self._index, self._pid = self._claim(pid), pid
+            offset = self._index * self.size
+            self._map[offset + self._SLOT.size:offset + self._SLOT.size + len(payload)] = payload
+            self._SLOT.pack_into(self._map, offset, pid, len(payload))
+
+    def read_others(self):
+        """The data last published by every other worker, including ones that have since exited."""
+        pid, others = os.getpid(), []
+        with self._lock:
+            for i in range(self.slots):
+                owner, length = self._SLOT.unpack_from(self._map, i * self.size)
+                start = i * self.size + self._SLOT.size
+                if owner and owner != pid and length: others.append(json.loads(self._map[start:start + length]))
+        return others
+
+def _alive(pid):
+    if os.name == 'nt': return True  # os.kill would terminate it; there are no forked workers on Windows anyway.
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except OSError: pass
+    return True
+
+class LeaderLock:
+    """A non-blocking exclusive lock on a file, held for the life of the process that acquires it."""
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        if self._file is not None: return True
+        f = open(self.path, 'a+')
+        try:
+            f.seek(0)
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close(); return False
+        f.truncate(); f.write(f"{os.getpid()}\n"); f.flush()  # For whoever wonders which process is the leader.
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None: return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0); msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        except OSError: pass
+        self._file.close()
+        self._file = None